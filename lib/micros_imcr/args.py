@@ -18,7 +18,7 @@
 Argument management module.
 """
 
-from os.path import exists, isfile
+from os.path import exists, isdir, isfile
 
 import logging
 
@@ -38,6 +38,28 @@ V_LEVELS = {
 }
 
 
+def parse_encoder_option(text):
+    """
+    Converts a KEY=VALUE encoder option. VALUE is read as JSON when
+    possible, so numbers and booleans keep their type
+
+    :param text: The option text.
+    :return: A (key, value) tuple.
+    """
+    from argparse import ArgumentTypeError
+    from json import loads
+
+    key, separator, value = text.partition('=')
+    if not separator or not key:
+        raise ArgumentTypeError(
+            'Wrong encoder option {!r}: Expected KEY=VALUE'.format(text)
+        )
+    try:
+        return key, loads(value)
+    except ValueError:
+        return key, value
+
+
 def validate_args(args):
     """
     Validate that arguments are valid.
@@ -56,21 +78,116 @@ def validate_args(args):
 
     log.debug('Raw arguments:\n{}'.format(args))
 
-    # Verify if the path_to_src directory exists
-    if exists(args.path_to_json) is False:
-        raise TypeError(
-            'Path to Json does not exists'
-        )
+    # In batch mode path_to_json may be a directory, glob or JSON-lines file
+    if not args.batch:
+        # Verify if the path_to_src directory exists
+        if exists(args.path_to_json) is False:
+            raise TypeError(
+                'Path to Json does not exists'
+            )
 
-    # Check that the path_to_json ends up in a existing file
-    if exists(args.path_to_json):
+        # Check that the path_to_json ends up in a existing file
         if not isfile(args.path_to_json):
             raise TypeError(
                 'Wrong path parameter: It must be an existing file'
             )
-    else:
+
+    # Check the dataset parameters
+    if args.dataset is not None:
+        if args.batch:
+            raise ValueError(
+                'Wrong dataset parameter: It can not be used with --batch'
+            )
+        if args.dataset < 1:
+            raise ValueError(
+                'Wrong dataset parameter: It must be a positive integer'
+            )
+    if args.jitter < 0:
+        raise ValueError(
+            'Wrong jitter parameter: It must not be negative'
+        )
+    if args.shard_size < 1:
+        raise ValueError(
+            'Wrong shard size parameter: It must be a positive integer'
+        )
+
+    # The dry run plans a single configuration or sweep
+    if args.plan and (args.batch or args.dataset is not None
+                      or args.server is not None or args.watch):
+        raise ValueError(
+            'Wrong plan parameter: It can not be used with --batch,'
+            ' --dataset, --server or --watch'
+        )
+    if args.max_memory is not None and args.max_memory < 1:
+        raise ValueError(
+            'Wrong max memory parameter: It must be a positive integer'
+        )
+
+    # A sweep expands a single configuration rendered locally
+    if args.sweep and (args.batch or args.dataset is not None
+                       or args.server is not None or args.watch):
+        raise ValueError(
+            'Wrong sweep parameter: It can not be used with --batch,'
+            ' --dataset, --server or --watch'
+        )
+
+    # Watch mode follows a single configuration rendered locally
+    if args.watch and (args.batch or args.dataset is not None
+                       or args.server is not None):
+        raise ValueError(
+            'Wrong watch parameter: It can not be used with --batch,'
+            ' --dataset or --server'
+        )
+
+    # The render daemon renders a single configuration
+    if args.server is not None and (args.batch or args.dataset is not None):
+        raise ValueError(
+            'Wrong server parameter: It can not be used with --batch or'
+            ' --dataset'
+        )
+
+    # Check that the output directory is not an existing file
+    if exists(args.output_dir) and not isdir(args.output_dir):
         raise TypeError(
-            'Wrong path parameter: File not found'
+            'Wrong output parameter: It must be a directory'
+        )
+
+    # Check that every scene file exists
+    for scene_file in args.scene_files:
+        if not isfile(scene_file):
+            raise TypeError(
+                'Wrong scenes parameter: {} is not an existing file'.format(
+                    scene_file)
+            )
+
+    # Check that the seed is usable as a root seed
+    if args.seed is not None and args.seed < 0:
+        raise ValueError(
+            'Wrong seed parameter: It must not be negative'
+        )
+
+    # Check that the bands have at least one row
+    if args.band_height is not None and args.band_height < 1:
+        raise ValueError(
+            'Wrong band height parameter: It must be a positive integer'
+        )
+
+    # Check the number of saving threads
+    if args.save_threads < 0:
+        raise ValueError(
+            'Wrong save threads parameter: It must not be negative'
+        )
+
+    # Check that the cache has room for something
+    if args.cache_size is not None and args.cache_size < 1:
+        raise ValueError(
+            'Wrong cache size parameter: It must be a positive integer'
+        )
+
+    # Check that at least one worker process was requested
+    if args.jobs < 1:
+        raise ValueError(
+            'Wrong jobs parameter: It must be a positive integer'
         )
 
     return args
@@ -97,7 +214,8 @@ def parse_args(argv=None):
         'path_to_json',
         default="default_data.json",
         help='Absolute path to the json file with the, size, color and format'
-             ' information.'
+             ' information. With --batch: a directory, glob pattern or'
+             ' JSON-lines file of configurations.'
     )
 
     # Misc Arguments
@@ -117,6 +235,220 @@ def parse_args(argv=None):
         help='Increase verbosity level',
     )
 
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes used to render the images',
+    )
+
+    parser.add_argument(
+        '-b', '--batch',
+        action='store_true',
+        help='Render every configuration found in path_to_json, each one in'
+             ' its own directory under the output directory',
+    )
+
+    parser.add_argument(
+        '--sweep',
+        action='store_true',
+        help='Render every combination of the lists in the JSON file, such'
+             ' as "sizex": [600, 2000] or "background": ["black", "white"],'
+             ' each one in its own directory under the output directory.'
+             ' The largest images are scheduled first',
+    )
+
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Dry run: print the estimated memory, primitives, encode time'
+             ' and output size of every image without rendering them. The'
+             ' estimates come from a quick calibration at small sizes',
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Memory budget of the images rendered at once. An image whose'
+             ' estimate is over it is rejected before rendering, and the'
+             ' worker processes only take as many images as fit in it',
+    )
+
+    parser.add_argument(
+        '--dataset',
+        type=int,
+        default=None,
+        metavar='N',
+        help='Render N variants of every scene, with shuffled colors and'
+             ' jittered coordinates, into sharded archives in the output'
+             ' directory',
+    )
+
+    parser.add_argument(
+        '--jitter',
+        type=int,
+        default=0,
+        metavar='PX',
+        help='Maximum displacement of every coordinate of a dataset variant'
+             ' in pixels. Defaults to 0',
+    )
+
+    parser.add_argument(
+        '--shard-format',
+        choices=('tar', 'zip'),
+        default='tar',
+        help='Archive format of the dataset shards. Defaults to tar',
+    )
+
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=256,
+        metavar='MB',
+        help='Size bound of every dataset shard. Defaults to 256',
+    )
+
+    parser.add_argument(
+        '-o', '--output-dir',
+        default='.',
+        help='Directory where the images are saved',
+    )
+
+    parser.add_argument(
+        '--backend',
+        choices=['pillow', 'numpy', 'sparse', 'mmap'],
+        default=None,
+        help='Rasterization backend. Overrides the "backend" JSON key',
+    )
+
+    parser.add_argument(
+        '--band-height',
+        type=int,
+        default=None,
+        metavar='ROWS',
+        help='Render in horizontal bands of ROWS rows streamed to the output'
+             ' file (png or ppm), bounding memory by the band size.'
+             ' Overrides the "band_height" JSON key',
+    )
+
+    parser.add_argument(
+        '--canvas-mode',
+        choices=('RGB', 'P'),
+        default=None,
+        help='Canvas mode of the pillow backend. P draws on a one byte per'
+             ' pixel indexed canvas, saved as indexed png, gif, bmp or tiff'
+             ' and converted to RGB for other formats. Overrides the'
+             ' "canvas_mode" JSON key, defaults to RGB',
+    )
+
+    parser.add_argument(
+        '--pixel-format',
+        choices=('rgb565le', 'rgb565be', 'rgb332', 'mono'),
+        default=None,
+        help='Pixel layout of the "bin" and "h" framebuffer formats.'
+             ' Overrides the "pixel_format" JSON key, defaults to rgb565le',
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Root seed of the random colors. Every scene draws from its own'
+             ' stream derived from it, so the images do not depend on the'
+             ' number of jobs. Overrides the "seed" JSON key',
+    )
+
+    parser.add_argument(
+        '--encoder',
+        choices=['default', 'fast', 'small', 'auto'],
+        default=None,
+        help='Encoder profile for the output format. auto picks the fastest'
+             ' settings whose output fits in --target-size bytes',
+    )
+
+    parser.add_argument(
+        '--encoder-option',
+        dest='encoder_options',
+        type=parse_encoder_option,
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Image.save parameter such as compress_level=1 or lossless=true.'
+             ' Can be repeated. With --encoder, replaces the "encoder" JSON'
+             ' key',
+    )
+
+    parser.add_argument(
+        '--target-size',
+        type=int,
+        default=None,
+        metavar='BYTES',
+        help='Output size the auto encoder profile aims for. Overrides the'
+             ' "target_size" JSON key',
+    )
+
+    parser.add_argument(
+        '--save-threads',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Encode and save images on N background threads while the next'
+             ' image is drawn. Used when --jobs is 1',
+    )
+
+    parser.add_argument(
+        '--cache',
+        dest='cache_dir',
+        default=None,
+        metavar='DIR',
+        help='Render cache directory. Unchanged images are copied from it'
+             ' instead of being rendered again',
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Size limit of the render cache, least recently used images are'
+             ' evicted first. Defaults to 1024',
+    )
+
+    parser.add_argument(
+        '--scenes',
+        dest='scene_files',
+        action='append',
+        default=[],
+        metavar='PATH',
+        help='JSON file with additional scene definitions. Can be repeated',
+    )
+
+    parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='Keep running and render again the scenes affected by every'
+             ' edit of the JSON file or of the scene files',
+    )
+
+    parser.add_argument(
+        '--server',
+        default=None,
+        metavar='ADDRESS',
+        help='Send the configuration to the micros_imcr_daemon listening on'
+             ' ADDRESS (unix:PATH or HOST:PORT), which writes the images to'
+             ' the output directory',
+    )
+
+    parser.add_argument(
+        '--metrics',
+        default=None,
+        metavar='PATH',
+        help='Write per-scene timings, sizes and peak memory to PATH, in'
+             ' Prometheus text format when PATH ends in .prom, JSON otherwise',
+    )
+
     args = parser.parse_args(argv)
     args = validate_args(args)
     return args
@@ -0,0 +1,885 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rasterization backends.
+
+A backend owns the canvas of an ImcrPrinter and draws batches of DrawOp
+on it. Every backend produces the same pixels as the Pillow one.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from functools import lru_cache
+from io import BytesIO
+from logging import getLogger
+
+from PIL import Image, ImageDraw
+
+log = getLogger(__name__)
+
+
+class PillowCanvas:
+    """
+    Canvas drawn one primitive at a time with PIL.ImageDraw
+    """
+    name = "pillow"
+
+    def __init__(self, mode, size, background, pool):
+        self.mode = mode
+        self.size = tuple(size)
+        self.background = background
+        self.pool = pool
+        self.image = pool.acquire(mode, self.size, background)
+
+    def reset(self):
+        """
+        Clears the canvas to the background color
+        """
+        self.pool.release(self.image, self.background)
+        self.image = self.pool.acquire(self.mode, self.size, self.background)
+
+    def detach(self):
+        """
+        Returns the current image and starts a new canvas
+        """
+        image = self.image
+        self.image = self.pool.acquire(self.mode, self.size, self.background)
+        return image
+
+    def recycle(self, image):
+        """
+        Gives back an image returned by detach once it is no longer used
+        """
+        self.pool.release(image, self.background)
+
+    def draw(self, ops, colors, palette):
+        """
+        Draws a batch of operations
+        :param ops:           List of DrawOp
+        :param colors:        Palette index of every operation
+        :param palette:       List of (r, g, b) colors
+        """
+        drawer = ImageDraw.Draw(self.image)
+        for op, color_index in zip(ops, colors):
+            fill = palette[color_index]
+            if op.kind == "line":
+                drawer.line(xy=op.xy, fill=fill)
+            else:
+                drawer.arc(xy=op.xy, start=op.start, end=op.end, fill=fill)
+
+
+@lru_cache(maxsize=256)
+def _arc_footprint(width, height, start, end):
+    """
+    Pixel offsets drawn by Pillow for an arc in a width x height box. Arcs
+    with integer boxes are translation invariant, so the footprint is
+    computed once and shifted to every arc of the same shape
+    """
+    import numpy
+
+    scratch = Image.new("L", (width + 1, height + 1))
+    ImageDraw.Draw(scratch).arc(
+        xy=(0, 0, width, height), start=start, end=end, fill=255)
+    ys, xs = numpy.nonzero(numpy.asarray(scratch))
+    return xs, ys
+
+
+def _rasterize_lines(xy, size):
+    """
+    Pixels of a batch of lines with Pillow's Bresenham variant, clipped to
+    the canvas
+    :param xy:            (n, 4) array of x0, y0, x1, y1
+    :param size:          (width, height) of the canvas
+    :return:              Flat pixel index and line index of every pixel
+    """
+    import numpy as np
+
+    width, height = size
+    x0, y0, x1, y1 = xy.T
+    dx, dy = np.abs(x1 - x0), np.abs(y1 - y0)
+    sx = np.where(x1 < x0, -1, 1)
+    sy = np.where(y1 < y0, -1, 1)
+    x_major = dx > dy
+    steps = np.maximum(dx, dy)
+    minor = np.minimum(dx, dy)
+
+    # Every line plots steps + 1 pixels, the last point included
+    counts = steps + 1
+    ids = np.repeat(np.arange(len(xy)), counts)
+    i = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                            counts)
+
+    # Offset along the minor axis after i steps of the major axis
+    denominator = np.maximum(2 * steps, 1)[ids]
+    j = (2 * minor[ids] * i + denominator // 2) // denominator
+
+    major = x_major[ids]
+    xs = x0[ids] + sx[ids] * np.where(major, i, j)
+    ys = y0[ids] + sy[ids] * np.where(major, j, i)
+
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    return ys[inside] * width + xs[inside], ids[inside]
+
+
+def _op_arrays(ops):
+    """
+    (n, 4) int64 array of the boxes of a list of DrawOp and boolean array
+    of the lines among them
+    """
+    import numpy as np
+
+    xy = np.fromiter(
+        chain.from_iterable([op.xy for op in ops]), dtype=np.int64,
+        count=4 * len(ops)).reshape(-1, 4)
+    lines = np.fromiter(
+        (op.kind == "line" for op in ops), dtype=bool, count=len(ops))
+    return xy, lines
+
+
+def _batch_pixels(ops, size, footprint=_arc_footprint, arrays=None):
+    """
+    Pixels of a batch of operations, clipped to the canvas
+    :param ops:           List of DrawOp
+    :param size:          (width, height) of the canvas
+    :param footprint:     Function returning the (xs, ys) offsets of an arc
+    :param arrays:        The _op_arrays of ops, when already known
+    :return:              Flat pixel index and operation index of every
+                          pixel, an operation may touch a pixel more than
+                          once
+    """
+    import numpy as np
+
+    width, height = size
+    flats, orders = [], []
+
+    xy, lines = _op_arrays(ops) if arrays is None else arrays
+    if lines.all():
+        flat, line_ids = _rasterize_lines(xy, size)
+        flats.append(flat)
+        orders.append(line_ids.astype(np.int32))
+    elif lines.any():
+        flat, line_ids = _rasterize_lines(xy[lines], size)
+        flats.append(flat)
+        orders.append(np.flatnonzero(lines).astype(np.int32)[line_ids])
+
+    arcs = np.flatnonzero(~lines)
+    if len(arcs):
+        boxes = xy[arcs]
+        widths, heights = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+        if (widths < 0).any() or (heights < 0).any():
+            raise ValueError("Arc box must have x1 >= x0 and y1 >= y0")
+
+        # Arcs of the same shape share a footprint, shifted to every box
+        shapes = {}
+        for position, shape in enumerate(zip(
+                widths.tolist(), heights.tolist(),
+                [ops[i].start for i in arcs.tolist()],
+                [ops[i].end for i in arcs.tolist()])):
+            shapes.setdefault(shape, []).append(position)
+        for shape, positions in shapes.items():
+            xs, ys = footprint(*shape)
+            positions = np.array(positions, dtype=np.intp)
+            xs = (boxes[positions, 0, None] + xs).reshape(-1)
+            ys = (boxes[positions, 1, None] + ys).reshape(-1)
+            ids = np.repeat(arcs[positions], len(xs) // len(positions))
+            inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+            flats.append(ys[inside] * width + xs[inside])
+            orders.append(ids[inside].astype(np.int32))
+
+    if not flats:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+    return np.concatenate(flats), np.concatenate(orders)
+
+
+# Lines with at most this many steps and arcs of a known shape are drawn
+# by NumPy, the rest by ImageDraw, which fills long spans in C
+SHORT_LINE = 32
+
+# Shorter runs of consecutive short primitives go to ImageDraw, a NumPy
+# batch costs more than a few ImageDraw calls
+MIN_BATCH = 16
+
+# Arc shapes drawn before, the next arcs with these shapes are batched.
+# The set starts over once it holds MAX_SEEN_ARCS shapes
+_seen_arcs = set()
+MAX_SEEN_ARCS = 4096
+
+
+def _arcs_seen(shapes):
+    """
+    For every arc shape, True when it was drawn before. The shapes are
+    recorded, so a footprint is only computed once its shape repeats
+    """
+    if len(_seen_arcs) > MAX_SEEN_ARCS:
+        _seen_arcs.clear()
+    seen = []
+    for shape in shapes:
+        seen.append(shape in _seen_arcs)
+        _seen_arcs.add(shape)
+    return seen
+
+
+class NumpyCanvas:
+    """
+    Canvas stored as a (sizey, sizex, 4) RGBX NumPy array shared with a PIL
+    image. Runs of short primitives, which spend most of their time in the
+    per call overhead of ImageDraw, are rasterized together in a single
+    vectorized pass using Pillow's Bresenham variant and cached arc
+    footprints. Long lines, arc shapes not seen before and runs too short
+    for a batch are drawn by ImageDraw on the same memory, in the order of
+    the operations
+    """
+    name = "numpy"
+
+    def __init__(self, mode, size, background, pool):
+        try:
+            import numpy
+        except ImportError:
+            log.error("The numpy backend requires the numpy package")
+            raise
+
+        if mode != "RGB":
+            raise ValueError("The numpy backend only draws RGB canvases")
+
+        self.__numpy = numpy
+        self.mode = mode
+        self.size = tuple(size)
+        width, height = self.size
+        self.__background = self.__color_words(
+            [pool.template(mode, self.size, background).getpixel((0, 0))])[0]
+        self.__rgbx = numpy.empty((height, width, 4), dtype=numpy.uint8)
+        # One 32-bit word per pixel
+        self.__words = self.__rgbx.reshape(-1).view(numpy.uint32)
+        self.__words.fill(self.__background)
+
+        # Images made from a buffer are read only, ImageDraw would draw on
+        # a copy
+        self.__image = Image.frombuffer(
+            "RGBX", self.size, self.__rgbx, "raw", "RGBX", 0, 1)
+        self.__image.readonly = 0
+
+    @property
+    def array(self):
+        """
+        (sizey, sizex, 3) view of the canvas
+        """
+        return self.__rgbx[:, :, :3]
+
+    @property
+    def image(self):
+        """
+        A new PIL copy of the canvas, allocating the whole area on every
+        access. Drawing on it does not change the canvas, array is the live
+        view of the pixels
+        """
+        return self.__image.convert("RGB")
+
+    @image.setter
+    def image(self, image):
+        self.__rgbx[:, :, :3] = self.__numpy.asarray(image.convert("RGB"))
+
+    def reset(self):
+        """
+        Clears the canvas to the background color
+        """
+        self.__words.fill(self.__background)
+
+    def detach(self):
+        """
+        Returns the current image and starts a new canvas
+        """
+        image = self.image
+        self.reset()
+        return image
+
+    def recycle(self, image):
+        """
+        Detached images are copies, nothing to give back
+        """
+
+    def draw(self, ops, colors, palette):
+        """
+        Draws a batch of operations. Where primitives overlap the last one
+        wins, as with ImageDraw
+        :param ops:           List of DrawOp
+        :param colors:        Palette index of every operation
+        :param palette:       List of (r, g, b) colors
+        """
+        np = self.__numpy
+        if not ops:
+            return
+
+        drawer = ImageDraw.Draw(self.__image)
+        xy, lines = _op_arrays(ops)
+        steps = np.maximum(
+            np.abs(xy[:, 2] - xy[:, 0]), np.abs(xy[:, 3] - xy[:, 1]))
+        short = lines & (steps <= SHORT_LINE)
+        arcs = np.flatnonzero(~lines)
+        if len(arcs):
+            boxes = xy[arcs]
+            short[arcs] = _arcs_seen(zip(
+                (boxes[:, 2] - boxes[:, 0]).tolist(),
+                (boxes[:, 3] - boxes[:, 1]).tolist(),
+                [ops[i].start for i in arcs.tolist()],
+                [ops[i].end for i in arcs.tolist()]))
+
+        # Segments of short operations long enough for a batch, in order
+        bounds = [0] + (np.flatnonzero(short[1:] != short[:-1]) + 1).tolist()
+        ends = bounds[1:] + [len(ops)]
+        runs = [
+            (start, end) for start, end in zip(bounds, ends)
+            if short[start] and end - start >= MIN_BATCH]
+
+        position = 0
+        words = self.__color_words(palette) if runs else None
+        for start, end in runs:
+            self.__draw_each(drawer, ops, colors, palette, position, start)
+            self.__draw_run(
+                ops[start:end], (xy[start:end], lines[start:end]),
+                colors[start:end], words)
+            position = end
+        self.__draw_each(drawer, ops, colors, palette, position, len(ops))
+
+    @staticmethod
+    def __draw_each(drawer, ops, colors, palette, start, end):
+        """
+        Draws the operations start to end - 1 one at a time with ImageDraw
+        """
+        line, arc = drawer.line, drawer.arc
+        for op, color_index in zip(ops[start:end], colors[start:end]):
+            if op.kind == "line":
+                line(op.xy, fill=palette[color_index])
+            else:
+                arc(op.xy, op.start, op.end, fill=palette[color_index])
+
+    def __draw_run(self, ops, arrays, colors, words):
+        """
+        Draws consecutive short operations in a single vectorized pass
+        """
+        np = self.__numpy
+        flat, order = _batch_pixels(ops, self.size, arrays=arrays)
+        if not len(flat):
+            return
+
+        # Sorted by pixel, then by operation, the last entry of every pixel
+        # is the operation drawn last
+        keys = np.argsort(flat * len(ops) + order)
+        flat, order = flat[keys], order[keys]
+        last = np.empty(len(flat), dtype=bool)
+        np.not_equal(flat[1:], flat[:-1], out=last[:-1])
+        last[-1] = True
+
+        run_colors = np.array(colors, dtype=np.intp)
+        self.__words[flat[last]] = words[run_colors[order[last]]]
+
+    def __color_words(self, palette):
+        """
+        Palette as 32-bit RGBX words matching __words
+        """
+        np = self.__numpy
+        values = np.full((len(palette), 4), 255, dtype=np.uint8)
+        values[:, :3] = [color[:3] for color in palette]
+        return values.reshape(-1).view(np.uint32)
+
+
+# Rows of scratch image rasterized at a time by _arc_runs
+_SCRATCH_PIXELS = 1 << 20
+
+_NONZERO = re.compile(b"[^\x00]+")
+
+
+@lru_cache(maxsize=256)
+def _arc_runs(width, height, start, end):
+    """
+    Runs of pixels drawn by Pillow for an arc in a width x height box, as
+    (row, first column, last column + 1) offsets. The box is rasterized in
+    strips, so the scratch memory is bounded whatever the arc size
+    """
+    runs = []
+    stride = width + 1
+    rows = max(1, _SCRATCH_PIXELS // stride)
+    for top in range(0, height + 1, rows):
+        strip_rows = min(rows, height + 1 - top)
+        scratch = Image.new("L", (stride, strip_rows))
+        ImageDraw.Draw(scratch).arc(
+            xy=(0, -top, width, height - top), start=start, end=end,
+            fill=255)
+        for match in _NONZERO.finditer(scratch.tobytes()):
+            # A match may go on from the end of a row to the next one
+            position, match_end = match.span()
+            while position < match_end:
+                row, column = divmod(position, stride)
+                stop = min(match_end, position - column + stride)
+                runs.append((top + row, column, column + stop - position))
+                position = stop
+    return tuple(runs)
+
+
+@lru_cache(maxsize=256)
+def _arc_strip_footprint(width, height, start, end):
+    """
+    The offsets of _arc_footprint taken from the runs of _arc_runs, so the
+    scratch memory is bounded whatever the arc size
+    """
+    import numpy as np
+
+    runs = np.array(
+        _arc_runs(width, height, start, end), dtype=np.int64).reshape(-1, 3)
+    lengths = runs[:, 2] - runs[:, 1]
+    steps = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(runs[:, 1], lengths) + steps, np.repeat(
+        runs[:, 0], lengths)
+
+
+def _line_runs(x0, y0, x1, y1):
+    """
+    Runs of pixels of a line with Pillow's Bresenham variant, see
+    NumpyCanvas, as (row, first column, last column + 1)
+    """
+    dx, dy = abs(x1 - x0), abs(y1 - y0)
+    sx = -1 if x1 < x0 else 1
+    sy = -1 if y1 < y0 else 1
+    steps, minor = max(dx, dy), min(dx, dy)
+    denominator = max(2 * steps, 1)
+
+    if dx <= dy:
+        # One pixel per row
+        runs = []
+        for i in range(steps + 1):
+            x = x0 + sx * ((2 * minor * i + denominator // 2) // denominator)
+            runs.append((y0 + sy * i, x, x + 1))
+        return runs
+
+    # Consecutive steps sharing the minor offset j make a run, the first
+    # one being the smallest i with 2 * minor * i + steps >= 2 * steps * j
+    runs = []
+    first = 0
+    for j in range(minor + 1):
+        if j < minor:
+            after = -(-(2 * steps * (j + 1) - steps) // (2 * minor))
+        else:
+            after = steps + 1
+        if after > first:
+            if sx > 0:
+                runs.append((y0 + sy * j, x0 + first, x0 + after))
+            else:
+                runs.append((y0 + sy * j, x0 - after + 1, x0 - first + 1))
+        first = after
+    return runs
+
+
+class SparseCanvas:
+    """
+    Canvas storing only the runs of drawn pixels of every row, for large
+    images that are mostly background. Memory and drawing time follow the
+    drawn pixels instead of the area. The rows are only expanded when the
+    canvas is written, one at a time by stream, or all together by image
+    for the formats that can not be streamed
+    """
+    name = "sparse"
+
+    def __init__(self, mode, size, background, pool):
+        if mode != "RGB":
+            raise ValueError("The sparse backend only draws RGB canvases")
+
+        if isinstance(background, str):
+            from PIL import ImageColor
+
+            background = ImageColor.getrgb(background)
+        self.mode = mode
+        self.size = tuple(size)
+        self.background = bytes(bytearray(background[:3]))
+        self.__empty_row = self.background * self.size[0]
+        # row -> [starts, ends, fills], sorted and not overlapping
+        self.__rows = {}
+
+    @property
+    def drawn_pixels(self):
+        """
+        Number of pixels covered by the runs
+        """
+        return sum(
+            end - start for starts, ends, _ in self.__rows.values()
+            for start, end in zip(starts, ends))
+
+    @property
+    def image(self):
+        """
+        A PIL copy of the canvas. Allocates the whole area
+        """
+        return Image.frombytes("RGB", self.size, b"".join(self.iter_rows()))
+
+    @image.setter
+    def image(self, image):
+        raise ValueError("The sparse backend can not load an image")
+
+    def reset(self):
+        """
+        Clears the canvas to the background color
+        """
+        self.__rows = {}
+
+    def detach(self):
+        """
+        Returns the current image and starts a new canvas
+        """
+        image = self.image
+        self.reset()
+        return image
+
+    def recycle(self, image):
+        """
+        Detached images are copies, nothing to give back
+        """
+
+    def draw(self, ops, colors, palette):
+        """
+        Draws a batch of operations
+        :param ops:           List of DrawOp
+        :param colors:        Palette index of every operation
+        :param palette:       List of (r, g, b) colors
+        """
+        width, height = self.size
+        for op, color_index in zip(ops, colors):
+            fill = bytes(bytearray(palette[color_index][:3]))
+            x0, y0, x1, y1 = (int(value) for value in op.xy)
+            if op.kind == "line":
+                runs = _line_runs(x0, y0, x1, y1)
+            else:
+                if x1 < x0 or y1 < y0:
+                    raise ValueError(
+                        "Arc box must have x1 >= x0 and y1 >= y0")
+                runs = [
+                    (row + y0, first + x0, last + x0) for row, first, last
+                    in _arc_runs(x1 - x0, y1 - y0, op.start, op.end)]
+
+            for row, first, last in runs:
+                if 0 <= row < height:
+                    first, last = max(first, 0), min(last, width)
+                    if first < last:
+                        self.__paint(row, first, last, fill)
+
+    def __paint(self, row, first, last, fill):
+        """
+        Sets the columns first to last - 1 of a row, over any earlier run
+        """
+        runs = self.__rows.get(row)
+        if runs is None:
+            self.__rows[row] = [[first], [last], [fill]]
+            return
+
+        starts, ends, fills = runs
+        # Runs overlapping [first, last) are lo to hi - 1
+        lo = bisect_right(ends, first)
+        hi = bisect_left(starts, last)
+        new_starts, new_ends, new_fills = [first], [last], [fill]
+        if lo < hi:
+            if starts[lo] < first:
+                new_starts.insert(0, starts[lo])
+                new_ends.insert(0, first)
+                new_fills.insert(0, fills[lo])
+            if ends[hi - 1] > last:
+                new_starts.append(last)
+                new_ends.append(ends[hi - 1])
+                new_fills.append(fills[hi - 1])
+        starts[lo:hi] = new_starts
+        ends[lo:hi] = new_ends
+        fills[lo:hi] = new_fills
+
+    def iter_rows(self):
+        """
+        Yields the RGB bytes of every row, top to bottom
+        """
+        for row in range(self.size[1]):
+            if row in self.__rows:
+                yield self.__row_bytes(row)
+            else:
+                yield self.__empty_row
+
+    def __row_bytes(self, row):
+        data = bytearray(self.__empty_row)
+        for start, end, fill in zip(*self.__rows[row]):
+            data[3 * start:3 * end] = fill * (end - start)
+        return bytes(data)
+
+    def stream(self, writer, rows=64):
+        """
+        Feeds the canvas to a row writer. Runs of empty rows are handed
+        over as a single repeated row
+        :param writer:        PngStreamWriter or PpmStreamWriter
+        :param rows:          Number of drawn rows handed over at a time
+        """
+        drawn = sorted(self.__rows)
+        chunk = []
+        position = 0
+        for row in drawn + [self.size[1]]:
+            if row > position:
+                if chunk:
+                    writer.write_rows(b"".join(chunk))
+                    chunk = []
+                writer.write_repeated_rows(self.__empty_row, row - position)
+            if row == self.size[1]:
+                break
+            chunk.append(self.__row_bytes(row))
+            if len(chunk) == rows:
+                writer.write_rows(b"".join(chunk))
+                chunk = []
+            position = row + 1
+        if chunk:
+            writer.write_rows(b"".join(chunk))
+
+
+class MappedCanvas:
+    """
+    Canvas drawn straight into the pixels of an uncompressed output file,
+    see mapped.py. Lines and arcs are rasterized in a single vectorized
+    pass as the short runs of NumpyCanvas, overlaps being resolved by
+    sorting the drawn pixels, so the resident memory follows the drawn
+    pixels. Until open maps an output file, the canvas is an
+    anonymous map with the layout of the file, allocated on first use
+    """
+    name = "mmap"
+
+    def __init__(self, mode, size, background, pool):
+        try:
+            import numpy
+        except ImportError:
+            log.error("The mmap backend requires the numpy package")
+            raise
+
+        if mode != "RGB":
+            raise ValueError("The mmap backend only draws RGB canvases")
+
+        self.__numpy = numpy
+        self.mode = mode
+        self.size = tuple(size)
+        self.background = background
+        self.layout = None
+        self.path = None
+        self.__encoder = None
+        self.__values = {}
+        self.__buffer = None
+        self.__file = None
+        self.__pixels = None
+
+    def set_format(self, encoder):
+        """
+        Sets the output file format, dropping the current canvas
+        :param encoder:       EncoderSettings of the output
+        :raise ValueError:    When the format can not be mapped
+        """
+        from .mapped import mapped_layout
+
+        self.close()
+        self.layout = mapped_layout(encoder, *self.size)
+        self.__encoder = encoder
+        self.__values = {}
+        self.__buffer = self.__pixels = None
+
+    @property
+    def image(self):
+        """
+        A PIL copy of the canvas, decoded from the file bytes
+        """
+        if self.__encoder.is_framebuffer:
+            raise ValueError(
+                "The pixels of a mapped framebuffer can not be read back")
+        image = Image.open(BytesIO(self.tobytes()))
+        image.load()
+        return image
+
+    @image.setter
+    def image(self, image):
+        raise ValueError("The mmap backend can not load an image")
+
+    def reset(self):
+        """
+        Clears the canvas to the background color
+        """
+        if self.__pixels is not None:
+            self.__pixels[...] = self.__color_values([self.background])[0]
+
+    def detach(self):
+        """
+        Returns the current image and starts a new canvas
+        """
+        image = self.image
+        self.reset()
+        return image
+
+    def recycle(self, image):
+        """
+        Detached images are copies, nothing to give back
+        """
+
+    def open(self, path):
+        """
+        Maps an output file as the canvas, with its header written and its
+        pixels set to the background color
+        """
+        from mmap import mmap
+
+        self.close()
+        self.__buffer = self.__pixels = None
+        output = open(path, "w+b")
+        try:
+            output.truncate(self.layout.size)
+            buffer = mmap(output.fileno(), self.layout.size)
+        except Exception:
+            output.close()
+            raise
+        self.__file = output
+        self.path = path
+        # A new file reads as zeros, a zero background is left unwritten
+        self.__map(buffer, fill=any(bytearray(
+            self.__color_values([self.background])[0].tobytes())))
+
+    def close(self):
+        """
+        Flushes and unmaps the output file opened by open
+        """
+        if self.__file is None:
+            return
+        self.__pixels = None
+        self.__buffer.flush()
+        self.__buffer.close()
+        self.__file.close()
+        self.__buffer = self.__file = self.path = None
+
+    def save(self, path):
+        """
+        Writes the canvas to path. When path is the mapped output file it
+        is only flushed and unmapped
+        """
+        if path == self.path:
+            self.close()
+            return
+        self.__canvas()
+        with open(path, "wb") as output:
+            output.write(self.__buffer)
+
+    def tobytes(self):
+        """
+        The file contents of the canvas
+        """
+        self.__canvas()
+        return self.__buffer[:]
+
+    def draw(self, ops, colors, palette):
+        """
+        Draws a batch of operations. Where primitives overlap the last one
+        wins, as with ImageDraw
+        :param ops:           List of DrawOp
+        :param colors:        Palette index of every operation
+        :param palette:       List of (r, g, b) colors
+        """
+        np = self.__numpy
+        if not ops:
+            return
+
+        flat, order = _batch_pixels(ops, self.size, _arc_strip_footprint)
+        if not len(flat):
+            return
+
+        if len(ops) > 1:
+            # The last pixel of every run of equal indexes, sorted by
+            # operation, is the one drawn last
+            keys = np.lexsort((order, flat))
+            flat, order = flat[keys], order[keys]
+            last = np.append(flat[1:] != flat[:-1], True)
+            flat, order = flat[last], order[last]
+
+        op_colors = self.__color_values(palette)[np.array(colors)]
+        rows, columns = np.divmod(flat, self.size[0])
+        self.__canvas()[rows, columns] = op_colors[order]
+
+    def __canvas(self):
+        """
+        The (sizey, sizex) array of pixels, in an anonymous map when no
+        output file is open
+        """
+        if self.__pixels is None:
+            from mmap import mmap
+
+            self.__map(mmap(-1, self.layout.size), fill=True)
+        return self.__pixels
+
+    def __map(self, buffer, fill):
+        np = self.__numpy
+        layout = self.layout
+        width, height = self.size
+        buffer[:len(layout.header)] = layout.header
+
+        # The pixels as rows at increasing addresses, flipped for bottom-up
+        # files
+        first = layout.offset
+        if layout.stride < 0:
+            first += (height - 1) * layout.stride
+        pixels = np.ndarray(
+            (height, width), dtype="V{}".format(layout.pixel_bytes),
+            buffer=buffer, offset=first,
+            strides=(abs(layout.stride), layout.pixel_bytes))
+        if layout.stride < 0:
+            pixels = pixels[::-1]
+
+        self.__buffer = buffer
+        self.__pixels = pixels
+        if fill:
+            self.reset()
+
+    def __color_values(self, palette):
+        """
+        Palette as an array of pixel values of the file
+        """
+        key = tuple(
+            color if isinstance(color, str) else tuple(color[:3])
+            for color in palette)
+        values = self.__values.get(key)
+        if values is None:
+            from .mapped import pixel_values
+
+            values = self.__values[key] = self.__numpy.frombuffer(
+                pixel_values(self.__encoder, palette),
+                dtype="V{}".format(self.layout.pixel_bytes))
+        return values
+
+
+BACKENDS = {
+    PillowCanvas.name: PillowCanvas,
+    NumpyCanvas.name: NumpyCanvas,
+    SparseCanvas.name: SparseCanvas,
+    MappedCanvas.name: MappedCanvas,
+}
+
+
+def get_backend(name):
+    """
+    Returns the canvas class of a backend name
+    """
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown backend {!r}, expected one of: {}".format(
+                name, ", ".join(sorted(BACKENDS))))
+
+
+__all__ = [
+    'PillowCanvas', 'NumpyCanvas', 'SparseCanvas', 'MappedCanvas',
+    'BACKENDS', 'get_backend']
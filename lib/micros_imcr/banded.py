@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bounded-memory band rendering.
+
+The canvas is rasterized in horizontal strips. Every primitive is drawn on
+a strip shifted by the strip's top row, so Pillow clips it to the strip,
+and the finished rows are streamed to a PNG or PPM writer. Peak memory is
+proportional to sizex * band_height instead of sizex * sizey.
+
+Lines and arcs with integer coordinates are translation invariant, so the
+decoded pixels are the same as a full-canvas render.
+"""
+
+import random
+import struct
+import zlib
+from logging import getLogger
+
+from PIL import ImageDraw
+
+from .canvas import default_pool
+from .encoders import EncoderSettings
+from .scenes import resolve_colors
+
+log = getLogger(__name__)
+
+
+_ADLER_BASE = 65521
+
+# Second byte of the zlib header by compression level, as written by zlib
+_ZLIB_FLAGS = [0x01, 0x01, 0x5e, 0x5e, 0x5e, 0x5e, 0x9c, 0xda, 0xda, 0xda]
+
+
+def adler32_combine(adler1, adler2, length2):
+    """
+    Adler-32 of the concatenation of two pieces, from the checksums of both
+    and the length of the second one, as zlib's adler32_combine
+    """
+    remainder = length2 % _ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % _ADLER_BASE
+    sum1 += (adler2 & 0xffff) + _ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff)
+    sum2 += _ADLER_BASE - remainder
+    return (sum1 % _ADLER_BASE) | ((sum2 % _ADLER_BASE) << 16)
+
+
+class PpmStreamWriter:
+    """
+    Writes a binary PPM (P6) image row by row
+    """
+    def __init__(self, fp, width, height):
+        self.fp = fp
+        fp.write("P6\n{} {}\n255\n".format(width, height).encode("ascii"))
+
+    def write_rows(self, data):
+        """
+        :param data:          RGB bytes of whole rows
+        """
+        self.fp.write(data)
+
+    def write_repeated_rows(self, row, count):
+        """
+        Writes count copies of a row
+        :param row:           RGB bytes of a single row
+        """
+        block = row * min(count, 64)
+        for start in range(0, count, 64):
+            self.fp.write(block[:len(row) * min(64, count - start)])
+
+    def close(self):
+        pass
+
+
+class PngStreamWriter:
+    """
+    Writes an 8-bit RGB PNG row by row, compressing the rows as they come
+
+    The zlib stream is assembled from raw deflate data. Repeated rows, such
+    as the empty rows of a sparse canvas, are compressed once into a
+    self-contained deflate segment that is written again for every
+    repetition, and their checksum is combined arithmetically, so they cost
+    no compression time
+    """
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    # Rows in a cached segment of repeated rows
+    SEGMENT_ROWS = 256
+
+    def __init__(self, fp, width, height, compress_level=6):
+        self.fp = fp
+        self.row_size = 3 * width
+        self.compress_level = compress_level
+        self.__compressor = self.__raw_compressor()
+        self.__adler = 1
+        self.__segments = {}
+
+        fp.write(self.SIGNATURE)
+        self.__chunk(b"IHDR", struct.pack(
+            ">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        level = 6 if compress_level < 0 else min(compress_level, 9)
+        self.__chunk(b"IDAT", bytes(bytearray([0x78, _ZLIB_FLAGS[level]])))
+
+    def write_rows(self, data):
+        """
+        :param data:          RGB bytes of whole rows
+        """
+        # Every row starts with the filter type, 0 is no filter
+        rows = bytearray()
+        for start in range(0, len(data), self.row_size):
+            rows += b"\x00"
+            rows += data[start:start + self.row_size]
+
+        rows = bytes(rows)
+        self.__adler = zlib.adler32(rows, self.__adler)
+        compressed = self.__compressor.compress(rows)
+        if compressed:
+            self.__chunk(b"IDAT", compressed)
+
+    def write_repeated_rows(self, row, count):
+        """
+        Writes count copies of a row
+        :param row:           RGB bytes of a single row
+        """
+        # A full flush ends the pending data on a byte boundary and drops
+        # the history, so the segments can follow it
+        flushed = self.__compressor.flush(zlib.Z_FULL_FLUSH)
+        if flushed:
+            self.__chunk(b"IDAT", flushed)
+
+        filtered = b"\x00" + row
+        while count:
+            rows = min(count, self.SEGMENT_ROWS)
+            segment, adler = self.__segment(filtered, rows)
+            self.__adler = adler32_combine(
+                self.__adler, adler, len(filtered) * rows)
+            self.__chunk(b"IDAT", segment)
+            count -= rows
+
+    def close(self):
+        data = self.__compressor.flush()
+        self.__chunk(b"IDAT", data + struct.pack(">I", self.__adler))
+        self.__chunk(b"IEND", b"")
+
+    def __raw_compressor(self):
+        return zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+
+    def __segment(self, filtered, rows):
+        """
+        Deflate segment and Adler-32 of a filtered row repeated rows times
+        """
+        key = (filtered, rows)
+        cached = self.__segments.get(key)
+        if cached is None:
+            data = filtered * rows
+            compressor = self.__raw_compressor()
+            segment = compressor.compress(data)
+            segment += compressor.flush(zlib.Z_FULL_FLUSH)
+            cached = self.__segments[key] = (segment, zlib.adler32(data))
+        return cached
+
+    def __chunk(self, kind, data):
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(kind)
+        self.fp.write(data)
+        self.fp.write(struct.pack(
+            ">I", zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+
+STREAM_WRITERS = {
+    "png": PngStreamWriter,
+    "ppm": PpmStreamWriter,
+}
+
+
+def open_stream_writer(fp, encoder, width, height):
+    """
+    Row writer of an output format
+    :param fp:            Binary file the image is written to
+    :param encoder:       EncoderSettings of the output
+    :param width:         Image width in pixels
+    :param height:        Image height in pixels
+    :return:              A PngStreamWriter or PpmStreamWriter
+    """
+    writer_class = STREAM_WRITERS.get(encoder.format)
+    if writer_class is None:
+        raise ValueError(
+            "Streamed output writes {} files, not {}".format(
+                "/".join(sorted(STREAM_WRITERS)), encoder.extension))
+    if writer_class is PngStreamWriter:
+        return writer_class(fp, width, height, encoder.compress_level)
+    return writer_class(fp, width, height)
+
+
+def _vertical_span(op):
+    """
+    First and last row a DrawOp can touch
+    """
+    return min(op.xy[1], op.xy[3]), max(op.xy[1], op.xy[3])
+
+
+def render_banded(json_data, plan, seed, file_root_name, band_height):
+    """
+    Renders a plan strip by strip straight into the output file
+    :param json_data:     Is the json data in dictionary format
+    :param plan:          DrawPlan compiled for the configured size
+    :param seed:          Seed for the random colors of the plan
+    :param file_root_name: Output path without the extension
+    :param band_height:   Number of rows rasterized at a time
+    :return:              Path of the written file
+    """
+    extension = json_data["format"]
+    if extension.lower() not in STREAM_WRITERS:
+        raise ValueError(
+            "Band rendering writes {} files, not {}".format(
+                "/".join(sorted(STREAM_WRITERS)), extension))
+    if band_height < 1:
+        raise ValueError("band_height must be a positive integer")
+
+    colors = [
+        json_data["color1"], json_data["color2"],
+        json_data["color3"], json_data["color4"]]
+    palette = [(color[0], color[1], color[2]) for color in colors]
+    color_indexes = resolve_colors(plan, random.Random(seed), len(colors))
+    ops = list(zip(plan.ops, color_indexes))
+
+    width, height = json_data["sizex"], json_data["sizey"]
+    background = json_data["background"]
+    path = "{}.{}".format(file_root_name, extension)
+
+    with open(path, "wb") as fp:
+        writer = open_stream_writer(
+            fp, EncoderSettings.from_json(json_data), width, height)
+        for top in range(0, height, band_height):
+            rows = min(band_height, height - top)
+            strip = default_pool.acquire("RGB", (width, rows), background)
+            drawer = ImageDraw.Draw(strip)
+
+            for op, color_index in ops:
+                first, last = _vertical_span(op)
+                if last < top or first >= top + rows:
+                    continue
+
+                x0, y0, x1, y1 = op.xy
+                xy = (x0, y0 - top, x1, y1 - top)
+                fill = palette[color_index]
+                if op.kind == "line":
+                    drawer.line(xy=xy, fill=fill)
+                else:
+                    drawer.arc(xy=xy, start=op.start, end=op.end, fill=fill)
+
+            writer.write_rows(strip.tobytes())
+            default_pool.release(strip, background)
+        writer.close()
+
+    log.debug("Rendered {} in bands of {} rows".format(path, band_height))
+    return path
+
+
+__all__ = [
+    'render_banded', 'open_stream_writer', 'adler32_combine',
+    'PngStreamWriter', 'PpmStreamWriter']
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batch mode: render many JSON configurations in a single process.
+"""
+
+from collections import namedtuple
+from glob import glob
+from json import loads
+from logging import getLogger
+from os import remove
+from os.path import basename, isdir, isfile, join, splitext
+from time import time
+
+from .main import (
+    get_max_memory, get_overrides, open_cache, open_metrics, render_config,
+    submit_config)
+
+log = getLogger(__name__)
+
+
+# File left in the directory of a failed configuration, with the error
+FAILED_MARKER = "FAILED"
+
+
+# One configuration found by find_configs. Configurations read from a
+# JSON-lines file keep their line number and the byte offset of the line,
+# otherwise line and offset are None
+BatchConfig = namedtuple("BatchConfig", ["name", "path", "line", "offset"])
+
+BatchSummary = namedtuple(
+    "BatchSummary", ["configs", "images", "failures", "elapsed"])
+
+
+def find_configs(source):
+    """
+    Lists the configurations found in a batch source
+    :param source:        Directory with JSON files, glob pattern, JSON-lines
+                          file or a single JSON file
+    :return:              List of BatchConfig, every one with a unique name
+    """
+    if isdir(source):
+        paths = sorted(glob(join(source, "*.json")))
+    elif isfile(source):
+        paths = [source]
+    else:
+        paths = sorted(glob(source))
+
+    configs = []
+    used = set()
+
+    def unique(name):
+        candidate, count = name, 1
+        while candidate in used:
+            count += 1
+            candidate = "{}-{}".format(name, count)
+        used.add(candidate)
+        return candidate
+
+    for path in paths:
+        stem = splitext(basename(path))[0]
+        if not path.endswith(".jsonl"):
+            configs.append(BatchConfig(unique(stem), path, None, None))
+            continue
+
+        # Binary mode, so the offsets can be given to seek
+        offset = 0
+        with open(path, "rb") as jsonl_file:
+            for number, line in enumerate(jsonl_file, start=1):
+                if line.strip():
+                    name = unique("{}-{:04d}".format(stem, number))
+                    configs.append(BatchConfig(name, path, number, offset))
+                offset += len(line)
+
+    return configs
+
+
+def load_config(config):
+    """
+    Reads the JSON data of a BatchConfig
+    """
+    if config.offset is None:
+        with open(config.path) as json_file:
+            return loads(json_file.read())
+
+    with open(config.path, "rb") as jsonl_file:
+        jsonl_file.seek(config.offset)
+        line = jsonl_file.readline()
+    if not line.strip():
+        raise ValueError(
+            "Line {} not found in {}".format(config.line, config.path))
+    return loads(line.decode("utf-8"))
+
+
+def run_batch(source, output_dir=".", jobs=1, scene_files=None,
+              overrides=None, cache=None, save_threads=0, metrics=None,
+              max_memory=None):
+    """
+    Renders every configuration of a batch source. Each configuration is
+    saved in its own directory under output_dir and a failing configuration
+    does not stop the batch. Its directory, which may hold some of its
+    images, gets a FAILED_MARKER file with the error
+    :param source:        Directory, glob pattern, JSON-lines or JSON file
+    :param output_dir:    Base directory for the outputs
+    :param jobs:          Number of worker processes shared by the batch.
+                          The scenes of the next configuration are queued
+                          while the current one finishes
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :param overrides:     Optional JSON keys replacing the ones of every
+                          configuration
+    :param cache:         Optional RenderCache shared by the batch
+    :param save_threads:  Number of background saving threads of serial runs
+    :param metrics:       Optional MetricsRecorder, the scenes are labeled
+                          with their configuration name
+    :param max_memory:    Optional memory budget in bytes, a configuration
+                          with a scene over it fails
+    :return:              A BatchSummary. failures is a list of
+                          (config name, error message)
+    """
+    configs = find_configs(source)
+    if not configs:
+        log.warning("No configurations found in {}".format(source))
+
+    executor = budget = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        if max_memory is not None:
+            from .planner import MemoryBudget
+
+            budget = MemoryBudget(max_memory)
+
+    images = 0
+    failures = []
+    start = time()
+
+    def failed(config, error):
+        log.error("Configuration {} failed: {!r}".format(config.name, error))
+        failures.append((config.name, repr(error)))
+        config_dir = join(output_dir, config.name)
+        if isdir(config_dir):
+            with open(join(config_dir, FAILED_MARKER), "w") as marker:
+                marker.write("{!r}\n".format(error))
+
+    def done(config):
+        marker = join(output_dir, config.name, FAILED_MARKER)
+        if isfile(marker):
+            remove(marker)
+
+    def collect(submitted):
+        # Waits for the scenes of a configuration given to submit_config
+        config, wait = submitted
+        try:
+            count = wait()
+        except Exception as error:
+            failed(config, error)
+            return 0
+        done(config)
+        return count
+
+    # With a pool, the scenes of a configuration are submitted before
+    # waiting for the ones of the previous configuration, so the workers
+    # do not sit idle between configurations
+    waiting = None
+    try:
+        for config in configs:
+            if metrics is not None:
+                metrics.labels["config"] = config.name
+            submitted = None
+            try:
+                if executor is None:
+                    images += render_config(
+                        load_config(config),
+                        output_dir=join(output_dir, config.name),
+                        scene_files=scene_files,
+                        overrides=overrides,
+                        cache=cache,
+                        save_threads=save_threads,
+                        metrics=metrics,
+                        max_memory=max_memory)
+                    done(config)
+                else:
+                    json_data = load_config(config)
+                    if overrides:
+                        json_data = dict(json_data, **overrides)
+                    submitted = config, submit_config(
+                        json_data, executor,
+                        output_dir=join(output_dir, config.name),
+                        scene_files=scene_files,
+                        cache=cache,
+                        metrics=metrics,
+                        budget=budget)
+            except Exception as error:
+                failed(config, error)
+
+            if waiting is not None:
+                images += collect(waiting)
+            waiting = submitted
+
+        if waiting is not None:
+            images += collect(waiting)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return BatchSummary(len(configs), images, failures, time() - start)
+
+
+def format_summary(summary):
+    """
+    Human readable report of a BatchSummary
+    """
+    elapsed = max(summary.elapsed, 1e-9)
+    lines = [
+        "Configurations: {} ({} failed)".format(
+            summary.configs, len(summary.failures)),
+        "Images:         {}".format(summary.images),
+        "Elapsed:        {:.2f} s".format(summary.elapsed),
+        "Throughput:     {:.2f} configs/s, {:.2f} images/s".format(
+            summary.configs / elapsed, summary.images / elapsed),
+    ]
+    for name, error in summary.failures:
+        lines.append("FAILED {}: {}".format(name, error))
+    return "\n".join(lines)
+
+
+def micros_imcr_batch(args):
+    """
+    Batch call of the IMCR package. args.path_to_json is the batch source
+    :return:              Exit code, 1 when any configuration failed
+    """
+    cache = open_cache(args)
+    metrics = open_metrics(args)
+    summary = run_batch(
+        args.path_to_json,
+        output_dir=getattr(args, "output_dir", "."),
+        jobs=getattr(args, "jobs", 1) or 1,
+        scene_files=getattr(args, "scene_files", None),
+        overrides=get_overrides(args),
+        cache=cache,
+        save_threads=getattr(args, "save_threads", 0) or 0,
+        metrics=metrics,
+        max_memory=get_max_memory(args))
+
+    print(format_summary(summary))
+    if cache is not None:
+        from .cache import format_stats
+
+        cache.save_stats()
+        print(format_stats(cache.stats()))
+    if metrics is not None:
+        metrics.write(args.metrics)
+    return 1 if summary.failures else 0
+
+
+__all__ = ['find_configs', 'run_batch', 'micros_imcr_batch']
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline benchmark suite.
+
+Times printer construction, restart_image, draw_line/draw_arc throughput,
+save_image per format and a full render over a matrix of canvas sizes and
+output formats. Results are written as JSON and can be compared against a
+stored baseline to flag regressions::
+
+    micros_imcr_bench run -o results.json
+    micros_imcr_bench compare baseline.json results.json
+
+The imports command measures the import time of the modules behind the
+command line and the tool with python -X importtime, and fails when one of
+them loads Pillow or NumPy before rendering starts.
+"""
+
+import os
+import platform
+import random
+import subprocess
+import sys
+from json import dumps, loads
+from logging import getLogger
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter, strftime
+
+from . import __version__
+
+log = getLogger(__name__)
+
+
+DEFAULT_SIZES = (600, 2000, 4000, 8000, 16000)
+DEFAULT_FORMATS = ("png", "jpg", "bmp", "gif", "tiff", "webp", "ppm")
+
+# Primitives drawn by the throughput benchmarks
+PRIMITIVES_PER_RUN = 1000
+
+# Modules timed by the imports command
+IMPORT_MODULES = (
+    "micros_imcr.args", "micros_imcr.main", "micros_imcr.imcr_tool",
+    "micros_imcr.batch")
+
+# Packages that must only be imported once rendering starts
+LAZY_PACKAGES = ("PIL", "numpy")
+
+BASE_CONFIG = {
+    "color1": [255, 0, 0],
+    "color2": [0, 255, 0],
+    "color3": [0, 0, 255],
+    "color4": [255, 255, 255],
+    "background": "black",
+}
+
+
+def make_config(size, extension="png"):
+    """
+    Configuration of a square canvas
+    """
+    return dict(BASE_CONFIG, sizex=size, sizey=size, format=extension)
+
+
+def time_call(function, repeat):
+    """
+    Runs function repeat times
+    :return:              List of durations in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+    return durations
+
+
+def result(name, size, durations, extension=None, operations=1):
+    """
+    Benchmark record. operations is the number of calls timed by every
+    duration, used to report a throughput
+    """
+    best = min(durations)
+    return {
+        "name": name,
+        "size": size,
+        "format": extension,
+        "repeat": len(durations),
+        "min": best,
+        "median": median(durations),
+        "ops_per_second": operations / best if best else None,
+    }
+
+
+def supported_formats(formats):
+    """
+    Formats Pillow can write in this environment
+    """
+    from PIL import Image
+    from PIL.features import check
+
+    Image.init()
+    extensions = Image.registered_extensions()
+    supported = []
+    for extension in formats:
+        if "." + extension not in extensions:
+            log.warning("Format {} is not supported, skipped".format(
+                extension))
+        elif extension == "webp" and not check("webp"):
+            log.warning("Pillow was built without WebP, skipped")
+        else:
+            supported.append(extension)
+    return supported
+
+
+def bench_size(size, formats, repeat, directory):
+    """
+    Every benchmark of a canvas size
+    """
+    from argparse import Namespace
+    from .main import ImcrPrinter, micros_imcr_main
+
+    config = make_config(size)
+    results = []
+
+    results.append(result(
+        "construct", size,
+        time_call(lambda: ImcrPrinter(config), repeat)))
+
+    printer = ImcrPrinter(config)
+    results.append(result(
+        "restart_image", size,
+        time_call(printer.restart_image, repeat)))
+
+    rng = random.Random(size)
+    lines = [
+        (rng.randrange(size), rng.randrange(size),
+         rng.randrange(size), rng.randrange(size), rng.randrange(4))
+        for _ in range(PRIMITIVES_PER_RUN)]
+
+    def draw_lines():
+        for x0, y0, x1, y1, color in lines:
+            printer.draw_line(x0, y0, x1, y1, color)
+
+    results.append(result(
+        "draw_line", size, time_call(draw_lines, repeat),
+        operations=PRIMITIVES_PER_RUN))
+
+    arcs = []
+    for _ in range(PRIMITIVES_PER_RUN):
+        x0, y0 = rng.randrange(size // 2), rng.randrange(size // 2)
+        arcs.append((x0, y0, x0 + rng.randrange(1, size // 2),
+                     y0 + rng.randrange(1, size // 2),
+                     rng.choice((0, 90, 180, 270)),
+                     rng.choice((90, 180, 270, 360)), rng.randrange(4)))
+
+    def draw_arcs():
+        for x0, y0, x1, y1, start, end, color in arcs:
+            printer.draw_arc(x0, y0, x1, y1, start, end, color)
+
+    results.append(result(
+        "draw_arc", size, time_call(draw_arcs, repeat),
+        operations=PRIMITIVES_PER_RUN))
+
+    for extension in formats:
+        format_printer = ImcrPrinter(make_config(size, extension))
+        format_printer.draw_line(0, 0, size - 1, size - 1, 0)
+        root_name = join(directory, "bench")
+        results.append(result(
+            "save_image", size,
+            time_call(lambda: format_printer.save_image(root_name), repeat),
+            extension=extension))
+
+    json_path = join(directory, "bench_{}.json".format(size))
+    with open(json_path, "w") as json_file:
+        json_file.write(dumps(config))
+    args = Namespace(path_to_json=json_path, output_dir=directory)
+
+    # The scene seeds come from the global generator
+    random.seed(size)
+    results.append(result(
+        "micros_imcr_main", size,
+        time_call(lambda: micros_imcr_main(args), repeat)))
+
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, formats=DEFAULT_FORMATS, repeat=3):
+    """
+    Runs the benchmark matrix
+    :return:              Dictionary with "meta" and "results"
+    """
+    from PIL import __version__ as pillow_version
+
+    formats = supported_formats(formats)
+    directory = mkdtemp(prefix="micros_imcr_bench_")
+    results = []
+    try:
+        for size in sizes:
+            log.info("Benchmarking {0}x{0}".format(size))
+            results.extend(bench_size(size, formats, repeat, directory))
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+    return {
+        "meta": {
+            "micros_imcr": __version__,
+            "pillow": pillow_version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def import_time(module):
+    """
+    Imports a module in a new interpreter with -X importtime
+    :return:              (seconds spent importing the micros_imcr modules,
+                           list of LAZY_PACKAGES that were imported)
+    """
+    environment = dict(os.environ)
+    package_root = dirname(dirname(abspath(__file__)))
+    environment["PYTHONPATH"] = os.pathsep.join(
+        path for path in (package_root, environment.get("PYTHONPATH"))
+        if path)
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, env=environment)
+    if process.returncode:
+        raise RuntimeError("Importing {} failed:\n{}".format(
+            module, process.stderr))
+
+    # Lines are "import time: self | cumulative | name", nested imports
+    # are indented under the module importing them
+    microseconds = 0
+    loaded = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        top_level = not name[1:].startswith(" ")
+        name = name.strip()
+        if top_level and name.split(".")[0] == "micros_imcr":
+            microseconds += int(cumulative)
+        if name in LAZY_PACKAGES and name not in loaded:
+            loaded.append(name)
+
+    return microseconds / 1e6, loaded
+
+
+def run_import_benchmarks(modules=IMPORT_MODULES, repeat=5):
+    """
+    Import time of every module, in a new interpreter every time
+    :return:              Dictionary with "meta" and "results"
+    """
+    results = []
+    for module in modules:
+        durations = []
+        loaded = []
+        for _ in range(repeat):
+            seconds, loaded = import_time(module)
+            durations.append(seconds)
+        record = result("import", None, durations, extension=module)
+        record["lazy_packages_loaded"] = loaded
+        results.append(record)
+
+    return {
+        "meta": {
+            "micros_imcr": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def result_key(record):
+    return (record["name"], record["size"], record["format"])
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares the min time of every benchmark present in both runs
+    :param threshold:     Relative slowdown flagged as a regression
+    :return:              List of (key, baseline, current, ratio, regressed)
+    """
+    stored = dict(
+        (result_key(record), record) for record in baseline["results"])
+
+    rows = []
+    for record in current["results"]:
+        key = result_key(record)
+        if key not in stored:
+            continue
+        before, after = stored[key]["min"], record["min"]
+        ratio = after / before if before else float("inf")
+        rows.append((key, before, after, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def format_comparison(rows):
+    """
+    Human readable table of compare_results
+    """
+    lines = ["{:<18} {:>6} {:<22} {:>12} {:>12} {:>7}".format(
+        "benchmark", "size", "fmt/module", "baseline s", "current s",
+        "ratio")]
+    for (name, size, extension), before, after, ratio, regressed in rows:
+        lines.append(
+            "{:<18} {:>6} {:<22} {:>12.6f} {:>12.6f} {:>6.2f}x{}".format(
+                name, "-" if size is None else size, extension or "-",
+                before, after, ratio, "  REGRESSION" if regressed else ""))
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    """
+    Argument parsing of the benchmark script
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='micros_imcr benchmark suite')
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count',
+        default=0,
+        help='Increase verbosity level',
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help='Run the benchmarks')
+    run.add_argument(
+        '-o', '--output',
+        default='bench_results.json',
+        help='JSON file receiving the results',
+    )
+    run.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=list(DEFAULT_SIZES),
+        help='Square canvas sizes to benchmark',
+    )
+    run.add_argument(
+        '--formats',
+        nargs='+',
+        default=list(DEFAULT_FORMATS),
+        help='Output formats benchmarked by save_image',
+    )
+    run.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Runs of every benchmark, the fastest one is kept',
+    )
+
+    imports = commands.add_parser(
+        'imports', help='Measure the import time of the package modules')
+    imports.add_argument(
+        '-o', '--output',
+        default='bench_imports.json',
+        help='JSON file receiving the results',
+    )
+    imports.add_argument(
+        '--modules',
+        nargs='+',
+        default=list(IMPORT_MODULES),
+        help='Modules to import',
+    )
+    imports.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Imports of every module, the fastest one is kept',
+    )
+
+    compare = commands.add_parser(
+        'compare', help='Flag regressions against a baseline')
+    compare.add_argument('baseline', help='Baseline results JSON file')
+    compare.add_argument('current', help='Current results JSON file')
+    compare.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='Relative slowdown considered a regression. Defaults to 0.1',
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the benchmark script
+    :return:              Exit code, 1 when compare finds a regression or
+                          a module imports Pillow or NumPy
+    """
+    import logging
+    from .args import FORMAT, V_LEVELS
+
+    args = parse_args(argv)
+    logging.basicConfig(
+        format=FORMAT, level=V_LEVELS.get(args.verbose, logging.DEBUG))
+
+    if args.command == 'run':
+        results = run_benchmarks(args.sizes, args.formats, args.repeat)
+        with open(args.output, 'w') as output:
+            output.write(dumps(results, indent=2, sort_keys=True))
+        print("Wrote {} results to {}".format(
+            len(results["results"]), args.output))
+        return 0
+
+    if args.command == 'imports':
+        results = run_import_benchmarks(args.modules, args.repeat)
+        with open(args.output, 'w') as output:
+            output.write(dumps(results, indent=2, sort_keys=True))
+
+        eager = 0
+        for record in results["results"]:
+            print("{:<24} {:8.2f} ms{}".format(
+                record["format"], record["min"] * 1000,
+                "  loads " + ", ".join(record["lazy_packages_loaded"])
+                if record["lazy_packages_loaded"] else ""))
+            eager += bool(record["lazy_packages_loaded"])
+        return 1 if eager else 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = loads(baseline_file.read())
+    with open(args.current) as current_file:
+        current = loads(current_file.read())
+
+    rows = compare_results(baseline, current, args.threshold)
+    print(format_comparison(rows))
+    regressions = sum(1 for row in rows if row[4])
+    print("{} of {} benchmarks regressed".format(regressions, len(rows)))
+    return 1 if regressions else 0
+
+
+__all__ = [
+    'run_benchmarks', 'run_import_benchmarks', 'compare_results', 'main']
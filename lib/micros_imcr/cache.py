@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-addressed render cache.
+
+A rendered file is stored under the hash of everything that decides its
+bytes: the resolved primitive list with its colors, canvas size,
+background, format and encoder settings. A cache hit is copied into
+place instead of drawing and encoding the image again. Entries are never
+linked to output files, so writing over an output can not change them.
+"""
+
+import random
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps, loads
+from logging import getLogger
+from os import listdir, makedirs, remove, replace, stat, utime
+from os.path import exists, isdir, join
+from shutil import copyfile
+from threading import Lock
+
+from . import __version__
+from .scenes import resolve_colors
+
+log = getLogger(__name__)
+
+
+# JSON keys, besides the drawing itself, that change the encoded bytes.
+# The backends draw the same pixels, but some of them encode differently,
+# the sparse one streaming its PNG rows for one
+ENCODER_KEYS = (
+    "format", "band_height", "encoder", "target_size", "pixel_format",
+    "canvas_mode", "backend")
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def render_key(json_data, plan, seed):
+    """
+    Hash of everything that decides the bytes a plan renders to
+    :param json_data:     Is the json data in dictionary format
+    :param plan:          DrawPlan of the scene
+    :param seed:          Seed of the scene's random colors
+    """
+    colors = [
+        json_data["color1"], json_data["color2"],
+        json_data["color3"], json_data["color4"]]
+    indexes = resolve_colors(plan, random.Random(seed), len(colors))
+
+    primitives = [
+        [op.kind, list(op.xy), op.start, op.end, list(colors[index][:3])]
+        for op, index in zip(plan.ops, indexes)]
+
+    encoder = dict((key, json_data.get(key)) for key in ENCODER_KEYS)
+    encoder["backend"] = encoder["backend"] or "pillow"
+    description = {
+        "version": __version__,
+        "size": [plan.sizex, plan.sizey],
+        "background": json_data["background"],
+        "primitives": primitives,
+        "encoder": encoder,
+    }
+    if json_data["format"].lower() == "h":
+        # C headers name their array after the scene
+        description["name"] = plan.name
+    if json_data.get("canvas_mode") == "P":
+        # Indexed files store the whole palette, the unused colors too
+        description["palette"] = [list(color[:3]) for color in colors]
+    return sha256(
+        dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    On-disk cache of rendered files with LRU eviction
+
+    :directory:    Directory holding the cached files
+    :max_bytes:    Size limit of the cache. The least recently used files
+                   are evicted when a new file goes over it
+    :hits:         Number of files served from the cache
+    :misses:       Number of files that had to be rendered
+    :evictions:    Number of files removed to honor max_bytes
+    """
+    STATS_FILE = "stats.json"
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        if not isdir(directory):
+            makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = Lock()
+        # name -> size, least recently used first, loaded on first use
+        self.__index = None
+        self.__total = 0
+
+    def key(self, json_data, plan, seed):
+        """
+        Hash identifying the file a plan renders to, see render_key
+        """
+        return render_key(json_data, plan, seed)
+
+    def fetch(self, key, path):
+        """
+        Places the cached file of key at path
+        :return:              True on a hit
+        """
+        entry = join(self.directory, key)
+        with self.__lock:
+            index = self.__load()
+            if key in index and not exists(entry):
+                # Removed by another process sharing the directory
+                self.__total -= index.pop(key)
+            if key not in index:
+                self.misses += 1
+                return False
+            self.hits += 1
+            index.move_to_end(key)
+
+        # The modification time keeps the LRU order for later runs
+        try:
+            utime(entry, None)
+            copyfile(entry, path)
+        except FileNotFoundError:
+            # Evicted since the check above, the scene is rendered again
+            with self.__lock:
+                if key in self.__index and not exists(entry):
+                    self.__total -= self.__index.pop(key)
+                self.hits -= 1
+                self.misses += 1
+            return False
+        return True
+
+    def store(self, key, path):
+        """
+        Adds a rendered file to the cache and evicts old entries
+        """
+        entry = join(self.directory, key)
+        temporary = "{}.tmp".format(entry)
+        copyfile(path, temporary)
+        size = stat(temporary).st_size
+        replace(temporary, entry)
+        with self.__lock:
+            index = self.__load()
+            self.__total += size - index.pop(key, 0)
+            index[key] = size
+        if self.__total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries over max_bytes
+        """
+        with self.__lock:
+            index = self.__load()
+            while self.__total > self.max_bytes and index:
+                name, size = index.popitem(last=False)
+                self.__total -= size
+                try:
+                    remove(join(self.directory, name))
+                except OSError:
+                    continue
+                self.evictions += 1
+
+    def __load(self):
+        """
+        The LRU index, read from the directory the first time. Callers hold
+        the lock
+        """
+        if self.__index is None:
+            entries = []
+            for name in listdir(self.directory):
+                if name == self.STATS_FILE or name.endswith(".tmp"):
+                    continue
+                info = stat(join(self.directory, name))
+                entries.append((info.st_mtime, name, info.st_size))
+            self.__index = OrderedDict(
+                (name, size) for _, name, size in sorted(entries))
+            self.__total = sum(self.__index.values())
+        return self.__index
+
+    def stats(self):
+        """
+        Statistics of this cache object plus the entries it holds
+        """
+        with self.__lock:
+            index = self.__load()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(index),
+                "bytes": self.__total,
+            }
+
+    def save_stats(self):
+        """
+        Adds the counters of this object to the totals kept in the cache
+        directory and returns the updated totals
+        """
+        path = join(self.directory, self.STATS_FILE)
+        totals = {"hits": 0, "misses": 0, "evictions": 0}
+        if exists(path):
+            with open(path) as stats_file:
+                totals.update(loads(stats_file.read()))
+
+        for name in totals:
+            totals[name] += getattr(self, name)
+
+        with open(path, "w") as stats_file:
+            stats_file.write(dumps(totals, sort_keys=True))
+        return totals
+
+
+def format_stats(stats):
+    """
+    Human readable report of RenderCache.stats
+    """
+    lookups = max(stats["hits"] + stats["misses"], 1)
+    return (
+        "Cache: {} hits, {} misses ({:.0%} hit rate), {} evictions,"
+        " {} entries, {:.1f} MB".format(
+            stats["hits"], stats["misses"], stats["hits"] / lookups,
+            stats["evictions"], stats["entries"],
+            stats["bytes"] / (1024 * 1024)))
+
+
+__all__ = ['RenderCache', 'render_key', 'format_stats']
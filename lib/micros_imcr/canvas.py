@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Canvas allocation module.
+
+Keeps a pristine background template per (mode, size, background) and a
+small pool of released canvases, so a new drawing is reset by copying the
+template over an already allocated buffer instead of allocating a fresh
+image and resolving the background color again.
+
+Palette ("P") canvases use the palette as their background: index 0 is the
+background color and the drawing colors follow, see indexed_palette.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+def canvas_key(mode, size, background):
+    """
+    Hashable key of a canvas kind. JSON colors given as lists become tuples
+    """
+    if isinstance(background, list):
+        background = tuple(background)
+    return (mode, tuple(size), background)
+
+
+def indexed_palette(background, colors):
+    """
+    Palette of an indexed canvas
+    :param background:    Background color, a color name or an RGB list
+    :param colors:        RGB colors drawn with indexes 1, 2...
+    :return:              Flat tuple of r, g, b values, the background first
+    """
+    if isinstance(background, str):
+        from PIL import ImageColor
+
+        background = ImageColor.getrgb(background)
+
+    palette = []
+    for color in [background] + list(colors):
+        palette.extend(int(value) for value in color[:3])
+    return tuple(palette)
+
+
+class CanvasPool:
+    """
+    Pool of reusable canvases shared across printers
+
+    :max_canvases: Maximum number of released canvases kept by the pool.
+                   The least recently used sizes are dropped first
+    """
+    def __init__(self, max_canvases=4):
+        self.max_canvases = max_canvases
+        self.__templates = OrderedDict()
+        self.__free = OrderedDict()
+        self.__lock = Lock()
+
+    def template(self, mode, size, background):
+        """
+        Returns the background template of a canvas kind. The template must
+        not be drawn on. The background of a "P" canvas is its palette
+        """
+        key = canvas_key(mode, size, background)
+        with self.__lock:
+            template = self.__templates.get(key)
+            if template is None:
+                from PIL import Image
+
+                if mode == "P":
+                    template = Image.new(mode=mode, size=key[1], color=0)
+                    template.putpalette(key[2])
+                else:
+                    template = Image.new(
+                        mode=mode, size=key[1], color=key[2])
+                self.__templates[key] = template
+            self.__templates.move_to_end(key)
+            return template
+
+    def acquire(self, mode, size, background):
+        """
+        Returns a canvas filled with the background color
+        """
+        template = self.template(mode, size, background)
+        key = canvas_key(mode, size, background)
+        with self.__lock:
+            free = self.__free.get(key)
+            canvas = free.pop() if free else None
+
+        if canvas is None:
+            return template.copy()
+
+        canvas.paste(template)
+        return canvas
+
+    def release(self, canvas, background):
+        """
+        Gives back a canvas that is no longer used
+        :param canvas:        Image returned by acquire
+        :param background:    Background used to acquire it
+        """
+        key = canvas_key(canvas.mode, canvas.size, background)
+        with self.__lock:
+            self.__free.setdefault(key, []).append(canvas)
+            self.__free.move_to_end(key)
+            self.__trim()
+
+    def clear(self):
+        """
+        Drops every template and released canvas
+        """
+        with self.__lock:
+            self.__templates.clear()
+            self.__free.clear()
+
+    def __trim(self):
+        """
+        Drops the least recently used canvases over max_canvases together
+        with the templates nobody is using
+        """
+        count = sum(len(free) for free in self.__free.values())
+        while count > self.max_canvases:
+            key, free = next(iter(self.__free.items()))
+            free.pop(0)
+            count -= 1
+            if not free:
+                del self.__free[key]
+
+        while len(self.__templates) > max(self.max_canvases, 1):
+            key = next(iter(self.__templates))
+            del self.__templates[key]
+            self.__free.pop(key, None)
+
+
+# Pool shared by every printer of the process
+default_pool = CanvasPool()
+
+
+__all__ = ['CanvasPool', 'default_pool', 'indexed_palette']
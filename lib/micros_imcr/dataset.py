@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Dataset generation into sharded archives.
+
+Every scene is used as a template for N variants with shuffled colors and
+jittered coordinates. The encoded images are streamed into tar or zip
+shards of bounded size instead of one file each. Next to every shard an
+index in JSON-lines lists each member with its parameters and the offset
+and size of its data, so a reader can seek straight to one image::
+
+    shard-00000.tar
+    shard-00000.index.jsonl
+    manifest.json
+
+Zip members are stored without compression, so the data of every member
+is a contiguous slice of the shard in both formats. manifest.json is only
+written once every image was added, a directory without it holds an
+incomplete dataset.
+"""
+
+import random
+import tarfile
+import zipfile
+from collections import namedtuple
+from io import BytesIO
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, remove
+from os.path import isdir, join
+from time import time
+
+from .main import get_overrides, size_configs, worker_printer
+from .scenes import DrawOp, compile_scene, get_scenes
+from .seeds import SeedSequence, scene_seed
+
+log = getLogger(__name__)
+
+
+SHARD_FORMATS = ("tar", "zip")
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+
+# Parameters of one generated image
+Variant = namedtuple(
+    "Variant", ["scene", "variant", "seed", "colors", "jitter"])
+
+# One entry of a shard index
+IndexEntry = namedtuple(
+    "IndexEntry", ["name", "offset", "size", "params"])
+
+DatasetSummary = namedtuple(
+    "DatasetSummary", ["images", "shards", "bytes", "elapsed"])
+
+
+def make_variant(plan, rng, color_count, jitter):
+    """
+    Returns a plan with its fixed colors permuted and every coordinate
+    moved by up to jitter pixels, kept inside the canvas
+    :param plan:          DrawPlan used as template
+    :param rng:           Random generator of the variant
+    :param color_count:   Size of the color array
+    :param jitter:        Maximum displacement in pixels
+    :return:              (DrawPlan, color permutation)
+    """
+    colors = list(range(color_count))
+    rng.shuffle(colors)
+
+    def move(value, size):
+        if not jitter:
+            return value
+        return min(max(value + rng.randint(-jitter, jitter), 0), size - 1)
+
+    ops = []
+    for op in plan.ops:
+        x0, y0, x1, y1 = op.xy
+        x0, x1 = move(x0, plan.sizex), move(x1, plan.sizex)
+        y0, y1 = move(y0, plan.sizey), move(y1, plan.sizey)
+        # Arcs need the corners of their bounding box in order
+        if op.kind == "arc":
+            x0, x1 = min(x0, x1), max(x0, x1)
+            y0, y1 = min(y0, y1), max(y0, y1)
+
+        color = op.color
+        if isinstance(color, int) and color < color_count:
+            color = colors[color]
+        ops.append(DrawOp(op.kind, (x0, y0, x1, y1), color, op.start, op.end))
+
+    return plan._replace(ops=tuple(ops)), colors
+
+
+def render_variant(json_data, plan, entropy, variant, jitter):
+    """
+    Draws and encodes one variant of a scene
+    :param json_data:     Is the json data in dictionary format
+    :param plan:          DrawPlan used as template
+    :param entropy:       Root seed of the dataset
+    :param variant:       Variant number
+    :param jitter:        Maximum displacement in pixels
+    :return:              (Variant, encoded bytes)
+    """
+    printer = worker_printer(json_data)
+    root = SeedSequence(entropy)
+    node = root.child("scene", plan.name, "variant", variant)
+    variant_plan, colors = make_variant(
+        plan, node.child("layout").random(),
+        printer.get_color_array_size(), jitter)
+
+    seed = scene_seed(root, plan.name, variant)
+    printer.restart_image()
+    printer.reseed(seed)
+    printer.draw_plan(variant_plan)
+
+    params = Variant(plan.name, variant, seed, colors, jitter)
+    return params, printer.encode_image()
+
+
+class TarShardWriter:
+    """
+    Tar archive receiving encoded images
+    """
+    extension = "tar"
+
+    def __init__(self, path):
+        self.path = path
+        self.__tar = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+
+    @property
+    def size(self):
+        return self.__tar.offset
+
+    def add(self, name, data):
+        """
+        Appends a member
+        :return:              Offset of the member data in the archive
+        """
+        # TarInfo keeps a zero mtime so equal images give equal shards
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.__tar.addfile(info, BytesIO(data))
+        # The data is followed by padding up to a whole block
+        blocks = -(-len(data) // tarfile.BLOCKSIZE)
+        return self.__tar.offset - blocks * tarfile.BLOCKSIZE
+
+    def close(self):
+        self.__tar.close()
+
+
+class ZipShardWriter:
+    """
+    Zip archive receiving encoded images, stored without compression
+    """
+    extension = "zip"
+
+    def __init__(self, path):
+        self.path = path
+        self.__fp = open(path, "wb")
+        self.__zip = zipfile.ZipFile(self.__fp, "w", zipfile.ZIP_STORED)
+
+    @property
+    def size(self):
+        return self.__fp.tell()
+
+    def add(self, name, data):
+        """
+        Appends a member
+        :return:              Offset of the member data in the archive
+        """
+        # A fixed date so equal images give equal shards
+        self.__zip.writestr(
+            zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), data)
+        info = self.__zip.getinfo(name)
+        # Fixed local header, file name and extra field precede the data
+        return (info.header_offset + 30 + len(info.filename.encode("utf-8"))
+                + len(info.extra))
+
+    def close(self):
+        self.__zip.close()
+        self.__fp.close()
+
+
+SHARD_WRITERS = {
+    "tar": TarShardWriter,
+    "zip": ZipShardWriter,
+}
+
+
+class ShardedArchive:
+    """
+    Sequence of size bounded shards with one index per shard
+
+    :directory:    Output directory
+    :shard_format: "tar" or "zip"
+    :max_bytes:    A new shard is started when the next member would take
+                   the current one over this size. A single member larger
+                   than max_bytes gets a shard of its own, and the archive
+                   trailer (tar end blocks, zip central directory) comes on
+                   top of the bound
+    :shards:       List of (shard file name, index file name, members)
+    """
+    def __init__(self, directory, shard_format="tar",
+                 max_bytes=DEFAULT_SHARD_BYTES):
+        if shard_format not in SHARD_WRITERS:
+            raise ValueError("Unknown shard format {!r}, expected {}".format(
+                shard_format, " or ".join(SHARD_FORMATS)))
+        if max_bytes < 1:
+            raise ValueError("The shard size must be positive")
+
+        self.directory = directory
+        self.shard_format = shard_format
+        self.max_bytes = max_bytes
+        self.shards = []
+        self.bytes = 0
+        self.__writer = None
+        self.__index = None
+        self.__members = 0
+
+    def add(self, name, data, params):
+        """
+        Writes a member and its index entry
+        :param name:          Member name inside the shard
+        :param data:          Member bytes
+        :param params:        JSON serializable parameters of the member
+        """
+        if (self.__writer is not None and self.__members
+                and self.__writer.size + len(data) > self.max_bytes):
+            self.__close_shard()
+        if self.__writer is None:
+            self.__open_shard()
+
+        offset = self.__writer.add(name, data)
+        entry = IndexEntry(name, offset, len(data), params)
+        self.__index.write(dumps(entry._asdict(), sort_keys=True) + "\n")
+        self.__members += 1
+        self.bytes += len(data)
+
+    def close(self, **metadata):
+        """
+        Closes the last shard and writes manifest.json
+        :param metadata:      Extra JSON serializable keys of the manifest
+        """
+        if self.__writer is not None:
+            self.__close_shard()
+
+        manifest = dict(metadata)
+        manifest.update({
+            "format": self.shard_format,
+            "shards": [
+                {"shard": shard, "index": index, "members": members}
+                for shard, index, members in self.shards],
+        })
+        with open(join(self.directory, "manifest.json"), "w") as fp:
+            fp.write(dumps(manifest, indent=2, sort_keys=True))
+
+    def abort(self):
+        """
+        Closes the last shard after a failure. No manifest is written, and
+        the one of a previous dataset in the directory is removed, as its
+        shards may have been overwritten
+        """
+        try:
+            if self.__writer is not None:
+                self.__close_shard()
+        finally:
+            try:
+                remove(join(self.directory, "manifest.json"))
+            except FileNotFoundError:
+                pass
+
+    def __open_shard(self):
+        stem = "shard-{:05d}".format(len(self.shards))
+        writer_class = SHARD_WRITERS[self.shard_format]
+        shard = "{}.{}".format(stem, writer_class.extension)
+        index = "{}.index.jsonl".format(stem)
+
+        self.__writer = writer_class(join(self.directory, shard))
+        self.__index = open(join(self.directory, index), "w")
+        self.__members = 0
+        self.shards.append((shard, index, 0))
+
+    def __close_shard(self):
+        self.__writer.close()
+        self.__index.close()
+        shard, index, _ = self.shards[-1]
+        self.shards[-1] = (shard, index, self.__members)
+        log.debug("Closed {} with {} members".format(shard, self.__members))
+        self.__writer = None
+        self.__index = None
+
+
+def load_index(path):
+    """
+    Reads a shard index
+    :return:              List of IndexEntry
+    """
+    with open(path) as index_file:
+        return [IndexEntry(**loads(line)) for line in index_file if line]
+
+
+def read_member(shard_path, entry):
+    """
+    Reads the data of one member straight from its offset
+    :param shard_path:    Path of the shard
+    :param entry:         IndexEntry of the member
+    """
+    with open(shard_path, "rb") as shard:
+        shard.seek(entry.offset)
+        return shard.read(entry.size)
+
+
+def generate_dataset(json_data, output_dir=".", variants=1, jitter=0,
+                     shard_format="tar", shard_bytes=DEFAULT_SHARD_BYTES,
+                     jobs=1, scene_files=None, overrides=None):
+    """
+    Renders variants of every scene into sharded archives
+    :param json_data:     Is the json data in dictionary format
+    :param output_dir:    Directory receiving the shards, created when
+                          missing
+    :param variants:      Number of variants per scene
+    :param jitter:        Maximum displacement of every coordinate in pixels
+    :param shard_format:  "tar" or "zip"
+    :param shard_bytes:   Size bound of every shard
+    :param jobs:          Number of worker processes
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :param overrides:     Optional dictionary of JSON keys replacing the
+                          ones in json_data
+    :return:              A DatasetSummary
+    """
+    if overrides:
+        json_data = dict(json_data, **overrides)
+    if variants < 1:
+        raise ValueError("At least one variant per scene is needed")
+    if jitter < 0:
+        raise ValueError("The jitter must not be negative")
+    if size_configs(json_data)[0][0] is not None:
+        raise ValueError(
+            "A dataset has a single size, sizex and sizey must be numbers")
+
+    # Without a seed one is drawn, and kept in the manifest entries
+    entropy = json_data.get("seed")
+    if entropy is None:
+        entropy = random.getrandbits(64)
+
+    plans = [
+        compile_scene(scene, json_data["sizex"], json_data["sizey"])
+        for scene in get_scenes(scene_files)]
+    tasks = [(plan, variant) for plan in plans for variant in range(variants)]
+
+    if not isdir(output_dir):
+        makedirs(output_dir)
+
+    archive = ShardedArchive(output_dir, shard_format, shard_bytes)
+    start = time()
+    pool = None
+    try:
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            pool = ProcessPoolExecutor(max_workers=jobs)
+            results = pool.map(
+                render_variant,
+                *zip(*[(json_data, plan, entropy, variant, jitter)
+                       for plan, variant in tasks]),
+                chunksize=max(1, len(tasks) // (4 * jobs)))
+        else:
+            results = (
+                render_variant(json_data, plan, entropy, variant, jitter)
+                for plan, variant in tasks)
+
+        # Results come in task order, so the shards do not depend on jobs
+        for params, data in results:
+            name = "{}/{:06d}.{}".format(
+                params.scene, params.variant, json_data["format"])
+            member_params = dict(params._asdict(), root_seed=entropy)
+            archive.add(name, data, member_params)
+    except BaseException:
+        archive.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    archive.close(
+        root_seed=entropy, variants=variants, jitter=jitter,
+        scenes=[plan.name for plan in plans])
+
+    return DatasetSummary(
+        len(tasks), len(archive.shards), archive.bytes, time() - start)
+
+
+def micros_imcr_dataset(args):
+    """
+    Dataset call of the IMCR package
+    :return:              Exit code
+    """
+    with open(args.path_to_json) as json_file:
+        json_data = loads(json_file.read())
+
+    summary = generate_dataset(
+        json_data,
+        output_dir=getattr(args, "output_dir", "."),
+        variants=args.dataset,
+        jitter=getattr(args, "jitter", 0),
+        shard_format=getattr(args, "shard_format", "tar"),
+        shard_bytes=getattr(args, "shard_size", 256) * 1024 * 1024,
+        jobs=getattr(args, "jobs", 1) or 1,
+        scene_files=getattr(args, "scene_files", None),
+        overrides=get_overrides(args))
+
+    print("Images: {} in {} shards, {:.1f} MB, {:.2f} s".format(
+        summary.images, summary.shards, summary.bytes / (1024 * 1024),
+        summary.elapsed))
+    return 0
+
+
+__all__ = [
+    'generate_dataset', 'ShardedArchive', 'load_index', 'read_member',
+    'micros_imcr_dataset']
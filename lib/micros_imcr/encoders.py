@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Encoder settings for the "format" key.
+
+The optional "encoder" JSON key is either a profile name or an object with
+a "profile" and Image.save parameters, for example::
+
+    "encoder": {"profile": "fast", "compress_level": 2}
+
+Profiles:
+default:    Pillow defaults
+fast:       Fastest encode for the format
+small:      Smallest output for the format
+auto:       Tries the settings of the format from fastest to slowest and
+            keeps the first one whose output fits in "target_size" bytes
+
+The "bin" and "h" formats write microcontroller framebuffers in the layout
+of the "pixel_format" key, see framebuffer.py. Profiles do not apply to
+them.
+"""
+
+from io import BytesIO
+from logging import getLogger
+from os.path import basename, splitext
+
+log = getLogger(__name__)
+
+
+# Extensions sharing the settings of another one
+ALIASES = {
+    "jpg": "jpeg",
+    "tif": "tiff",
+}
+
+PROFILES = {
+    "png": {
+        "fast": {"compress_level": 1},
+        "small": {"compress_level": 9, "optimize": True},
+    },
+    "webp": {
+        "fast": {"lossless": True, "method": 0},
+        "small": {"lossless": True, "method": 6, "quality": 100},
+    },
+    "jpeg": {
+        "fast": {"quality": 75},
+        "small": {"quality": 75, "optimize": True},
+    },
+    "gif": {
+        "fast": {},
+        "small": {"optimize": True},
+    },
+    "tiff": {
+        "fast": {},
+        "small": {"compression": "tiff_deflate"},
+    },
+}
+
+# Settings tried by the auto profile, fastest first
+AUTO_LADDERS = {
+    "png": [
+        {"compress_level": 0},
+        {"compress_level": 1},
+        {"compress_level": 3},
+        {"compress_level": 6},
+        {"compress_level": 9},
+        {"compress_level": 9, "optimize": True},
+    ],
+    "webp": [
+        {"lossless": True, "method": 0},
+        {"lossless": True, "method": 2},
+        {"lossless": True, "method": 4},
+        {"lossless": True, "method": 6, "quality": 100},
+    ],
+    "jpeg": [
+        {"quality": 95},
+        {"quality": 85},
+        {"quality": 75, "optimize": True},
+    ],
+    "tiff": [
+        {},
+        {"compression": "tiff_lzw"},
+        {"compression": "tiff_deflate"},
+    ],
+}
+
+PROFILE_NAMES = ("default", "fast", "small", "auto")
+
+# Formats saving "P" images as indexed files, the others get RGB
+PALETTE_FORMATS = ("png", "gif", "bmp", "tiff")
+
+
+class EncoderSettings:
+    """
+    Image.save parameters of an output format
+
+    :extension:    File extension, the "format" JSON key
+    :profile:      One of PROFILE_NAMES
+    :options:      Extra Image.save parameters, applied over the profile
+    :target_size:  Output size in bytes the auto profile aims for
+    :pixel_format: Pixel layout of the framebuffer formats
+    :background:   Background color, the unset pixels of mono framebuffers
+    """
+    def __init__(self, extension, profile="default", options=None,
+                 target_size=None, pixel_format=None, background="black"):
+        if profile not in PROFILE_NAMES:
+            raise ValueError(
+                "Unknown encoder profile {!r}, expected one of: {}".format(
+                    profile, ", ".join(PROFILE_NAMES)))
+        if profile == "auto" and not target_size:
+            raise ValueError("The auto encoder profile needs a target_size")
+        if pixel_format is not None:
+            from .framebuffer import PIXEL_FORMATS
+
+            if pixel_format not in PIXEL_FORMATS:
+                raise ValueError(
+                    "Unknown pixel format {!r}, expected one of: {}".format(
+                        pixel_format, ", ".join(PIXEL_FORMATS)))
+
+        self.extension = extension
+        self.format = ALIASES.get(extension.lower(), extension.lower())
+        self.profile = profile
+        self.options = dict(options or {})
+        self.target_size = target_size
+        self.pixel_format = pixel_format
+        self.background = background
+
+    @classmethod
+    def from_json(cls, json_data):
+        """
+        Settings of the "format", "encoder", "target_size" and
+        "pixel_format" JSON keys
+        """
+        encoder = json_data.get("encoder") or {}
+        if isinstance(encoder, str):
+            encoder = {"profile": encoder}
+
+        options = dict(encoder)
+        profile = options.pop("profile", "default")
+        return cls(json_data["format"], profile, options,
+                   json_data.get("target_size"),
+                   json_data.get("pixel_format"),
+                   json_data.get("background", "black"))
+
+    def params(self):
+        """
+        Image.save parameters of a non auto profile
+        """
+        params = dict(PROFILES.get(self.format, {}).get(self.profile, {}))
+        params.update(self.options)
+        return params
+
+    def candidates(self):
+        """
+        Parameter sets tried by the auto profile, fastest first
+        """
+        ladder = AUTO_LADDERS.get(self.format) or [{}]
+        return [dict(params, **self.options) for params in ladder]
+
+    @property
+    def compress_level(self):
+        """
+        zlib level for streamed PNG output
+        """
+        if self.profile == "auto":
+            return self.candidates()[-1].get("compress_level", 9)
+        return self.params().get("compress_level", 6)
+
+    @property
+    def is_framebuffer(self):
+        """
+        True for the microcontroller framebuffer formats
+        """
+        return self.format in ("bin", "h")
+
+    def prepare(self, image):
+        """
+        Returns the image in a mode the format can store. Indexed images
+        are kept as they are by PALETTE_FORMATS and converted to RGB for
+        the rest
+        """
+        if image.mode == "P" and self.format not in PALETTE_FORMATS:
+            return image.convert("RGB")
+        return image
+
+    def encode(self, image, name="image"):
+        """
+        Encodes an image with these settings
+        :param name:          Array name of a C header
+        :return:              The encoded file as bytes
+        """
+        image = self.prepare(image)
+        if self.is_framebuffer:
+            from .framebuffer import DEFAULT_PIXEL_FORMAT, encode_framebuffer
+
+            return encode_framebuffer(
+                image, self.format,
+                self.pixel_format or DEFAULT_PIXEL_FORMAT,
+                self.background, name)
+
+        if self.profile != "auto":
+            buffer = BytesIO()
+            image.save(buffer, format=self.format, **self.params())
+            return buffer.getvalue()
+
+        encoded = None
+        for params in self.candidates():
+            buffer = BytesIO()
+            image.save(buffer, format=self.format, **params)
+            if encoded is None or buffer.tell() < len(encoded):
+                encoded = buffer.getvalue()
+            if buffer.tell() <= self.target_size:
+                log.debug("{} bytes with {}".format(buffer.tell(), params))
+                break
+        else:
+            log.warning("No setting reaches {} bytes, kept {}".format(
+                self.target_size, len(encoded)))
+        return encoded
+
+    def save(self, image, path):
+        """
+        Encodes and writes an image with these settings
+        """
+        if self.profile != "auto" and not self.is_framebuffer:
+            self.prepare(image).save(path, **self.params())
+            return
+
+        encoded = self.encode(image, splitext(basename(path))[0])
+        with open(path, "wb") as output:
+            output.write(encoded)
+
+
+__all__ = [
+    'EncoderSettings', 'PROFILES', 'PROFILE_NAMES', 'PALETTE_FORMATS']
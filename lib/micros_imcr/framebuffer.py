@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microcontroller framebuffer output.
+
+The "bin" format writes the raw framebuffer and the "h" format a C header
+with the framebuffer as a uint8_t array. The "pixel_format" JSON key picks
+the pixel layout:
+
+rgb565le:   16 bits per pixel, RRRRRGGG GGGBBBBB stored little-endian
+rgb565be:   16 bits per pixel, stored big-endian
+rgb332:     8 bits per pixel, RRRGGGBB
+mono:       1 bit per pixel, set where the pixel is not the background,
+            8 pixels per byte with the leftmost one in the most significant
+            bit and every row padded to a whole byte
+
+Every channel is converted with a lookup table over the whole band and the
+bytes are interleaved by Pillow, so there is no per-pixel Python code.
+"""
+
+import re
+from logging import getLogger
+
+from PIL import Image, ImageChops
+
+from .canvas import default_pool
+
+log = getLogger(__name__)
+
+
+FRAMEBUFFER_FORMATS = ("bin", "h")
+PIXEL_FORMATS = ("rgb565le", "rgb565be", "rgb332", "mono")
+DEFAULT_PIXEL_FORMAT = "rgb565le"
+
+# Lookup tables, a value for every 8-bit channel level
+_RGB565_HIGH_R = [(level >> 3) << 3 for level in range(256)]
+_RGB565_HIGH_G = [level >> 5 for level in range(256)]
+_RGB565_LOW_G = [((level >> 2) & 0x07) << 5 for level in range(256)]
+_RGB565_LOW_B = [level >> 3 for level in range(256)]
+_RGB332_R = [(level >> 5) << 5 for level in range(256)]
+_RGB332_G = [(level >> 5) << 2 for level in range(256)]
+_RGB332_B = [level >> 6 for level in range(256)]
+_MONO = [0] + [255] * 255
+
+_HEX = ["0x{:02x},".format(value) for value in range(256)]
+
+
+def _combine(*bands):
+    """
+    Sum of bands whose bits do not overlap, so the sum is a bitwise or
+    """
+    result = bands[0]
+    for band in bands[1:]:
+        result = ImageChops.add(result, band)
+    return result
+
+
+def to_framebuffer(image, pixel_format=DEFAULT_PIXEL_FORMAT,
+                   background="black"):
+    """
+    Converts an image to a framebuffer
+    :param image:         PIL image
+    :param pixel_format:  One of PIXEL_FORMATS
+    :param background:    Background color, the unset pixels of mono
+    :return:              Framebuffer bytes, row after row
+    """
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError(
+            "Unknown pixel format {!r}, expected one of: {}".format(
+                pixel_format, ", ".join(PIXEL_FORMATS)))
+
+    image = image.convert("RGB")
+    if pixel_format == "mono":
+        template = default_pool.template("RGB", image.size, background)
+        red, green, blue = ImageChops.difference(image, template).split()
+        difference = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+        return difference.point(_MONO, "1").tobytes()
+
+    red, green, blue = image.split()
+    if pixel_format == "rgb332":
+        return _combine(
+            red.point(_RGB332_R), green.point(_RGB332_G),
+            blue.point(_RGB332_B)).tobytes()
+
+    high = _combine(red.point(_RGB565_HIGH_R), green.point(_RGB565_HIGH_G))
+    low = _combine(green.point(_RGB565_LOW_G), blue.point(_RGB565_LOW_B))
+    if pixel_format == "rgb565le":
+        return Image.merge("LA", (low, high)).tobytes()
+    return Image.merge("LA", (high, low)).tobytes()
+
+
+def c_identifier(name):
+    """
+    Valid C identifier made from a file or scene name
+    """
+    identifier = re.sub(r"\W", "_", name)
+    if not identifier or identifier[0].isdigit():
+        identifier = "_" + identifier
+    return identifier
+
+
+def to_c_header(data, name, width, height, pixel_format):
+    """
+    C header declaring a framebuffer as a uint8_t array
+    :param data:          Framebuffer bytes
+    :param name:          Name of the array
+    :param width:         Width in pixels
+    :param height:        Height in pixels
+    :param pixel_format:  One of PIXEL_FORMATS
+    :return:              Header text
+    """
+    identifier = c_identifier(name)
+    macro = identifier.upper()
+    lines = [
+        "/* {}: {}x{} {} framebuffer, {} bytes */".format(
+            name, width, height, pixel_format, len(data)),
+        "#ifndef {}_H".format(macro),
+        "#define {}_H".format(macro),
+        "",
+        "#include <stdint.h>",
+        "",
+        "#define {}_WIDTH {}".format(macro, width),
+        "#define {}_HEIGHT {}".format(macro, height),
+        "",
+        "static const uint8_t {}[{}] = {{".format(identifier, len(data)),
+    ]
+    for start in range(0, len(data), 16):
+        lines.append("    " + " ".join(
+            map(_HEX.__getitem__, data[start:start + 16])))
+    lines.extend(["};", "", "#endif /* {}_H */".format(macro), ""])
+    return "\n".join(lines)
+
+
+def encode_framebuffer(image, extension, pixel_format=DEFAULT_PIXEL_FORMAT,
+                       background="black", name="framebuffer"):
+    """
+    Encodes an image as a "bin" or "h" file
+    :param name:          Array name of a C header
+    :return:              File contents as bytes
+    """
+    data = to_framebuffer(image, pixel_format, background)
+    if extension == "bin":
+        return data
+    width, height = image.size
+    return to_c_header(
+        data, name, width, height, pixel_format).encode("ascii")
+
+
+__all__ = [
+    'to_framebuffer', 'to_c_header', 'encode_framebuffer',
+    'FRAMEBUFFER_FORMATS', 'PIXEL_FORMATS']
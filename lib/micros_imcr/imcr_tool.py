@@ -14,7 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from micros_imcr.main import micros_imcr_main
+from collections import deque
+from json import loads
 from os.path import exists, isfile
 
 
@@ -24,8 +25,36 @@ class MicrosImcrData():
     micros_imcr_main from main
 
     :path_to_json: String that contains the path to the JSON file
+    :jobs:         Number of worker processes used to render the images
+    :scene_files:  List of JSON files with additional scene definitions
+    :output_dir:   Directory where the images are saved
+    :backend:      Rasterization backend overriding the "backend" JSON key
+    :band_height:  Rows per band overriding the "band_height" JSON key
+    :cache_dir:    Render cache directory, None disables the cache
+    :cache_size:   Size limit of the render cache in MB
+    :save_threads: Number of background saving threads, 0 saves
+                   synchronously
+    :metrics:      Path of the metrics file, None disables the metrics
+    :sweep:        Render the cartesian product of the lists of the JSON
+                   file
+    :encoder:      Encoder profile, "default", "fast", "small" or "auto"
+    :encoder_options: Dictionary of Image.save parameters, with encoder
+                   they replace the "encoder" JSON key
+    :target_size:  Output size in bytes of the auto encoder profile
+    :seed:         Root seed overriding the "seed" JSON key
+    :pixel_format: Framebuffer pixel layout overriding the "pixel_format"
+                   JSON key
+    :canvas_mode:  Canvas mode, "RGB" or "P", overriding the "canvas_mode"
+                   JSON key
+    :max_memory:   Memory budget of the images rendered at once in MB,
+                   None for no budget
     """
-    def __init__(self, file_path):
+    def __init__(self, file_path, jobs=1, scene_files=None, output_dir=".",
+                 backend=None, band_height=None, cache_dir=None,
+                 cache_size=None, save_threads=0, metrics=None, sweep=False,
+                 encoder=None, encoder_options=None, target_size=None,
+                 seed=None, pixel_format=None, canvas_mode=None,
+                 max_memory=None):
 
         # Check that the path_to_json ends up in a existing file
         if exists(file_path):
@@ -37,19 +66,158 @@ class MicrosImcrData():
             raise TypeError(
                 'Wrong path parameter: File not found'
             )
+        if jobs < 1:
+            raise ValueError(
+                'Wrong jobs parameter: It must be a positive integer'
+            )
         self.path_to_json = file_path
+        self.jobs = jobs
+        self.scene_files = list(scene_files or [])
+        self.output_dir = output_dir
+        self.backend = backend
+        self.band_height = band_height
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.save_threads = save_threads
+        self.metrics = metrics
+        self.sweep = sweep
+        self.encoder = encoder
+        self.encoder_options = dict(encoder_options or {})
+        self.target_size = target_size
+        self.seed = seed
+        self.pixel_format = pixel_format
+        self.canvas_mode = canvas_mode
+        self.max_memory = max_memory
 
 
-def micros_imcr_tool(path_to_json):
+def micros_imcr_tool(path_to_json, jobs=1, scene_files=None, output_dir=".",
+                     backend=None, band_height=None, cache_dir=None,
+                     cache_size=None, save_threads=0, metrics=None,
+                     sweep=False, encoder=None, encoder_options=None,
+                     target_size=None, seed=None, pixel_format=None,
+                     canvas_mode=None, max_memory=None):
     """
     Main call of the IMCR package via a tool
     Takes a path to a JSON file and creates a set of default images
 
     :param path_to_json: Relative path to the data.json file
+    :param jobs:         Number of worker processes used to render the images
+    :param scene_files:  List of JSON files with additional scene definitions
+    :param output_dir:   Directory where the images are saved
+    :param backend:      Rasterization backend: "pillow", "numpy", "sparse" or
+                         "mmap"
+    :param band_height:  Render png/ppm files in bands of this many rows
+    :param cache_dir:    Render cache directory, unchanged images are taken
+                         from it
+    :param cache_size:   Size limit of the render cache in MB
+    :param save_threads: Number of threads saving the images in the
+                         background while the next one is drawn
+    :param metrics:      Write per-scene metrics to this file, in Prometheus
+                         text format for .prom files and JSON otherwise
+    :param sweep:        Render every combination of the lists of the JSON
+                         file, each one in its own directory
+    :param encoder:      Encoder profile: "default", "fast", "small" or
+                         "auto"
+    :param encoder_options: Dictionary of Image.save parameters such as
+                         {"compress_level": 1}
+    :param target_size:  Output size in bytes the auto profile aims for,
+                         overrides the "target_size" JSON key
+    :param seed:         Root seed of the random colors, overrides the
+                         "seed" JSON key
+    :param pixel_format: Pixel layout of the "bin" and "h" framebuffer
+                         formats, overrides the "pixel_format" JSON key
+    :param canvas_mode:  "RGB" or "P" for an indexed canvas, overrides the
+                         "canvas_mode" JSON key
+    :param max_memory:   Memory budget of the images rendered at once in MB
     """
 
+    # The rendering modules are only imported when a tool is called
+    from micros_imcr.main import micros_imcr_main
+
     # Initialize a MicrosImcrData class with the required filepath
-    args = MicrosImcrData(path_to_json)
+    args = MicrosImcrData(
+        path_to_json, jobs, scene_files, output_dir, backend, band_height,
+        cache_dir, cache_size, save_threads, metrics, sweep, encoder,
+        encoder_options, target_size, seed, pixel_format, canvas_mode,
+        max_memory)
 
     # Call the micros_imcr_main method
     micros_imcr_main(args)
+
+
+def micros_imcr_images(config, output="pil", jobs=1, scene_files=None,
+                       **overrides):
+    """
+    Generator rendering every scene in memory, nothing is written to disk.
+    Each pair is yielded as soon as its drawing is finished, so the first
+    image can be used while the rest are rendered
+
+    :param config:       JSON data in dictionary format or path to a JSON
+                         file
+    :param output:       "pil" for PIL images, "bytes" for the images encoded
+                         in the configured format or "numpy" for
+                         (sizey, sizex, 3) arrays
+    :param jobs:         Number of worker processes rendering ahead, at
+                         most 2 * jobs scenes ahead of the consumer
+    :param scene_files:  List of JSON files with additional scene definitions
+    :param overrides:    JSON keys replacing the ones of the configuration,
+                         for example seed=3
+    :return:             Iterator of (scene_name, image) in scene order.
+                         With lists of sizes every scene is yielded for
+                         each size, named "WxH/scene_name"
+    """
+    from micros_imcr.main import get_seeds, render_image, size_configs
+    from micros_imcr.scenes import compile_scene, get_scenes
+
+    if isinstance(config, dict):
+        json_data = dict(config)
+    else:
+        with open(config) as json_file:
+            json_data = loads(json_file.read())
+    json_data.update(overrides)
+
+    configs = size_configs(json_data)
+    scenes = get_scenes(scene_files)
+    size_plans = [
+        [compile_scene(scene, size_data["sizex"], size_data["sizey"])
+         for scene in scenes]
+        for _, size_data in configs]
+    seeds = get_seeds(json_data, size_plans[0])
+
+    # With several sizes the names are "WxH/scene"
+    tasks = []
+    for index, seed in enumerate(seeds):
+        for (subdir, size_data), plans in zip(configs, size_plans):
+            plan = plans[index]
+            name = plan.name if subdir is None else "{}/{}".format(
+                subdir, plan.name)
+            tasks.append((name, size_data, plan, seed))
+
+    if jobs <= 1:
+        for name, size_data, plan, seed in tasks:
+            yield name, render_image(size_data, plan, seed, output)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Only a window of scenes is rendered ahead of the consumer, so a slow
+    # consumer does not hold every image of the run in memory
+    window = 2 * jobs
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    pending = deque()
+    try:
+        for name, size_data, plan, seed in tasks:
+            pending.append((name, pool.submit(
+                render_image, size_data, plan, seed, output)))
+            if len(pending) >= window:
+                name, future = pending.popleft()
+                yield name, future.result()
+        while pending:
+            name, future = pending.popleft()
+            yield name, future.result()
+    finally:
+        # When the consumer stops early the scenes not started yet are
+        # dropped, the running ones finish in the background
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
@@ -15,20 +15,48 @@
 # limitations under the License.
 
 import random
-from PIL import Image, ImageDraw
-from json import loads
+from collections import OrderedDict
+from io import BytesIO
+from json import dumps, loads
 from logging import getLogger
+from os import makedirs
+from os.path import basename, isdir, join
+from time import perf_counter
+
+from .canvas import default_pool, indexed_palette
+from .encoders import EncoderSettings
+from .metrics import SceneMetrics, peak_rss
+from .seeds import SeedSequence, printer_seed, scene_seed
+from .scenes import DrawOp, compile_scene, get_scenes, resolve_colors
 
 log = getLogger(__name__)
 
 
+# Values of the "canvas_mode" JSON key
+CANVAS_MODES = ("RGB", "P")
+
+
 # IMCR main class
 # This creates and handles any new image
 class ImcrPrinter:
 
-    def __init__(self, json_data):
+    def __init__(self, json_data, seed=None, pool=None, backend=None,
+                 saver=None):
         """
         :param json_data: Is the json data in dictionary format
+        :param seed:      Optional seed for the printer's own random generator.
+                          When None the stream derived from the "seed" JSON
+                          key is used, or else the global random module
+        :param pool:      CanvasPool providing the canvases. Defaults to the
+                          pool shared by the process
+        :param backend:   Rasterization backend, "pillow" or "numpy". Defaults
+                          to the "backend" JSON key or "pillow"
+        :param saver:     Optional AsyncSaver. When given save_image hands the
+                          image to it and goes on with a new canvas
+
+        The "canvas_mode" JSON key picks the canvas: "RGB" (default) or "P",
+        an indexed canvas of one byte per pixel whose palette is the
+        background followed by color1-4
         """
         # Initialize all the private params based on the JSON information
         self.__imcr_color_array = [
@@ -40,12 +68,62 @@ class ImcrPrinter:
         self.__imcr_sizex = json_data["sizex"]
         self.__imcr_sizey = json_data["sizey"]
         self.__imcr_extension = json_data["format"]
+        self.__encoder = EncoderSettings.from_json(json_data)
+        self.__canvas_mode = json_data.get("canvas_mode") or "RGB"
+        if self.__canvas_mode not in CANVAS_MODES:
+            raise ValueError(
+                "Unknown canvas mode {!r}, expected one of: {}".format(
+                    self.__canvas_mode, ", ".join(CANVAS_MODES)))
+        if self.__canvas_mode == "P":
+            # Indexed canvases are drawn with palette indexes, the
+            # background takes index 0
+            self.__palette = list(
+                range(1, len(self.__imcr_color_array) + 1))
+            canvas_background = indexed_palette(
+                self.__background, self.__imcr_color_array)
+        else:
+            self.__palette = [
+                (color[0], color[1], color[2])
+                for color in self.__imcr_color_array]
+            canvas_background = self.__background
+        if seed is None and json_data.get("seed") is not None:
+            seed = printer_seed(SeedSequence(json_data["seed"]))
+        self.reseed(seed)
+        self.saver = saver
+        if backend is None:
+            backend = json_data.get("backend", "pillow")
+
+        # Initialize the image. The backends, and Pillow with them, are
+        # only imported once a printer is needed
+        from .backends import get_backend
+
+        self.__canvas = get_backend(backend)(
+            self.__canvas_mode, (self.__imcr_sizex, self.__imcr_sizey),
+            canvas_background, default_pool if pool is None else pool)
+        # Backends drawing into the output file need its layout
+        if hasattr(self.__canvas, "set_format"):
+            self.__canvas.set_format(self.__encoder)
+
+    @property
+    def current_image(self):
+        """
+        The image being drawn, as a PIL image. Only the pillow backend
+        returns the canvas itself: the other backends build a full copy on
+        every access, so drawing on it does not change the canvas and two
+        accesses return different images
+        """
+        return self.__canvas.image
+
+    @current_image.setter
+    def current_image(self, image):
+        self.__canvas.image = image
 
-        # Initialize the image
-        self.current_image = Image.new(
-            mode="RGB",
-            size=(self.__imcr_sizex, self.__imcr_sizey),
-            color=self.__background)
+    @property
+    def backend(self):
+        """
+        Name of the rasterization backend
+        """
+        return self.__canvas.name
 
     def get_color_array_size(self):
         """
@@ -57,23 +135,107 @@ class ImcrPrinter:
         """
         Return a random valid index for the color_array
         """
-        return random.randrange(len(self.__imcr_color_array))
+        return self.__rng.randrange(len(self.__imcr_color_array))
+
+    def reseed(self, seed):
+        """
+        Replaces the random generator used by get_random_index
+        :param seed:          Seed for a new generator. When None the global
+                              random module is used
+        """
+        self.__rng = random if seed is None else random.Random(seed)
 
     def restart_image(self):
         """
-        Resets the internal parameter current_image
+        Resets the internal parameter current_image. The canvas goes back to
+        the pool and comes out again reset from the background template
         """
-        self.current_image = Image.new(
-            mode="RGB",
-            size=(self.__imcr_sizex, self.__imcr_sizey),
-            color=self.__background)
+        self.__canvas.reset()
+
+    def detach_image(self):
+        """
+        Returns current_image and replaces it with a new canvas, so the
+        returned image is not reused by later drawings
+        """
+        return self.__canvas.detach()
+
+    def open_output(self, file_root_name):
+        """
+        Maps the output file as the canvas when the backend draws into it,
+        see MappedCanvas. The canvas starts over from the background and
+        save_image with the same name only flushes it. Nothing is done for
+        the other backends
+        """
+        if hasattr(self.__canvas, "open"):
+            self.__canvas.open(
+                "{}.{}".format(file_root_name, self.__imcr_extension))
 
     def save_image(self, file_root_name):
         """
-        Saves the internal parameter current_image
+        Saves the internal parameter current_image. With a saver the image
+        is detached and saved in the background, and its canvas is recycled
+        once written
+        """
+        path = "{}.{}".format(file_root_name, self.__imcr_extension)
+        if hasattr(self.__canvas, "save"):
+            # The canvas is the file already, there is nothing to encode
+            self.__canvas.save(path)
+            return
+        if self.__streams():
+            with open(path, "wb") as output:
+                self.__stream(output)
+            return
+        if self.saver is None:
+            self.__encoder.save(self.current_image, path)
+            return
+
+        self.saver.submit(
+            self.detach_image(), path, on_done=self.__canvas.recycle,
+            save=self.__encoder.save)
+
+    def encode_image(self):
+        """
+        Returns current_image encoded in the configured format, as bytes
+        """
+        if hasattr(self.__canvas, "tobytes"):
+            return self.__canvas.tobytes()
+        if self.__streams():
+            output = BytesIO()
+            self.__stream(output)
+            return output.getvalue()
+        return self.__encoder.encode(self.current_image)
+
+    def __streams(self):
+        """
+        True when the canvas is written row by row instead of as a whole
+        image: the backend streams its rows and the format has a row writer
+        """
+        if not hasattr(self.__canvas, "stream"):
+            return False
+
+        from .banded import STREAM_WRITERS
+
+        return (self.__encoder.format in STREAM_WRITERS
+                and self.__encoder.profile != "auto")
+
+    def __stream(self, output):
+        from .banded import open_stream_writer
+
+        writer = open_stream_writer(
+            output, self.__encoder, self.__imcr_sizex, self.__imcr_sizey)
+        self.__canvas.stream(writer)
+        writer.close()
+
+    def get_image_array(self):
+        """
+        Returns a copy of current_image as a (sizey, sizex, 3) numpy array
         """
-        self.current_image.save(
-            "{}.{}".format(file_root_name, self.__imcr_extension))
+        array = getattr(self.__canvas, "array", None)
+        if array is not None:
+            return array.copy()
+
+        import numpy
+        return numpy.array(self.current_image.convert("RGB"))
 
     def draw_line(self, x_start, y_start, x_finish, y_finish, color_index):
         """
@@ -101,16 +263,12 @@ class ImcrPrinter:
         if color_index > len(self.__imcr_color_array):
             log.error("Desired color index goes beyond the color array")
 
-        # Get the desired color
-        # ---------------------
-        current_color = self.__imcr_color_array[color_index]
-
         # Start drawline process
         # ---------------------
-        drawer = ImageDraw.Draw(self.current_image)
-        drawer.line(
-            xy=(x_start, y_start, x_finish, y_finish),
-            fill=(current_color[0], current_color[1], current_color[2]))
+        self.__canvas.draw(
+            [DrawOp("line", (x_start, y_start, x_finish, y_finish),
+                    color_index, None, None)],
+            [color_index], self.__palette)
 
     def draw_arc(self, x_start, y_start, x_finish, y_finish, start_angle,
                  end_angle, color_index):
@@ -141,322 +299,569 @@ class ImcrPrinter:
         if color_index > len(self.__imcr_color_array):
             log.error("Desired color index goes beyond the color array")
 
-        # Get the desired color
-        # ---------------------
-        current_color = self.__imcr_color_array[color_index]
-
         # Start drawline process
         # ---------------------
-        drawer = ImageDraw.Draw(self.current_image)
-        drawer.arc(
-            xy=(x_start, y_start, x_finish, y_finish),
-            start=start_angle,
-            end=end_angle,
-            fill=(current_color[0], current_color[1], current_color[2]))
+        self.__canvas.draw(
+            [DrawOp("arc", (x_start, y_start, x_finish, y_finish),
+                    color_index, start_angle, end_angle)],
+            [color_index], self.__palette)
 
+    def resolve_colors(self, plan):
+        """
+        Returns the color index of every operation of a plan, drawing its
+        random slots from this printer's generator
+        :param plan:          DrawPlan to resolve
+        """
+        return resolve_colors(
+            plan, self.__rng, len(self.__imcr_color_array))
 
-def micros_imcr_main(args):
+    def draw_plan(self, plan):
+        """
+        Draws every operation of a compiled scene in the objects image
+        :param plan:          DrawPlan compiled for this printer's size
+        """
+        if (plan.sizex, plan.sizey) != (self.__imcr_sizex, self.__imcr_sizey):
+            log.error("Plan {} was compiled for another image size".format(
+                plan.name))
+            raise ValueError
+
+        self.__canvas.draw(
+            plan.ops, self.resolve_colors(plan), self.__palette)
+
+
+# Printers owned by a pool worker process, keyed by their JSON data. The
+# least recently used ones are dropped past MAX_WORKER_PRINTERS
+_worker_printers = OrderedDict()
+MAX_WORKER_PRINTERS = 8
+
+# JSON keys that can be overridden with an argument of the same name
+OVERRIDE_KEYS = (
+    "backend", "band_height", "target_size", "seed", "pixel_format",
+    "canvas_mode")
+
+
+def worker_printer(json_data):
     """
-    Main call of the IMCR package
-    Takes a path to a JSON file and creates a set of default images
+    Returns the printer the calling process keeps for a configuration
     """
-    # Obtain the json information
-    # --------------------------------------------------------------------------
-    # Read the file
-    json_file = open(args.path_to_json).read()
-    json_data = loads(json_file)
+    key = dumps(json_data, sort_keys=True)
+    printer = _worker_printers.get(key)
+    if printer is None:
+        printer = ImcrPrinter(json_data)
+        _worker_printers[key] = printer
+        while len(_worker_printers) > MAX_WORKER_PRINTERS:
+            _worker_printers.popitem(last=False)
+    else:
+        _worker_printers.move_to_end(key)
+    return printer
+
+
+def get_overrides(args):
+    """
+    Returns the JSON keys set by the arguments namespace. An encoder
+    profile or encoder options replace the whole "encoder" JSON key
+    """
+    overrides = dict(
+        (key, getattr(args, key)) for key in OVERRIDE_KEYS
+        if getattr(args, key, None) is not None)
 
-    imcr_sizex = json_data["sizex"]
-    imcr_sizey = json_data["sizey"]
+    encoder = dict(getattr(args, "encoder_options", None) or {})
+    if getattr(args, "encoder", None) is not None:
+        encoder["profile"] = args.encoder
+    if encoder:
+        overrides["encoder"] = encoder
+    return overrides
 
-    # Initialize the ImcrPrinter object
-    printer = ImcrPrinter(json_data)
 
-    # Generate the basic images
-    # --------------------------------------------------------------------------
-    # First Drawing: Single vertical Line
-    # ###################################
-    # Starts 1/3 in the y axis and draws 1/3 of the size
-    printer.draw_line(
-        x_start=imcr_sizex//2,
-        y_start=imcr_sizey//3,
-        x_finish=imcr_sizex//2,
-        y_finish=2*imcr_sizey//3,
-        color_index=printer.get_random_index())
-
-    printer.save_image(file_root_name="simple_line")
-
-    # Second Drawing: Multiple lines
-    # ###################################
-    # Restart Image
+def render_scene(json_data, plan, seed, output_dir=".", printer=None,
+                 measure=False):
+    """
+    Draws and saves a single scene
+    :param json_data:     Is the json data in dictionary format
+    :param plan:          DrawPlan of the scene, its name is the file root name
+    :param seed:          Seed for the printer's random generator
+    :param output_dir:    Directory where the image is saved
+    :param printer:       Optional ImcrPrinter to reuse. When None the
+                          calling process keeps its own printer
+    :param measure:       When True every step is timed
+    :return:              The scene name, or its SceneMetrics when measure is
+                          True
+    """
+    root_name = join(output_dir, plan.name)
+
+    # Band rendering never allocates the full canvas
+    if json_data.get("band_height"):
+        from .banded import render_banded
+
+        start = perf_counter()
+        render_banded(
+            json_data, plan, seed, root_name, json_data["band_height"])
+        if not measure:
+            return plan.name
+        # Bands are drawn and encoded together
+        return SceneMetrics(
+            plan.name, len(plan.ops), None, perf_counter() - start, None,
+            None, peak_rss(), False)
+
+    if printer is None:
+        printer = worker_printer(json_data)
+
+    if not measure:
+        # Start every scene from a clean canvas and its own random stream
+        printer.restart_image()
+        printer.open_output(root_name)
+        printer.reseed(seed)
+
+        printer.draw_plan(plan)
+        printer.save_image(file_root_name=root_name)
+        return plan.name
+
+    start = perf_counter()
     printer.restart_image()
+    printer.open_output(root_name)
+    reset = perf_counter()
+    printer.reseed(seed)
+    printer.draw_plan(plan)
+    drawn = perf_counter()
+    printer.save_image(file_root_name=root_name)
+    saved = perf_counter()
 
-    # Adds one horizontal line of each color with no intersections
-    for i in range(printer.get_color_array_size()):
-        printer.draw_line(
-            x_start=imcr_sizex//3,
-            y_start=(i+1)*imcr_sizey//5,
-            x_finish=2*imcr_sizex//3,
-            y_finish=(i+1)*imcr_sizey//5,
-            color_index=i)
+    return SceneMetrics(
+        plan.name, len(plan.ops), reset - start, drawn - reset,
+        saved - drawn, None, peak_rss(), False)
 
-    printer.save_image(file_root_name="multiple_horizontal_line")
 
-    # Third Drawing: Diagonal line
-    # ###################################
-    # Restart Image
-    printer.restart_image()
+IMAGE_OUTPUTS = ("pil", "bytes", "numpy")
 
-    # Adds two diagonal lines of the same color
-    random_color = printer.get_random_index()
-    for i in range(2):
-        printer.draw_line(
-            x_start=imcr_sizex//5,
-            y_start=(i+1)*imcr_sizey//5,
-            x_finish=2*imcr_sizex//5,
-            y_finish=(i+2)*imcr_sizey//5,
-            color_index=random_color)
-
-    printer.save_image(file_root_name="diagonal_lines")
-
-    # Fourth Drawing: Intersection
-    # ###################################
-    # Restart Image
-    printer.restart_image()
 
-    # Diagonal intersection using two random colors
-    # Draw first diagonal
-    random_color = printer.get_random_index()
-    printer.draw_line(
-        x_start=imcr_sizex//3,
-        y_start=imcr_sizey//5,
-        x_finish=2*imcr_sizex//3,
-        y_finish=4*imcr_sizey//5,
-        color_index=random_color)
-
-    # Draw second diagonal
-    second_random_color = random_color
-    while second_random_color == random_color:
-        second_random_color = printer.get_random_index()
-
-    printer.draw_line(
-        x_start=imcr_sizex//3,
-        y_start=4*imcr_sizey//5,
-        x_finish=2*imcr_sizex//3,
-        y_finish=imcr_sizey//5,
-        color_index=second_random_color)
-
-    printer.save_image(file_root_name="diagonal_intersection")
-
-    # Fifth Drawing: Four Line intersection
-    # ###################################
-    # Restart Image
-    printer.restart_image()
+def render_image(json_data, plan, seed, output="pil"):
+    """
+    Draws a single scene in memory
+    :param json_data:     Is the json data in dictionary format
+    :param plan:          DrawPlan of the scene
+    :param seed:          Seed for the printer's random generator
+    :param output:        "pil" for a PIL image, "bytes" for the image
+                          encoded in the configured format or "numpy" for a
+                          (sizey, sizex, 3) array
+    :return:              The image in the requested output
+    """
+    if output not in IMAGE_OUTPUTS:
+        raise ValueError(
+            "Unknown image output {!r}, expected one of: {}".format(
+                output, ", ".join(IMAGE_OUTPUTS)))
 
-    # Creates four lines where there are multiple intersections
-    # Draw first line
-    printer.draw_line(
-        x_start=imcr_sizex//3,
-        y_start=imcr_sizey//5,
-        x_finish=2*imcr_sizex//3,
-        y_finish=4*imcr_sizey//5,
-        color_index=0)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=imcr_sizex//3,
-        y_start=imcr_sizey//4,
-        x_finish=2*imcr_sizex//3,
-        y_finish=imcr_sizey//4,
-        color_index=1)
-
-    # Draw third line
-    printer.draw_line(
-        x_start=imcr_sizex//4,
-        y_start=4*imcr_sizey//5,
-        x_finish=3*imcr_sizex//4,
-        y_finish=3*imcr_sizey//5,
-        color_index=2)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=imcr_sizex//2,
-        y_start=1*imcr_sizey//5,
-        x_finish=imcr_sizex//2,
-        y_finish=4*imcr_sizey//5,
-        color_index=3)
-
-    printer.save_image(file_root_name="full_intersection")
-
-    # Sixth Drawing: Three lines
-    # ###################################
-    # Restart Image
+    printer = worker_printer(json_data)
     printer.restart_image()
+    printer.reseed(seed)
+    printer.draw_plan(plan)
 
-    # Creates three lines with no intersections
-    # Draw first line
-    printer.draw_line(
-        x_start=imcr_sizex//9,
-        y_start=imcr_sizey//5,
-        x_finish=3*imcr_sizex//4,
-        y_finish=imcr_sizey//5,
-        color_index=0)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=4*imcr_sizex//5,
-        y_start=3*imcr_sizey//5,
-        x_finish=4*imcr_sizex//5,
-        y_finish=imcr_sizey,
-        color_index=2)
-
-    # Draw third line
-    printer.draw_line(
-        x_start=imcr_sizex//6,
-        y_start=7*imcr_sizey//8,
-        x_finish=imcr_sizex//3,
-        y_finish=imcr_sizey//6,
-        color_index=3)
-
-    # Save the image
-    printer.save_image(file_root_name="three_line_test")
-
-    # Seventh Drawing: Curve
-    # ################################
-    # Restart Image
-    printer.restart_image()
+    if output == "bytes":
+        return printer.encode_image()
+    if output == "numpy":
+        return printer.get_image_array()
+    # The caller keeps the image, the printer goes on with a new canvas
+    return printer.detach_image()
 
-    # Draw first arc
-    printer.draw_arc(
-        x_start=2*imcr_sizex//7,
-        y_start=imcr_sizey//9,
-        x_finish=5*imcr_sizex//7,
-        y_finish=8*imcr_sizey//9,
-        start_angle=90,
-        end_angle=270,
-        color_index=0)
-
-    # Draw second arc
-    printer.draw_arc(
-        x_start=1*imcr_sizex//7,
-        y_start=imcr_sizey//9,
-        x_finish=3*imcr_sizex//7,
-        y_finish=8*imcr_sizey//9,
-        start_angle=270,
-        end_angle=90,
-        color_index=3)
-
-    # Save the image
-    printer.save_image(file_root_name="curve")
-
-    # Eigth Drawing: Happy face
-    # ################################
-    # Restart Image
-    printer.restart_image()
 
-    # Draw first arc
-    printer.draw_arc(
-        x_start=1*imcr_sizex//7,
-        y_start=5*imcr_sizey//9,
-        x_finish=6*imcr_sizex//7,
-        y_finish=8*imcr_sizey//9,
-        start_angle=0,
-        end_angle=180,
-        color_index=0)
-
-    # Draw first line
-    printer.draw_line(
-        x_start=2*imcr_sizex//5,
-        y_start=imcr_sizey//3,
-        x_finish=2*imcr_sizex//5,
-        y_finish=2*imcr_sizey//3,
-        color_index=1)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=3*imcr_sizex//5,
-        y_start=imcr_sizey//3,
-        x_finish=3*imcr_sizex//5,
-        y_finish=2*imcr_sizey//3,
-        color_index=1)
-
-    # Save the image
-    printer.save_image(file_root_name="happy_face")
-
-    # Ninth Drawing: Sad face
-    # ################################
-    # Restart Image
-    printer.restart_image()
+def render_config(json_data, output_dir=".", jobs=1, scene_files=None,
+                  executor=None, overrides=None, cache=None, save_threads=0,
+                  metrics=None, scene_names=None, max_memory=None):
+    """
+    Renders every scene of a configuration
+
+    When "sizex" or "sizey" is a list the scenes are parsed and seeded
+    once, then every scene is drawn for each size, in its own "WxH"
+    subdirectory of output_dir. The sizes of a scene are independent jobs,
+    so a pool renders them in parallel
+    :param json_data:     Is the json data in dictionary format
+    :param output_dir:    Directory where the images are saved, created when
+                          missing
+    :param jobs:          Number of worker processes
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :param executor:      Optional running executor to submit the scenes to,
+                          used instead of creating a pool of jobs processes
+    :param overrides:     Optional dictionary of JSON keys replacing the
+                          ones in json_data
+    :param cache:         Optional RenderCache. Cached scenes are placed
+                          from the cache instead of being rendered
+    :param save_threads:  Number of background threads encoding and saving
+                          the images while the next scene is drawn. Only
+                          used by serial runs, 0 saves synchronously
+    :param metrics:       Optional MetricsRecorder receiving the
+                          SceneMetrics of every scene
+    :param scene_names:   Optional names of the scenes to render, every
+                          scene by default. The seeds are the same as in a
+                          full run
+    :param max_memory:    Optional memory budget in bytes. A scene whose
+                          estimated memory is over it fails the whole call
+                          before anything is rendered, and a pool only runs
+                          as many scenes at once as fit in it
+    :return:              Number of images written
+    """
+    if overrides:
+        json_data = dict(json_data, **overrides)
+
+    if executor is not None or jobs > 1:
+        budget = None
+        if max_memory is not None:
+            from .planner import MemoryBudget
+
+            budget = MemoryBudget(max_memory)
+
+        pool = None
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = pool = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            return submit_config(
+                json_data, executor, output_dir=output_dir,
+                scene_files=scene_files, cache=cache, metrics=metrics,
+                scene_names=scene_names, budget=budget)()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    budget = None
+    if max_memory is not None:
+        from .planner import MemoryBudget
+
+        budget = MemoryBudget(max_memory)
+    entries, jobs_list, measures, store, record = _prepare_config(
+        json_data, output_dir, scene_files, cache, metrics, scene_names,
+        budget)
+    measure = metrics is not None
+
+    def draw(saver):
+        # A printer for every size, created on its first scene
+        printers = {}
+        for size_data, plan, seed, size_dir, key in jobs_list:
+            printer = None
+            if not json_data.get("band_height"):
+                size = (plan.sizex, plan.sizey)
+                if size not in printers:
+                    printers[size] = ImcrPrinter(size_data, saver=saver)
+                printer = printers[size]
+            result = render_scene(
+                size_data, plan, seed, size_dir, printer=printer,
+                measure=measure)
+            if measure:
+                measures.append((result, size_data, size_dir))
+            if saver is None:
+                store(size_data, plan, size_dir, key)
+
+    if save_threads and not json_data.get("band_height"):
+        from .saver import AsyncSaver
+
+        with AsyncSaver(save_threads) as saver:
+            draw(saver)
+        # The files are complete only after the saver was flushed
+        for size_data, plan, _, size_dir, key in jobs_list:
+            store(size_data, plan, size_dir, key)
+    else:
+        draw(None)
+
+    if measure:
+        record()
+    return len(entries)
+
+
+def submit_config(json_data, executor, output_dir=".", scene_files=None,
+                  cache=None, metrics=None, scene_names=None, budget=None):
+    """
+    Submits the scenes of a configuration to an executor without waiting
+    for them, so the scenes of the next configuration can be queued behind
+    them. The arguments are the ones of render_config
+    :param executor:      Running executor rendering the scenes
+    :param budget:        Optional MemoryBudget admitting the scenes, shared
+                          by every configuration submitted to the executor
+    :return:              A function waiting for the scenes and returning
+                          the number of images written. It raises the
+                          error of the first failed scene
+    """
+    entries, jobs_list, measures, store, record = _prepare_config(
+        json_data, output_dir, scene_files, cache, metrics, scene_names,
+        budget)
+    measure = metrics is not None
+
+    if budget is None:
+        futures = [
+            executor.submit(
+                render_scene, size_data, plan, seed, size_dir,
+                measure=measure)
+            for size_data, plan, seed, size_dir, _ in jobs_list]
+    else:
+        from .planner import canvas_memory
+
+        # Wait for room in the budget before every submission
+        futures = [
+            budget.submit(
+                executor, canvas_memory(size_data), render_scene,
+                size_data, plan, seed, size_dir, measure=measure)
+            for size_data, plan, seed, size_dir, _ in jobs_list]
+
+    def wait():
+        # Propagate any worker error
+        for future, job in zip(futures, jobs_list):
+            size_data, plan, _, size_dir, key = job
+            result = future.result()
+            if measure:
+                measures.append((result, size_data, size_dir))
+            log.debug("Scene {} done".format(
+                output_path(size_data, size_dir, plan.name)))
+            store(size_data, plan, size_dir, key)
+
+        if measure:
+            record()
+        return len(entries)
+
+    return wait
+
+
+def _prepare_config(json_data, output_dir, scene_files, cache, metrics,
+                    scene_names, budget):
+    """
+    Plans the images of a configuration, creates their directories and
+    places the ones found in the cache
+    :return:              (entries, jobs, measures, store, record). entries
+                          lists every image, jobs the ones to render as
+                          (json data, plan, seed, directory, cache key),
+                          store adds a rendered file to the cache and
+                          record adds the measures to metrics
+    """
+    configs = size_configs(json_data)
+    scenes = get_scenes(scene_files)
+    size_plans = [
+        [compile_scene(scene, size_data["sizex"], size_data["sizey"])
+         for scene in scenes]
+        for _, size_data in configs]
+    # Every size of a scene draws the same random colors
+    seeds = get_seeds(json_data, size_plans[0])
+
+    # One entry per image: (json data, plan, seed, directory), the sizes of
+    # a scene next to each other
+    entries = []
+    for index, seed in enumerate(seeds):
+        if (scene_names is not None
+                and size_plans[0][index].name not in scene_names):
+            continue
+        for (subdir, size_data), plans in zip(configs, size_plans):
+            size_dir = output_dir if subdir is None else join(
+                output_dir, subdir)
+            entries.append((size_data, plans[index], seed, size_dir))
+
+    if budget is not None:
+        from .planner import canvas_memory
+
+        for _, size_data in configs:
+            budget.check(
+                "{}x{}".format(size_data["sizex"], size_data["sizey"]),
+                canvas_memory(size_data))
+
+    for size_dir in set(entry[3] for entry in entries) | {output_dir}:
+        if not isdir(size_dir):
+            makedirs(size_dir)
+
+    # Skip the scenes found in the cache
+    jobs_list = []
+    measures = []
+    for size_data, plan, seed, size_dir in entries:
+        key = None
+        if cache is not None:
+            key = cache.key(size_data, plan, seed)
+            path = output_path(size_data, size_dir, plan.name)
+            if cache.fetch(key, path):
+                log.debug("Scene {} served from the cache".format(path))
+                if metrics is not None:
+                    measures.append((SceneMetrics(
+                        plan.name, len(plan.ops), None, None, None, None,
+                        None, True), size_data, size_dir))
+                continue
+        jobs_list.append((size_data, plan, seed, size_dir, key))
+
+    # The labels of the configuration, metrics.labels may change before
+    # its scenes are recorded
+    labels = dict(metrics.labels) if metrics is not None else None
+
+    def store(size_data, plan, size_dir, key):
+        if key is not None:
+            cache.store(key, output_path(size_data, size_dir, plan.name))
+
+    def record():
+        # File sizes are known once every image was written
+        for measure, size_data, size_dir in measures:
+            scene_labels = dict(labels, format=json_data["format"])
+            if len(configs) > 1 or configs[0][0] is not None:
+                scene_labels["size"] = "{}x{}".format(
+                    size_data["sizex"], size_data["sizey"])
+            metrics.add(
+                measure, output_path(size_data, size_dir, measure.scene),
+                **scene_labels)
+
+    return entries, jobs_list, measures, store, record
+
+
+def get_sizes(json_data):
+    """
+    Returns the list of (sizex, sizey) canvas sizes of a configuration.
+    "sizex" and "sizey" are numbers or lists of numbers paired in order, a
+    number goes with every entry of the other list
+    """
+    sizex, sizey = json_data["sizex"], json_data["sizey"]
+    widths = list(sizex) if isinstance(sizex, (list, tuple)) else None
+    heights = list(sizey) if isinstance(sizey, (list, tuple)) else None
+    if widths is None and heights is None:
+        return [(sizex, sizey)]
+
+    if widths is None:
+        widths = [sizex] * len(heights)
+    if heights is None:
+        heights = [sizey] * len(widths)
+    if len(widths) != len(heights):
+        raise ValueError(
+            "The sizex and sizey lists must have the same length, got {} "
+            "and {}".format(len(widths), len(heights)))
+    if not widths:
+        raise ValueError("The size lists must not be empty")
+
+    sizes = list(zip(widths, heights))
+    if len(set(sizes)) != len(sizes):
+        raise ValueError("Repeated size in {!r}".format(sizes))
+    return sizes
+
+
+def size_configs(json_data):
+    """
+    Splits a configuration into one configuration per canvas size
+    :return:              List of (subdirectory, json data). The
+                          subdirectory is "WxH" when "sizex" or "sizey" is
+                          a list, None otherwise
+    """
+    sizes = get_sizes(json_data)
+    if not any(
+            isinstance(json_data[key], (list, tuple))
+            for key in ("sizex", "sizey")):
+        return [(None, json_data)]
+    return [
+        ("{}x{}".format(sizex, sizey),
+         dict(json_data, sizex=sizex, sizey=sizey))
+        for sizex, sizey in sizes]
+
+
+def get_seeds(json_data, plans):
+    """
+    Returns the seed of every plan. With a "seed" JSON key every scene gets
+    the stream derived from it and its name, otherwise the seeds are drawn
+    in order from the global random module
+    """
+    if json_data.get("seed") is None:
+        return [random.getrandbits(32) for _ in plans]
+
+    root = SeedSequence(json_data["seed"])
+    return [scene_seed(root, plan.name) for plan in plans]
+
+
+def output_path(json_data, output_dir, scene_name):
+    """
+    Path of the file a scene is saved to
+    """
+    return "{}.{}".format(join(output_dir, scene_name), json_data["format"])
 
-    # Draw first arc
-    printer.draw_arc(
-        x_start=1*imcr_sizex//7,
-        y_start=6*imcr_sizey//9,
-        x_finish=6*imcr_sizex//7,
-        y_finish=8*imcr_sizey//9,
-        start_angle=180,
-        end_angle=0,
-        color_index=2)
-
-    # Draw first line
-    printer.draw_line(
-        x_start=2*imcr_sizex//5,
-        y_start=imcr_sizey//4,
-        x_finish=2*imcr_sizex//5,
-        y_finish=2*imcr_sizey//4,
-        color_index=3)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=3*imcr_sizex//5,
-        y_start=imcr_sizey//4,
-        x_finish=3*imcr_sizex//5,
-        y_finish=2*imcr_sizey//4,
-        color_index=3)
-
-    # Save the image
-    printer.save_image(file_root_name="sad_face")
-
-    # Tenth Drawing: Curve and cross
-    # ################################
-    # Restart Image
-    printer.restart_image()
 
-    # Draw first arc
-    printer.draw_arc(
-        y_start=4*imcr_sizey//7,
-        x_start=imcr_sizex//6,
-        y_finish=6*imcr_sizey//7,
-        x_finish=5*imcr_sizex//6,
-        start_angle=180,
-        end_angle=0,
-        color_index=0)
-
-    # Draw second arc
-    printer.draw_arc(
-        y_start=3*imcr_sizey//7,
-        x_start=imcr_sizex//6,
-        y_finish=5*imcr_sizey//7,
-        x_finish=5*imcr_sizex//6,
-        start_angle=0,
-        end_angle=180,
-        color_index=3)
-
-    # Draw first line
-    printer.draw_line(
-        x_start=imcr_sizex//2,
-        y_start=imcr_sizey//4,
-        x_finish=imcr_sizex//2,
-        y_finish=3*imcr_sizey//4,
-        color_index=1)
-
-    # Draw second line
-    printer.draw_line(
-        x_start=imcr_sizex//5,
-        y_start=imcr_sizey//2,
-        x_finish=4*imcr_sizex//5,
-        y_finish=imcr_sizey//2,
-        color_index=2)
-
-    # Save the image
-    printer.save_image(file_root_name="curve_and_cross")
+def get_max_memory(args):
+    """
+    Memory budget of the arguments namespace in bytes, or None
+    """
+    max_memory = getattr(args, "max_memory", None)
+    if max_memory is None:
+        return None
+    return max_memory * 1024 * 1024
+
+
+def open_metrics(args):
+    """
+    Returns a MetricsRecorder when the arguments namespace asks for a
+    metrics file, or None
+    """
+    if not getattr(args, "metrics", None):
+        return None
+
+    from .metrics import MetricsRecorder
+
+    return MetricsRecorder()
+
+
+def open_cache(args):
+    """
+    Returns the RenderCache requested by the arguments namespace, or None
+    """
+    cache_dir = getattr(args, "cache_dir", None)
+    if not cache_dir:
+        return None
+
+    from .cache import RenderCache
+
+    cache_size = getattr(args, "cache_size", None)
+    if cache_size is None:
+        return RenderCache(cache_dir)
+    return RenderCache(cache_dir, cache_size * 1024 * 1024)
+
+
+def micros_imcr_main(args):
+    """
+    Main call of the IMCR package
+    Takes a path to a JSON file and creates a set of default images
+
+    Every scene of the registry, plus the ones in args.scene_files, is
+    compiled once into a draw plan for the configured canvas size.
+    The scenes are independent units of work. With args.jobs greater than
+    one they are distributed over a process pool, each worker drawing with
+    its own printer. Every scene gets its own seed, derived from the "seed"
+    JSON key or drawn in order from the global random module, so the output
+    is identical to a serial run.
+
+    With args.sweep every list of the JSON file is an axis of a parameter
+    sweep, see micros_imcr.sweep
+    """
+    if getattr(args, "plan", False):
+        from .planner import micros_imcr_plan
+
+        return micros_imcr_plan(args)
+
+    if getattr(args, "sweep", False):
+        from .sweep import micros_imcr_sweep
+
+        return micros_imcr_sweep(args)
+
+    # Obtain the json information
+    # --------------------------------------------------------------------------
+    # Read the file
+    with open(args.path_to_json) as json_file:
+        json_data = loads(json_file.read())
+
+    # Generate the basic images
+    # --------------------------------------------------------------------------
+    cache = open_cache(args)
+    metrics = open_metrics(args)
+    if metrics is not None:
+        metrics.labels["config"] = basename(args.path_to_json)
+    render_config(
+        json_data,
+        output_dir=getattr(args, "output_dir", "."),
+        jobs=getattr(args, "jobs", 1) or 1,
+        scene_files=getattr(args, "scene_files", None),
+        overrides=get_overrides(args),
+        cache=cache,
+        save_threads=getattr(args, "save_threads", 0) or 0,
+        metrics=metrics,
+        max_memory=get_max_memory(args))
+
+    if cache is not None:
+        from .cache import format_stats
+
+        cache.save_stats()
+        log.info(format_stats(cache.stats()))
+
+    if metrics is not None:
+        metrics.write(args.metrics)
+
+    return 0
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Uncompressed file layouts for the "mmap" backend.
+
+The backend maps the output file and draws into its pixels, so the file
+must store every pixel at a fixed position: binary PPM, 24-bit BMP and
+the "bin" framebuffers with a whole number of bytes per pixel. The
+headers and the pixel bytes are the ones Pillow and framebuffer.py write,
+so a mapped file is byte for byte the file the other backends save.
+"""
+
+from collections import namedtuple
+from struct import pack
+
+MAPPED_FORMATS = ("ppm", "bmp", "bin")
+
+# Pixels per meter of the BMP header, the 96 dpi Pillow writes
+_BMP_PPM = 3780
+
+# header:      Bytes before the pixels
+# offset:      Position of the top left pixel
+# stride:      Bytes from a row to the next one, negative for bottom-up files
+# pixel_bytes: Bytes of every pixel
+# size:        Size of the whole file
+MappedLayout = namedtuple(
+    "MappedLayout", ["header", "offset", "stride", "pixel_bytes", "size"])
+
+
+def mapped_layout(encoder, width, height):
+    """
+    Layout of an output file
+    :param encoder:       EncoderSettings of the output
+    :return:              MappedLayout
+    :raise ValueError:    When the format can not be mapped
+    """
+    if encoder.format == "ppm":
+        header = "P6\n{} {}\n255\n".format(width, height).encode("ascii")
+        return MappedLayout(
+            header, len(header), 3 * width, 3,
+            len(header) + 3 * width * height)
+
+    if encoder.format == "bmp":
+        # Rows are padded to 4 bytes and stored from the bottom one up
+        stride = (3 * width + 3) & ~3
+        data = stride * height
+        header = pack("<2sIHHI", b"BM", 54 + data, 0, 0, 54) + pack(
+            "<IiiHHIIiiII", 40, width, height, 1, 24, 0, data, _BMP_PPM,
+            _BMP_PPM, 0, 0)
+        return MappedLayout(
+            header, 54 + (height - 1) * stride, -stride, 3, 54 + data)
+
+    if encoder.format == "bin":
+        from .framebuffer import DEFAULT_PIXEL_FORMAT
+
+        pixel_format = encoder.pixel_format or DEFAULT_PIXEL_FORMAT
+        if pixel_format == "mono":
+            raise ValueError(
+                "The mmap backend can not write mono framebuffers, their "
+                "pixels are bits")
+        pixel_bytes = 1 if pixel_format == "rgb332" else 2
+        return MappedLayout(
+            b"", 0, pixel_bytes * width, pixel_bytes,
+            pixel_bytes * width * height)
+
+    raise ValueError(
+        "The mmap backend writes {} files, not {!r}".format(
+            ", ".join(MAPPED_FORMATS), encoder.extension))
+
+
+def pixel_values(encoder, colors):
+    """
+    Colors as the bytes the output file stores for them
+    :param encoder:       EncoderSettings of the output
+    :param colors:        List of color names or (r, g, b) colors
+    :return:              The bytes of every color one after the other
+    """
+    from PIL import Image, ImageColor
+
+    image = Image.new("RGB", (len(colors), 1))
+    image.putdata([
+        ImageColor.getrgb(color) if isinstance(color, str)
+        else tuple(int(value) for value in color[:3])
+        for color in colors])
+
+    if encoder.format == "ppm":
+        return image.tobytes()
+    if encoder.format == "bmp":
+        return image.tobytes("raw", "BGR")
+
+    from .framebuffer import DEFAULT_PIXEL_FORMAT, to_framebuffer
+
+    return to_framebuffer(
+        image, encoder.pixel_format or DEFAULT_PIXEL_FORMAT,
+        encoder.background)
+
+
+__all__ = ['MAPPED_FORMATS', 'MappedLayout', 'mapped_layout', 'pixel_values']
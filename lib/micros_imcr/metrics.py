@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-scene timing instrumentation.
+
+render_scene only measures when a MetricsRecorder is in use, so a run
+without --metrics does not pay for the clock reads. The recorded scenes are
+written as JSON or, for files ending in .prom, in the Prometheus text
+exposition format.
+"""
+
+import sys
+from collections import namedtuple
+from json import dumps
+from logging import getLogger
+from os.path import getsize
+
+log = getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+
+# Measures of one rendered scene. Times are in seconds, None when the step
+# did not run on its own: cached scenes are not drawn and band rendering
+# encodes while it draws. With background saving encode_seconds only
+# covers queueing the image
+SceneMetrics = namedtuple(
+    "SceneMetrics",
+    ["scene", "primitives", "reset_seconds", "draw_seconds",
+     "encode_seconds", "bytes", "peak_rss", "cached"])
+
+# Metric name, SceneMetrics field and help text of the Prometheus export
+PROMETHEUS_METRICS = (
+    ("micros_imcr_scene_primitives", "primitives",
+     "Number of primitives drawn by the scene"),
+    ("micros_imcr_scene_reset_seconds", "reset_seconds",
+     "Time resetting the canvas before the scene"),
+    ("micros_imcr_scene_draw_seconds", "draw_seconds",
+     "Time drawing the primitives of the scene"),
+    ("micros_imcr_scene_encode_seconds", "encode_seconds",
+     "Time encoding and writing the image"),
+    ("micros_imcr_scene_bytes", "bytes",
+     "Size of the written file"),
+    ("micros_imcr_scene_peak_rss_bytes", "peak_rss",
+     "Peak resident set size of the rendering process"),
+    ("micros_imcr_scene_cached", "cached",
+     "1 when the file was served from the render cache"),
+)
+
+
+def peak_rss():
+    """
+    Peak resident set size of the calling process in bytes, None when the
+    platform does not report it
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class MetricsRecorder:
+    """
+    Collects the SceneMetrics of one or more configurations
+
+    :records:      List of (labels, SceneMetrics). labels is a dictionary
+                   such as {"config": ..., "format": ...}
+    :labels:       Labels render_config adds to the scenes it records, for
+                   example the name of the configuration being rendered
+    """
+    def __init__(self, **labels):
+        self.records = []
+        self.labels = labels
+
+    def add(self, metrics, path=None, **labels):
+        """
+        Records a scene
+        :param metrics:       SceneMetrics of the scene
+        :param path:          Optional output file, used to fill in bytes
+        :param labels:        Labels identifying the run of the scene
+        """
+        if path is not None and metrics.bytes is None:
+            try:
+                metrics = metrics._replace(bytes=getsize(path))
+            except OSError:
+                log.warning("No output file {} to measure".format(path))
+        self.records.append((labels, metrics))
+
+    def to_json(self):
+        """
+        JSON text with one object per scene
+        """
+        scenes = []
+        for labels, metrics in self.records:
+            scene = dict(labels)
+            scene.update(metrics._asdict())
+            scenes.append(scene)
+        return dumps({"scenes": scenes}, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Prometheus text exposition format, one gauge per SceneMetrics field
+        """
+        lines = []
+        for name, field, description in PROMETHEUS_METRICS:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, metrics in self.records:
+                value = getattr(metrics, field)
+                if value is None:
+                    continue
+                all_labels = dict(labels, scene=metrics.scene)
+                lines.append("{}{{{}}} {}".format(
+                    name, format_labels(all_labels), float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Writes the metrics file, in Prometheus format for .prom files and
+        JSON otherwise
+        """
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        with open(path, "w") as metrics_file:
+            metrics_file.write(text)
+        log.info("Wrote metrics of {} scenes to {}".format(
+            len(self.records), path))
+
+
+def format_labels(labels):
+    """
+    Prometheus label set, values escaped
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+
+    return ",".join(
+        "{}=\"{}\"".format(key, escape(labels[key]))
+        for key in sorted(labels))
+
+
+__all__ = ['SceneMetrics', 'MetricsRecorder', 'peak_rss']
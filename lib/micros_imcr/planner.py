@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Job planner: cost estimates and memory admission.
+
+The peak memory of a job follows from the buffers its backend, canvas
+mode and format allocate, see canvas_memory. The encode time and the
+output size are predicted by a Calibration, a micro-benchmark rendering
+every scene at two small sizes with the job's own settings and fitting
+a * L**2 + b * L, L being the square root of the pixel count: the area
+term covers the background and the linear one the drawn primitives.
+
+A MemoryBudget admits jobs to an executor only while the estimated memory
+of the jobs in flight fits in the budget, and rejects a job that could
+never fit before anything is allocated.
+"""
+
+from collections import namedtuple
+from json import dumps, loads
+from logging import getLogger
+from math import sqrt
+from time import perf_counter
+
+from .main import (
+    ImcrPrinter, get_overrides, get_seeds, size_configs)
+from .scenes import compile_scene, get_scenes
+
+log = getLogger(__name__)
+
+
+JobEstimate = namedtuple("JobEstimate", [
+    "scene", "sizex", "sizey", "format", "primitives", "memory",
+    "encode_seconds", "output_bytes"])
+
+# Bytes per pixel of an RGB and of a "P" Pillow image
+_RGB_BYTES = 4
+_P_BYTES = 1
+
+# Formats written row by row by the sparse backend
+_STREAMED_FORMATS = ("png", "ppm")
+
+
+def canvas_memory(json_data):
+    """
+    Estimated peak memory of rendering one scene of a configuration
+    :param json_data:     Is the json data of a single size
+    :return:              Bytes
+    """
+    from .encoders import PALETTE_FORMATS, EncoderSettings
+
+    width, height = json_data["sizex"], json_data["sizey"]
+    pixels = width * height
+    encoder = EncoderSettings.from_json(json_data)
+    backend = json_data.get("backend") or "pillow"
+
+    # A strip and its background template
+    if json_data.get("band_height"):
+        rows = min(json_data["band_height"], height)
+        return 2 * _RGB_BYTES * width * rows
+
+    if backend == "sparse":
+        # Rows are expanded one chunk at a time, other formats need the
+        # whole image and the bytes it is made from
+        if encoder.format in _STREAMED_FORMATS:
+            return 2 * 3 * width * 64
+        return (_RGB_BYTES + 3) * pixels
+
+    if backend == "mmap":
+        # The pixels are pages of the output file, reclaimable by the
+        # system. What stays resident are the index arrays of the drawn
+        # pixels, a few times the perimeter
+        return 16 * 16 * (width + height)
+
+    if backend == "numpy":
+        # Pool template, RGBX canvas and the PIL copy handed to the encoder
+        memory = (_RGB_BYTES + 4 + _RGB_BYTES) * pixels
+    else:
+        indexed = json_data.get("canvas_mode") == "P"
+        # Canvas and background template
+        memory = 2 * (_P_BYTES if indexed else _RGB_BYTES) * pixels
+        if indexed and encoder.format not in PALETTE_FORMATS:
+            memory += _RGB_BYTES * pixels
+
+    # Framebuffers convert to RGB and split the bands
+    if encoder.is_framebuffer:
+        memory += (_RGB_BYTES + 3 + 2) * pixels
+    return memory
+
+
+def _fit(samples):
+    """
+    Coefficients (a, b) of a * L**2 + b * L through two (L, value) samples,
+    both non negative
+    """
+    (side1, value1), (side2, value2) = samples
+    a = (value2 / side2 - value1 / side1) / (side2 - side1)
+    b = value1 / side1 - a * side1
+    if a < 0:
+        return 0.0, value2 / side2
+    if b < 0:
+        return value2 / side2 ** 2, 0.0
+    return a, b
+
+
+class Calibration:
+    """
+    Encode time and output size model fitted by rendering the scenes at
+    small sizes. The fits are kept for every configuration and scene
+
+    :sides:        Square roots of the pixel counts of the samples
+    :repeats:      Number of timings of every sample, the fastest is kept
+    """
+    def __init__(self, sides=(384, 1024), repeats=3):
+        self.sides = sides
+        self.repeats = repeats
+        self.__fits = {}
+
+    def fit(self, json_data, scene):
+        """
+        Fitted ((time a, time b), (size a, size b)) of a scene
+        :param json_data:     Is the json data of a single size
+        :param scene:         Scene of the registry
+        """
+        settings = dict(json_data)
+        width, height = settings.pop("sizex"), settings.pop("sizey")
+        settings.pop("band_height", None)
+        aspect = width / height
+        key = (dumps(settings, sort_keys=True), aspect, scene.name)
+        if key in self.__fits:
+            return self.__fits[key]
+
+        times, sizes = [], []
+        for side in self.sides:
+            sizex = max(1, int(round(side * sqrt(aspect))))
+            sizey = max(1, int(round(side / sqrt(aspect))))
+            sample = dict(settings, sizex=sizex, sizey=sizey)
+            plan = compile_scene(scene, sizex, sizey)
+            printer = ImcrPrinter(sample)
+            seconds = None
+            for _ in range(self.repeats):
+                printer.restart_image()
+                printer.reseed(get_seeds(sample, [plan])[0])
+                printer.draw_plan(plan)
+                start = perf_counter()
+                data = printer.encode_image()
+                elapsed = perf_counter() - start
+                seconds = elapsed if seconds is None else min(
+                    seconds, elapsed)
+            side = sqrt(sizex * sizey)
+            times.append((side, seconds))
+            sizes.append((side, len(data)))
+
+        fitted = self.__fits[key] = (_fit(times), _fit(sizes))
+        return fitted
+
+    def estimate(self, json_data, scene):
+        """
+        Predicted (encode seconds, output bytes) of a scene
+        :param json_data:     Is the json data of a single size
+        """
+        (time_a, time_b), (size_a, size_b) = self.fit(json_data, scene)
+        side = sqrt(json_data["sizex"] * json_data["sizey"])
+        return (time_a * side ** 2 + time_b * side,
+                int(size_a * side ** 2 + size_b * side))
+
+
+def plan_config(json_data, scene_files=None, calibration=None,
+                scene_names=None):
+    """
+    Estimates every job of a configuration, nothing is rendered at the
+    requested sizes
+    :param json_data:     Is the json data in dictionary format
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :param calibration:   Calibration to use, a new one by default
+    :param scene_names:   Optional names of the scenes to plan
+    :return:              List of JobEstimate
+    """
+    if calibration is None:
+        calibration = Calibration()
+
+    estimates = []
+    scenes = [
+        scene for scene in get_scenes(scene_files)
+        if scene_names is None or scene.name in scene_names]
+    for _, size_data in size_configs(json_data):
+        memory = canvas_memory(size_data)
+        for scene in scenes:
+            plan = compile_scene(
+                scene, size_data["sizex"], size_data["sizey"])
+            seconds, output_bytes = calibration.estimate(size_data, scene)
+            estimates.append(JobEstimate(
+                scene.name, size_data["sizex"], size_data["sizey"],
+                size_data["format"], len(plan.ops), memory, seconds,
+                output_bytes))
+    return estimates
+
+
+def _megabytes(value):
+    return "{:.1f}".format(value / (1024 * 1024))
+
+
+def format_plan(estimates, max_memory=None):
+    """
+    Human readable table of JobEstimate
+    :param max_memory:    Optional memory budget in bytes, the jobs over it
+                          are flagged
+    """
+    lines = ["{:<26} {:>13} {:>6} {:>6} {:>11} {:>10} {:>10}".format(
+        "scene", "size", "format", "prims", "memory MB", "encode s",
+        "output KB")]
+    for estimate in estimates:
+        line = "{:<26} {:>13} {:>6} {:>6} {:>11} {:>10.3f} {:>10}".format(
+            estimate.scene,
+            "{}x{}".format(estimate.sizex, estimate.sizey),
+            estimate.format, estimate.primitives,
+            _megabytes(estimate.memory), estimate.encode_seconds,
+            estimate.output_bytes // 1024)
+        if max_memory is not None and estimate.memory > max_memory:
+            line += "  OVER BUDGET"
+        lines.append(line)
+
+    lines.append("Jobs: {}, peak job memory: {} MB, encode: {:.2f} s, "
+                 "output: {} MB".format(
+                     len(estimates),
+                     _megabytes(max(
+                         [estimate.memory for estimate in estimates] or [0])),
+                     sum(estimate.encode_seconds for estimate in estimates),
+                     _megabytes(sum(
+                         estimate.output_bytes for estimate in estimates))))
+    return "\n".join(lines)
+
+
+class MemoryBudget:
+    """
+    Admits jobs to an executor while their estimated memory fits
+
+    :max_memory:   Budget in bytes shared by the jobs in flight
+    """
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.__in_flight = {}
+
+    def check(self, name, memory):
+        """
+        Rejects a job that does not fit in the whole budget
+        :raise ValueError:    When memory is over the budget
+        """
+        if memory > self.max_memory:
+            raise ValueError(
+                "Job {} needs an estimated {} MB, over the {} MB "
+                "budget".format(
+                    name, _megabytes(memory), _megabytes(self.max_memory)))
+
+    def submit(self, executor, memory, function, *args, **kwargs):
+        """
+        Submits a call once the jobs in flight leave room for memory
+        :return:              The future of the call
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        while (self.__in_flight and
+               sum(self.__in_flight.values()) + memory > self.max_memory):
+            done, _ = wait(self.__in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                del self.__in_flight[future]
+
+        future = executor.submit(function, *args, **kwargs)
+        self.__in_flight[future] = memory
+        return future
+
+
+def micros_imcr_plan(args):
+    """
+    Dry run of the IMCR package. Prints the estimates of every job of
+    args.path_to_json, of every combination with args.sweep
+    :return:              Exit code, 1 when a job is over args.max_memory
+    """
+    with open(args.path_to_json) as json_file:
+        json_data = loads(json_file.read())
+    json_data.update(get_overrides(args))
+
+    if getattr(args, "sweep", False):
+        from .sweep import expand_sweep
+
+        configs = [config for _, _, config in expand_sweep(json_data)]
+    else:
+        configs = [json_data]
+
+    calibration = Calibration()
+    estimates = []
+    for config in configs:
+        estimates.extend(plan_config(
+            config, getattr(args, "scene_files", None), calibration))
+
+    max_memory = getattr(args, "max_memory", None)
+    if max_memory is not None:
+        max_memory *= 1024 * 1024
+    print(format_plan(estimates, max_memory))
+
+    if max_memory is not None and any(
+            estimate.memory > max_memory for estimate in estimates):
+        return 1
+    return 0
+
+
+__all__ = [
+    'JobEstimate', 'canvas_memory', 'Calibration', 'plan_config',
+    'format_plan', 'MemoryBudget', 'micros_imcr_plan']
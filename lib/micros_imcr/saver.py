@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background encode-and-save pipeline.
+
+Pillow's encoders release the GIL, so finished images are encoded and
+written by a thread pool while the printer draws the next scene. The queue
+of pending images is bounded to keep memory in check.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import BoundedSemaphore, Lock
+
+log = getLogger(__name__)
+
+
+class AsyncSaver:
+    """
+    Saves images on a thread pool
+
+    :threads:      Number of encoding threads
+    :max_pending:  Maximum number of images waiting or being saved. submit
+                   blocks while the queue is full
+    """
+    def __init__(self, threads=2, max_pending=None):
+        if threads < 1:
+            raise ValueError("AsyncSaver needs at least one thread")
+        if max_pending is None:
+            max_pending = 2 * threads
+
+        self.threads = threads
+        self.max_pending = max_pending
+        self.__executor = ThreadPoolExecutor(max_workers=threads)
+        self.__slots = BoundedSemaphore(max_pending)
+        self.__lock = Lock()
+        self.__futures = []
+        self.__error = None
+
+    def submit(self, image, path, on_done=None, save=None, **params):
+        """
+        Queues an image to be saved. The image must not be modified
+        afterwards
+        :param image:         PIL image to save
+        :param path:          Output file path
+        :param on_done:       Optional callable receiving the image once it
+                              was saved, for example to recycle its canvas
+        :param save:          Optional callable save(image, path) used
+                              instead of Image.save
+        :param params:        Extra keyword arguments for Image.save
+        """
+        self.raise_error()
+        self.__slots.acquire()
+        try:
+            future = self.__executor.submit(
+                self.__save, image, path, on_done, save, params)
+        except Exception:
+            self.__slots.release()
+            raise
+
+        with self.__lock:
+            self.__futures = [
+                pending for pending in self.__futures if not pending.done()]
+            self.__futures.append(future)
+        return future
+
+    def flush(self):
+        """
+        Waits for every queued image and raises the first save error
+        """
+        with self.__lock:
+            futures, self.__futures = self.__futures, []
+        for future in futures:
+            future.exception()
+        self.raise_error()
+
+    def close(self):
+        """
+        Flushes the queue and stops the threads
+        """
+        try:
+            self.flush()
+        finally:
+            self.__executor.shutdown()
+
+    def raise_error(self):
+        """
+        Raises the first error found by a save, if any
+        """
+        with self.__lock:
+            error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+    def __save(self, image, path, on_done, save, params):
+        try:
+            if save is None:
+                image.save(path, **params)
+            else:
+                save(image, path)
+            if on_done is not None:
+                on_done(image)
+        except Exception as error:
+            log.error("Saving {} failed: {!r}".format(path, error))
+            with self.__lock:
+                if self.__error is None:
+                    self.__error = error
+            raise
+        finally:
+            self.__slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Do not hide the error that is already propagating
+        if exc_info[0] is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
+__all__ = ['AsyncSaver']
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Declarative scene definitions.
+
+A scene is a table of primitives whose coordinates are fractions of the
+canvas size. Scenes are compiled once per canvas size into a DrawPlan with
+resolved pixel coordinates, which the ImcrPrinter executes in bulk.
+
+The JSON form of a scene is::
+
+    {
+        "name": "simple_line",
+        "primitives": [
+            {"type": "line", "xy": ["1/2", "1/3", "1/2", "2/3"],
+             "color": {"random": 0}},
+            {"type": "arc", "xy": ["1/7", "5/9", "6/7", "8/9"],
+             "start": 0, "end": 180, "color": 0}
+        ]
+    }
+
+Coordinates are "n/d" strings or numbers between 0 and 1, resolved as
+n*size//d. A color is an index in the color array or a random slot; every
+slot of a scene gets a different random color.
+"""
+
+from collections import namedtuple, OrderedDict
+from fractions import Fraction
+from functools import lru_cache
+from json import loads
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+# Scene with its primitives, coordinates kept as fractions
+Scene = namedtuple("Scene", ["name", "primitives"])
+Primitive = namedtuple("Primitive", ["kind", "xy", "color", "start", "end"])
+
+# Scene compiled for a given canvas size
+DrawPlan = namedtuple("DrawPlan", ["name", "sizex", "sizey", "ops", "slots"])
+DrawOp = namedtuple("DrawOp", ["kind", "xy", "color", "start", "end"])
+
+# Color reference to a random slot of the scene
+RandomColor = namedtuple("RandomColor", ["slot"])
+
+PRIMITIVE_KINDS = ("line", "arc")
+
+
+# Built-in test scenes
+# --------------------------------------------------------------------------
+BUILTIN_SCENES = [
+    # First Drawing: Single vertical Line
+    # Starts 1/3 in the y axis and draws 1/3 of the size
+    {
+        "name": "simple_line",
+        "primitives": [
+            {"type": "line", "xy": ["1/2", "1/3", "1/2", "2/3"],
+             "color": {"random": 0}},
+        ],
+    },
+    # Second Drawing: Multiple lines
+    # Adds one horizontal line of each color with no intersections
+    {
+        "name": "multiple_horizontal_line",
+        "primitives": [
+            {"type": "line", "xy": ["1/3", "1/5", "2/3", "1/5"], "color": 0},
+            {"type": "line", "xy": ["1/3", "2/5", "2/3", "2/5"], "color": 1},
+            {"type": "line", "xy": ["1/3", "3/5", "2/3", "3/5"], "color": 2},
+            {"type": "line", "xy": ["1/3", "4/5", "2/3", "4/5"], "color": 3},
+        ],
+    },
+    # Third Drawing: Diagonal line
+    # Adds two diagonal lines of the same color
+    {
+        "name": "diagonal_lines",
+        "primitives": [
+            {"type": "line", "xy": ["1/5", "1/5", "2/5", "2/5"],
+             "color": {"random": 0}},
+            {"type": "line", "xy": ["1/5", "2/5", "2/5", "3/5"],
+             "color": {"random": 0}},
+        ],
+    },
+    # Fourth Drawing: Intersection
+    # Diagonal intersection using two random colors
+    {
+        "name": "diagonal_intersection",
+        "primitives": [
+            {"type": "line", "xy": ["1/3", "1/5", "2/3", "4/5"],
+             "color": {"random": 0}},
+            {"type": "line", "xy": ["1/3", "4/5", "2/3", "1/5"],
+             "color": {"random": 1}},
+        ],
+    },
+    # Fifth Drawing: Four Line intersection
+    # Creates four lines where there are multiple intersections
+    {
+        "name": "full_intersection",
+        "primitives": [
+            {"type": "line", "xy": ["1/3", "1/5", "2/3", "4/5"], "color": 0},
+            {"type": "line", "xy": ["1/3", "1/4", "2/3", "1/4"], "color": 1},
+            {"type": "line", "xy": ["1/4", "4/5", "3/4", "3/5"], "color": 2},
+            {"type": "line", "xy": ["1/2", "1/5", "1/2", "4/5"], "color": 3},
+        ],
+    },
+    # Sixth Drawing: Three lines
+    # Creates three lines with no intersections
+    {
+        "name": "three_line_test",
+        "primitives": [
+            {"type": "line", "xy": ["1/9", "1/5", "3/4", "1/5"], "color": 0},
+            {"type": "line", "xy": ["4/5", "3/5", "4/5", "1"], "color": 2},
+            {"type": "line", "xy": ["1/6", "7/8", "1/3", "1/6"], "color": 3},
+        ],
+    },
+    # Seventh Drawing: Curve
+    {
+        "name": "curve",
+        "primitives": [
+            {"type": "arc", "xy": ["2/7", "1/9", "5/7", "8/9"],
+             "start": 90, "end": 270, "color": 0},
+            {"type": "arc", "xy": ["1/7", "1/9", "3/7", "8/9"],
+             "start": 270, "end": 90, "color": 3},
+        ],
+    },
+    # Eigth Drawing: Happy face
+    {
+        "name": "happy_face",
+        "primitives": [
+            {"type": "arc", "xy": ["1/7", "5/9", "6/7", "8/9"],
+             "start": 0, "end": 180, "color": 0},
+            {"type": "line", "xy": ["2/5", "1/3", "2/5", "2/3"], "color": 1},
+            {"type": "line", "xy": ["3/5", "1/3", "3/5", "2/3"], "color": 1},
+        ],
+    },
+    # Ninth Drawing: Sad face
+    {
+        "name": "sad_face",
+        "primitives": [
+            {"type": "arc", "xy": ["1/7", "6/9", "6/7", "8/9"],
+             "start": 180, "end": 0, "color": 2},
+            {"type": "line", "xy": ["2/5", "1/4", "2/5", "2/4"], "color": 3},
+            {"type": "line", "xy": ["3/5", "1/4", "3/5", "2/4"], "color": 3},
+        ],
+    },
+    # Tenth Drawing: Curve and cross
+    {
+        "name": "curve_and_cross",
+        "primitives": [
+            {"type": "arc", "xy": ["1/6", "4/7", "5/6", "6/7"],
+             "start": 180, "end": 0, "color": 0},
+            {"type": "arc", "xy": ["1/6", "3/7", "5/6", "5/7"],
+             "start": 0, "end": 180, "color": 3},
+            {"type": "line", "xy": ["1/2", "1/4", "1/2", "3/4"], "color": 1},
+            {"type": "line", "xy": ["1/5", "1/2", "4/5", "1/2"], "color": 2},
+        ],
+    },
+]
+
+
+def parse_fraction(value):
+    """
+    Converts a coordinate into a fraction of the canvas size
+    :param value:         "n/d" string or number between 0 and 1
+    :return:              The coordinate as a Fraction
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise TypeError(
+            'Wrong coordinate {!r}: It must be a "n/d" string or a'
+            ' number'.format(value)
+        )
+    fraction = Fraction(value)
+    if not 0 <= fraction <= 1:
+        raise ValueError(
+            'Wrong coordinate {!r}: It must be between 0 and 1'.format(value)
+        )
+    return fraction
+
+
+def parse_color(value):
+    """
+    Converts a JSON color reference into an index or a RandomColor
+    :param value:         Color index or {"random": slot}
+    """
+    if isinstance(value, dict):
+        if set(value) != {"random"}:
+            raise ValueError(
+                'Wrong color {!r}: Expected {{"random": slot}}'.format(value)
+            )
+        return RandomColor(int(value["random"]))
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise TypeError(
+            'Wrong color {!r}: It must be a color index'.format(value)
+        )
+    return value
+
+
+def parse_scene(data):
+    """
+    Validates a scene in dictionary format
+    :param data:          Scene as described in the module docstring
+    :return:              An immutable Scene
+    """
+    name = data.get("name")
+    if not name or not isinstance(name, str):
+        raise ValueError("Scene without a name: {!r}".format(data))
+
+    primitives = []
+    for raw in data.get("primitives", []):
+        kind = raw.get("type")
+        if kind not in PRIMITIVE_KINDS:
+            raise ValueError(
+                "Scene {}: Unknown primitive type {!r}".format(name, kind)
+            )
+
+        xy = tuple(parse_fraction(value) for value in raw["xy"])
+        if len(xy) != 4:
+            raise ValueError(
+                "Scene {}: A primitive needs 4 coordinates".format(name)
+            )
+
+        start = end = None
+        if kind == "arc":
+            start, end = raw["start"], raw["end"]
+
+        primitives.append(
+            Primitive(kind, xy, parse_color(raw["color"]), start, end))
+
+    return Scene(name, tuple(primitives))
+
+
+@lru_cache(maxsize=1024)
+def compile_scene(scene, sizex, sizey):
+    """
+    Resolves the fractional coordinates of a scene for a canvas size
+    :param scene:         Scene to compile
+    :param sizex:         Image size on X axis
+    :param sizey:         Image size on Y axis
+    :return:              A DrawPlan with pixel coordinates and the random
+                          slots in order of appearance
+    """
+    ops = []
+    slots = []
+    for primitive in scene.primitives:
+        x0, y0, x1, y1 = primitive.xy
+        xy = (
+            x0.numerator*sizex//x0.denominator,
+            y0.numerator*sizey//y0.denominator,
+            x1.numerator*sizex//x1.denominator,
+            y1.numerator*sizey//y1.denominator)
+        ops.append(DrawOp(
+            primitive.kind, xy, primitive.color,
+            primitive.start, primitive.end))
+        if (isinstance(primitive.color, RandomColor)
+                and primitive.color.slot not in slots):
+            slots.append(primitive.color.slot)
+
+    return DrawPlan(scene.name, sizex, sizey, tuple(ops), tuple(slots))
+
+
+def resolve_colors(plan, rng, color_count):
+    """
+    Returns the color index of every operation of a plan. Random slots are
+    drawn in order of appearance, each one different from the others
+    :param plan:          DrawPlan to resolve
+    :param rng:           Random generator providing randrange
+    :param color_count:   Size of the color array
+    """
+    if len(plan.slots) > color_count:
+        log.error("Scene {} uses more random colors than the color array"
+                  " has".format(plan.name))
+        raise ValueError
+
+    slots = {}
+    for slot in plan.slots:
+        index = rng.randrange(color_count)
+        while index in slots.values():
+            index = rng.randrange(color_count)
+        slots[slot] = index
+
+    colors = [
+        slots[op.color.slot] if isinstance(op.color, RandomColor)
+        else op.color
+        for op in plan.ops]
+
+    # Check that the desired index is obtainable
+    if colors and max(colors) >= color_count:
+        log.error("Desired color index goes beyond the color array")
+        raise ValueError
+
+    return colors
+
+
+def load_scenes(path):
+    """
+    Reads scenes from a JSON file
+    :param path:          JSON file with a list of scenes or an object with a
+                          "scenes" list
+    :return:              List of Scene
+    """
+    with open(path) as scene_file:
+        data = loads(scene_file.read())
+
+    if isinstance(data, dict):
+        data = data.get("scenes", [])
+
+    return [parse_scene(scene) for scene in data]
+
+
+# Registry of available scenes, in render order
+SCENES = OrderedDict(
+    (scene.name, scene)
+    for scene in (parse_scene(data) for data in BUILTIN_SCENES))
+
+
+def register_scene(scene):
+    """
+    Adds a scene to the registry, replacing any scene with the same name
+    :param scene:         Scene or scene in dictionary format
+    """
+    if not isinstance(scene, Scene):
+        scene = parse_scene(scene)
+    SCENES[scene.name] = scene
+    return scene
+
+
+def get_scenes(scene_files=None):
+    """
+    Returns the registered scenes plus the ones found in scene_files
+    :param scene_files:   Optional list of JSON scene files
+    :return:              List of Scene in render order
+    """
+    scenes = OrderedDict(SCENES)
+    for path in scene_files or []:
+        for scene in load_scenes(path):
+            log.debug("Loaded scene {} from {}".format(scene.name, path))
+            scenes[scene.name] = scene
+    return list(scenes.values())
+
+
+__all__ = [
+    'Scene', 'DrawPlan', 'compile_scene', 'resolve_colors', 'load_scenes',
+    'register_scene', 'get_scenes', 'SCENES',
+]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Derived random streams.
+
+A SeedSequence turns the "seed" JSON key into a tree of independent seeds,
+in the style of numpy.random.SeedSequence. Every node is addressed by the
+path of keys leading to it, for example ("scene", "simple_line") or
+("scene", "simple_line", "variant", 3), and its seed is a hash of the root
+entropy and that path. A stream therefore does not depend on how many
+other streams were drawn before it, which keeps the output identical for
+any number of workers and any execution order.
+"""
+
+import random
+from hashlib import sha256
+from json import dumps
+
+STATE_BITS = 64
+
+
+class SeedSequence:
+    """
+    Node of a tree of derived seeds
+
+    :entropy:      Root seed, a non negative integer
+    :spawn_key:    Tuple of strings and integers leading from the root to
+                   this node
+    """
+    def __init__(self, entropy, spawn_key=()):
+        if isinstance(entropy, bool) or not isinstance(entropy, int):
+            raise TypeError(
+                "The seed must be an integer, not {!r}".format(entropy))
+        if entropy < 0:
+            raise ValueError("The seed must not be negative")
+        for key in spawn_key:
+            if not isinstance(key, (str, int)):
+                raise TypeError(
+                    "Spawn keys must be strings or integers, not {!r}".format(
+                        key))
+
+        self.entropy = entropy
+        self.spawn_key = tuple(spawn_key)
+
+    def child(self, *key):
+        """
+        Returns the node found following key from this one
+        """
+        return SeedSequence(self.entropy, self.spawn_key + key)
+
+    def spawn(self, count):
+        """
+        Returns count children numbered from 0
+        """
+        return [self.child(index) for index in range(count)]
+
+    @property
+    def seed(self):
+        """
+        Integer seed of this node
+        """
+        # JSON keeps 1 and "1" apart
+        digest = sha256(dumps(
+            [self.entropy, list(self.spawn_key)]).encode("utf-8")).digest()
+        return int.from_bytes(digest[:STATE_BITS // 8], "big")
+
+    def random(self):
+        """
+        New random.Random seeded by this node
+        """
+        return random.Random(self.seed)
+
+    def __repr__(self):
+        return "SeedSequence({!r}, {!r})".format(
+            self.entropy, self.spawn_key)
+
+
+def scene_seed(root, scene_name, variant=None):
+    """
+    Seed of a scene, or of one of its variants
+    :param root:          Root SeedSequence, usually from the "seed" key
+    :param scene_name:    Name of the scene
+    :param variant:       Optional variant number
+    """
+    node = root.child("scene", scene_name)
+    if variant is not None:
+        node = node.child("variant", variant)
+    return node.seed
+
+
+def printer_seed(root):
+    """
+    Seed of the random generator an ImcrPrinter uses outside of scenes
+    """
+    return root.child("printer").seed
+
+
+__all__ = ['SeedSequence', 'scene_seed', 'printer_seed']
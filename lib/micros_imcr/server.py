@@ -0,0 +1,649 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent render daemon.
+
+The daemon keeps Pillow imported and its printers and canvases warm, and
+answers render requests over HTTP/1.1 on a Unix domain socket or a
+localhost TCP port. The body of a request holds the same configuration as
+a data.json file::
+
+    POST /render          {"config": {...}, "scenes": [...],
+                           "scene_files": [...], "output_dir": "/abs/dir"}
+                          Renders the scenes, every one of them when
+                          "scenes" is missing. With "output_dir" the files
+                          are written there and their paths returned,
+                          otherwise the encoded images are returned in
+                          base64
+    POST /render/NAME     {"config": {...}}
+                          Returns the encoded image of one scene as is
+    GET /stats            Request and cache counters
+
+Encoded images are kept in an in-memory LRU cache keyed by the hash of
+everything that decides their bytes, and the scenes are drawn on a worker
+pool. Running micros_imcr with --server ADDRESS sends its configuration to
+the daemon instead of rendering it.
+
+The daemon trusts its clients as much as the user running it: a request
+may read any scene file and write into any directory that user can. It
+is meant for clients of the same user on the same host, so it only
+listens on a Unix domain socket or a loopback address, and a Unix socket
+should be left in a directory other users can not reach.
+"""
+
+import asyncio
+import base64
+import http.client
+import socket
+from collections import OrderedDict
+from json import dumps, loads
+from logging import getLogger
+from mimetypes import guess_type
+from os import makedirs, remove, stat
+from os.path import abspath, isabs, isdir, join, realpath
+from stat import S_ISSOCK
+from urllib.parse import unquote
+
+from .cache import render_key
+from .main import (
+    get_overrides, get_seeds, output_path, render_image, size_configs)
+from .scenes import compile_scene, get_scenes
+
+log = getLogger(__name__)
+
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_HOST = "127.0.0.1"
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+
+class MemoryCache:
+    """
+    LRU cache of encoded images held in memory
+
+    :max_bytes:    Size limit, the least recently used images are evicted
+                   first
+    :bytes:        Size of the cached images
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the cached image of key, or None
+        """
+        data = self.__entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        """
+        Adds an image, evicting old ones over max_bytes
+        """
+        if len(data) > self.max_bytes or key in self.__entries:
+            return
+        self.__entries[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.__entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.__entries),
+            "bytes": self.bytes,
+        }
+
+
+def _warm():
+    """
+    Imports the rendering modules in a worker
+    """
+    from . import backends  # noqa: F401
+
+
+class RenderServer:
+    """
+    Render requests handler
+
+    :jobs:         Number of worker processes. With 1 the scenes are drawn
+                   on a thread of the daemon itself
+    :cache:        MemoryCache of the encoded images
+    :requests:     Number of requests handled
+    """
+    def __init__(self, jobs=1, cache_bytes=DEFAULT_CACHE_BYTES):
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self.__executor = ProcessPoolExecutor(max_workers=jobs)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            self.__executor = ThreadPoolExecutor(max_workers=1)
+
+        self.jobs = jobs
+        self.cache = MemoryCache(cache_bytes)
+        self.requests = 0
+        self.__inflight = {}
+
+    async def warm(self):
+        """
+        Starts the workers and imports Pillow in them
+        """
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.__executor, _warm)
+            for _ in range(self.jobs)])
+
+    def close(self):
+        self.__executor.shutdown()
+
+    async def image(self, json_data, plan, seed):
+        """
+        Encoded image of a scene, from the cache or rendered by a worker.
+        Equal images requested at the same time are rendered once
+        :return:              (data, True when served from the cache)
+        """
+        key = render_key(json_data, plan, seed)
+        data = self.cache.get(key)
+        if data is not None:
+            return data, True
+
+        future = self.__inflight.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(
+                self.__executor, render_image, json_data, plan, seed,
+                "bytes")
+            self.__inflight[key] = future
+            future.add_done_callback(
+                lambda _: self.__inflight.pop(key, None))
+
+        # A client going away must not cancel the render for the others
+        data = await asyncio.shield(future)
+        self.cache.put(key, data)
+        return data, False
+
+    async def render(self, request):
+        """
+        Renders the scenes of a request
+        :param request:       Request body in dictionary format
+        :return:              List of (scene name, data, cached)
+        :raise LookupError:   When a requested scene does not exist
+        """
+        json_data = request["config"]
+        if not isinstance(json_data, dict):
+            raise ValueError("The config must be a JSON object")
+        if size_configs(json_data)[0][0] is not None:
+            raise ValueError(
+                "The daemon renders a single size, sizex and sizey must be "
+                "numbers")
+
+        plans = [
+            compile_scene(scene, json_data["sizex"], json_data["sizey"])
+            for scene in get_scenes(request.get("scene_files"))]
+        seeds = get_seeds(json_data, plans)
+
+        names = request.get("scenes")
+        if names:
+            known = dict((plan.name, plan) for plan in plans)
+            for name in names:
+                if name not in known:
+                    raise LookupError("Unknown scene {!r}".format(name))
+            selected = [
+                (plan, seed) for plan, seed in zip(plans, seeds)
+                if plan.name in names]
+        else:
+            selected = list(zip(plans, seeds))
+
+        images = await asyncio.gather(*[
+            self.image(json_data, plan, seed) for plan, seed in selected])
+        return [
+            (plan.name, data, cached)
+            for (plan, _), (data, cached) in zip(selected, images)]
+
+    async def save(self, json_data, images, output_dir):
+        """
+        Writes rendered images to output_dir
+        :return:              List of paths
+        :raise ValueError:    When a file would be written outside of
+                              output_dir
+        """
+        if not isabs(output_dir):
+            raise ValueError("output_dir must be an absolute path")
+        # Scene names come from the scene files of the request
+        for name, _, _ in images:
+            if "/" in name or "\\" in name or ".." in name:
+                raise ValueError("Wrong scene name {!r}".format(name))
+
+        def write():
+            if not isdir(output_dir):
+                makedirs(output_dir)
+            root = join(realpath(output_dir), "")
+            paths = []
+            for name, data, _ in images:
+                path = output_path(json_data, output_dir, name)
+                if not realpath(path).startswith(root):
+                    raise ValueError(
+                        "Scene {!r} is saved outside of {}".format(
+                            name, output_dir))
+                with open(path, "wb") as image_file:
+                    image_file.write(data)
+                paths.append(path)
+            return paths
+
+        return await asyncio.get_event_loop().run_in_executor(None, write)
+
+    async def dispatch(self, method, target, body):
+        """
+        Handles one HTTP request
+        :return:              (status, content type, payload bytes)
+        """
+        self.requests += 1
+        try:
+            if method == "GET" and target == "/stats":
+                return 200, "application/json", dumps(
+                    self.stats()).encode("utf-8")
+            if method != "POST" or not target.startswith("/render"):
+                return self.error(
+                    404, LookupError("No {} {}".format(method, target)))
+
+            request = loads(body.decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("The request must be a JSON object")
+
+            if target != "/render":
+                name = unquote(target[len("/render/"):])
+                images = await self.render(dict(request, scenes=[name]))
+                _, data, _ = images[0]
+                content_type = guess_type(
+                    "image." + request["config"]["format"])[0]
+                return 200, content_type or "application/octet-stream", data
+
+            images = await self.render(request)
+            if request.get("output_dir"):
+                paths = await self.save(
+                    request["config"], images, request["output_dir"])
+                entries = [
+                    {"scene": name, "bytes": len(data), "cached": cached,
+                     "path": path}
+                    for (name, data, cached), path in zip(images, paths)]
+            else:
+                entries = [
+                    {"scene": name, "bytes": len(data), "cached": cached,
+                     "data": base64.b64encode(data).decode("ascii")}
+                    for name, data, cached in images]
+            return 200, "application/json", dumps(
+                {"images": entries}).encode("utf-8")
+
+        except (KeyError, ValueError, TypeError) as error:
+            return self.error(400, error)
+        except LookupError as error:
+            # Unknown scenes, KeyError being handled above
+            return self.error(404, error)
+        except Exception as error:
+            log.exception("Request {} {} failed".format(method, target))
+            return self.error(500, error)
+
+    @staticmethod
+    def error(status, error):
+        return status, "application/json", dumps(
+            {"error": repr(error)}).encode("utf-8")
+
+    async def handle(self, reader, writer):
+        """
+        Serves the HTTP/1.1 requests of one connection
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                parts = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+
+                # The body of a malformed request can not be skipped, the
+                # connection is closed after the error
+                if len(parts) != 3:
+                    status, content_type, payload = self.error(
+                        400, ValueError("Malformed request line"))
+                    keep_alive = False
+                elif length < 0:
+                    status, content_type, payload = self.error(
+                        400, ValueError("Invalid Content-Length {!r}".format(
+                            headers["content-length"])))
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    body = await reader.readexactly(length) if length else b""
+                    status, content_type, payload = await self.dispatch(
+                        method, target, body)
+                    keep_alive = (
+                        version == "HTTP/1.1"
+                        and headers.get("connection", "").lower() != "close")
+
+                writer.write((
+                    "HTTP/1.1 {} {}\r\n"
+                    "Content-Type: {}\r\n"
+                    "Content-Length: {}\r\n"
+                    "Connection: {}\r\n\r\n").format(
+                        status, STATUS_TEXT[status], content_type,
+                        len(payload), "keep-alive" if keep_alive else "close"
+                    ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def stats(self):
+        """
+        Request and cache counters
+        """
+        return {
+            "requests": self.requests,
+            "jobs": self.jobs,
+            "inflight": len(self.__inflight),
+            "cache": self.cache.stats(),
+        }
+
+
+def parse_address(address):
+    """
+    Reads a daemon address: "unix:PATH", a path containing "/", "PORT",
+    "HOST:PORT" or "http://HOST:PORT". The daemon writes files where its
+    requests say, so HOST must be a loopback address or "localhost"
+    :return:              ("unix", path) or ("tcp", (host, port))
+    :raise ValueError:    When the address can not be read or HOST is not a
+                          loopback host
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    if address.startswith("http://"):
+        address = address[len("http://"):].rstrip("/")
+    elif "/" in address:
+        return "unix", address
+
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("Wrong server address {!r}".format(address))
+    host = host.strip("[]") or DEFAULT_HOST
+    if not _is_loopback(host):
+        raise ValueError(
+            "The daemon only listens on loopback hosts, not {!r}".format(
+                host))
+    return "tcp", (host, int(port))
+
+
+def _is_loopback(host):
+    from ipaddress import ip_address
+
+    if host == "localhost":
+        return True
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve(address, jobs=1, cache_bytes=DEFAULT_CACHE_BYTES):
+    """
+    Runs the daemon until it is interrupted
+    :param address:       Listening address, see parse_address
+    :param jobs:          Number of worker processes
+    :param cache_bytes:   Size limit of the in-memory cache
+    """
+    kind, location = parse_address(address)
+    server = RenderServer(jobs, cache_bytes)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if kind == "unix":
+        # Replace the socket left by a daemon that did not shut down
+        try:
+            if S_ISSOCK(stat(location).st_mode):
+                remove(location)
+        except FileNotFoundError:
+            pass
+        listening = asyncio.start_unix_server(server.handle, path=location)
+    else:
+        listening = asyncio.start_server(server.handle, *location)
+
+    listener = loop.run_until_complete(listening)
+    loop.run_until_complete(server.warm())
+    log.info("Serving on {}".format(address))
+
+    try:
+        import signal
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    except (ImportError, NotImplementedError):
+        pass
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.close()
+        loop.close()
+        if kind == "unix":
+            try:
+                remove(location)
+            except OSError:
+                pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection over a Unix domain socket
+    """
+    def __init__(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RenderClient:
+    """
+    Client of the render daemon, keeping its connection open between
+    requests
+
+    :address:      Daemon address, see parse_address
+    """
+    def __init__(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        kind, location = parse_address(address)
+        if kind == "unix":
+            self.__connection = UnixHTTPConnection(location, timeout)
+        else:
+            self.__connection = http.client.HTTPConnection(
+                location[0], location[1], timeout=timeout)
+        self.address = address
+
+    def request(self, method, target, body=None):
+        """
+        Sends a request
+        :return:              Response payload bytes
+        """
+        payload = None if body is None else dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        self.__connection.request(method, target, payload, headers)
+        response = self.__connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError("Render server answered {}: {}".format(
+                response.status, data.decode("utf-8", "replace")))
+        return data
+
+    def render(self, config, scenes=None, output_dir=None,
+               scene_files=None):
+        """
+        Renders scenes of a configuration
+        :param config:        JSON data in dictionary format
+        :param scenes:        Optional list of scene names, all by default
+        :param output_dir:    When given the daemon writes the files there
+        :param scene_files:   Optional list of JSON files with more scenes
+        :return:              List of dictionaries with "scene", "bytes",
+                              "cached" and either "path" or "data" bytes
+        """
+        body = {"config": config}
+        if scenes:
+            body["scenes"] = list(scenes)
+        if output_dir is not None:
+            body["output_dir"] = abspath(output_dir)
+        if scene_files:
+            body["scene_files"] = [abspath(path) for path in scene_files]
+
+        images = loads(self.request("POST", "/render", body))["images"]
+        for image in images:
+            if "data" in image:
+                image["data"] = base64.b64decode(image["data"])
+        return images
+
+    def render_scene(self, config, scene):
+        """
+        Encoded image of one scene
+        """
+        return self.request(
+            "POST", "/render/{}".format(scene), {"config": config})
+
+    def stats(self):
+        return loads(self.request("GET", "/stats"))
+
+    def close(self):
+        self.__connection.close()
+
+
+def micros_imcr_client(args):
+    """
+    Sends the configuration of args.path_to_json to the daemon at
+    args.server, which writes the images to args.output_dir
+    :return:              Exit code
+    """
+    with open(args.path_to_json) as json_file:
+        json_data = loads(json_file.read())
+    json_data.update(get_overrides(args))
+
+    client = RenderClient(args.server)
+    try:
+        images = client.render(
+            json_data, output_dir=getattr(args, "output_dir", "."),
+            scene_files=getattr(args, "scene_files", None))
+    finally:
+        client.close()
+
+    log.info("{} images written by {}, {} from its cache".format(
+        len(images), args.server, sum(image["cached"] for image in images)))
+    return 0
+
+
+def parse_args(argv=None):
+    """
+    Argument parsing of the daemon script
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='micros_imcr render daemon')
+    parser.add_argument(
+        'address',
+        help='Listening address: unix:PATH or a path for a Unix domain'
+             ' socket, PORT or HOST:PORT for HTTP over TCP, HOST being a'
+             ' loopback address',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes drawing the images',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+        metavar='MB',
+        help='Size of the in-memory cache of encoded images. Defaults to'
+             ' 256',
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count',
+        default=0,
+        help='Increase verbosity level',
+    )
+
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('jobs must be a positive integer')
+    if args.cache_size < 0:
+        parser.error('cache size must not be negative')
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point of the daemon script
+    """
+    import logging
+    from .args import FORMAT, V_LEVELS
+
+    args = parse_args(argv)
+    logging.basicConfig(
+        format=FORMAT, level=V_LEVELS.get(args.verbose, logging.DEBUG))
+    serve(args.address, args.jobs, args.cache_size * 1024 * 1024)
+    return 0
+
+
+__all__ = [
+    'RenderServer', 'RenderClient', 'MemoryCache', 'serve',
+    'micros_imcr_client', 'main']
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sweep mode: render the cartesian product of the list-valued JSON keys.
+
+Every key holding a list is an axis of the sweep, the color keys being
+axes when they hold a list of colors. Unlike a plain run, the lists of
+"sizex" and "sizey" are crossed instead of paired. Each combination is a
+configuration saved in its own directory under the output directory, named
+after its axis values, and sweep.json maps the directories to the values.
+
+The (configuration, scene) pairs of the whole sweep are a single list of
+jobs ordered by cost, the largest canvases first. A process pool hands the
+next job to whichever worker is idle, so the small images fill in around
+the big ones and the last job to finish is a small one.
+"""
+
+import random
+import re
+from collections import namedtuple
+from itertools import product
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs
+from os.path import basename, isdir, join
+from time import time
+
+from .batch import BatchSummary, format_summary
+from .main import (
+    get_max_memory, get_overrides, get_seeds, open_cache, open_metrics,
+    output_path, render_scene)
+from .scenes import compile_scene, get_scenes
+
+log = getLogger(__name__)
+
+
+COLOR_KEYS = ("color1", "color2", "color3", "color4")
+
+# One image of a sweep. cost orders the jobs, largest first
+SweepJob = namedtuple(
+    "SweepJob", ["cost", "config", "json_data", "plan", "seed", "output_dir"])
+
+
+def sweep_axes(json_data):
+    """
+    Returns the axes of a sweep configuration
+    :param json_data:     Is the json data in dictionary format
+    :return:              List of (key, values) sorted by key
+    """
+    axes = []
+    for key in sorted(json_data):
+        value = json_data[key]
+        if not isinstance(value, list):
+            continue
+        if not value:
+            raise ValueError("Empty list of values for {!r}".format(key))
+        # A single color is a list of numbers
+        if key in COLOR_KEYS and not isinstance(value[0], list):
+            continue
+        axes.append((key, value))
+    return axes
+
+
+def _label(value):
+    if isinstance(value, list):
+        value = ".".join(str(item) for item in value)
+    return re.sub(r"[^\w.-]", "_", str(value))
+
+
+def expand_sweep(json_data):
+    """
+    Expands the cartesian product of the axes of a configuration
+    :param json_data:     Is the json data in dictionary format
+    :return:              List of (name, values, json data). name is made of
+                          the axis values, values is the dictionary of axis
+                          values of the configuration
+    """
+    axes = sweep_axes(json_data)
+    if not axes:
+        return [("", {}, json_data)]
+
+    keys = [key for key, _ in axes]
+    configs = []
+    for combination in product(*[values for _, values in axes]):
+        values = dict(zip(keys, combination))
+        name = "_".join(
+            "{}-{}".format(key, _label(value))
+            for key, value in zip(keys, combination))
+        configs.append((name, values, dict(json_data, **values)))
+    return configs
+
+
+def job_cost(json_data, plan):
+    """
+    Estimated cost of rendering a plan. The canvas reset and the encoding
+    are proportional to the pixel count, which dominates the primitives
+    """
+    return (json_data["sizex"] * json_data["sizey"], len(plan.ops))
+
+
+def plan_sweep(json_data, output_dir=".", scene_files=None):
+    """
+    Lists the jobs of a sweep
+    :param json_data:     Is the json data in dictionary format
+    :param output_dir:    Base directory of the sweep
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :return:              (list of (name, values), list of SweepJob sorted
+                          by decreasing cost)
+    """
+    # Every configuration draws the same random colors
+    if json_data.get("seed") is None:
+        json_data = dict(json_data, seed=random.getrandbits(64))
+
+    scenes = get_scenes(scene_files)
+    configs = []
+    jobs = []
+    for name, values, config_data in expand_sweep(json_data):
+        configs.append((name, values))
+        plans = [
+            compile_scene(scene, config_data["sizex"], config_data["sizey"])
+            for scene in scenes]
+        config_dir = join(output_dir, name) if name else output_dir
+        for plan, seed in zip(plans, get_seeds(config_data, plans)):
+            jobs.append(SweepJob(
+                job_cost(config_data, plan), name, config_data, plan, seed,
+                config_dir))
+
+    # sorted is stable, equal costs keep the configuration order
+    jobs.sort(key=lambda job: job.cost, reverse=True)
+    return configs, jobs
+
+
+def run_sweep(json_data, output_dir=".", jobs=1, scene_files=None,
+              overrides=None, cache=None, metrics=None, max_memory=None):
+    """
+    Renders every configuration of a sweep. A failing configuration does
+    not stop the sweep
+    :param json_data:     Is the json data in dictionary format
+    :param output_dir:    Base directory for the outputs
+    :param jobs:          Number of worker processes
+    :param scene_files:   Optional list of JSON files with additional scenes
+    :param overrides:     Optional JSON keys replacing the ones of json_data
+    :param cache:         Optional RenderCache
+    :param metrics:       Optional MetricsRecorder, the scenes are labeled
+                          with their configuration name
+    :param max_memory:    Optional memory budget in bytes. Jobs over it
+                          fail without being rendered, and the pool only
+                          runs as many jobs at once as fit in it
+    :return:              A BatchSummary. failures is a list of
+                          (config name, error message)
+    """
+    if overrides:
+        json_data = dict(json_data, **overrides)
+
+    start = time()
+    configs, sweep_jobs = plan_sweep(json_data, output_dir, scene_files)
+    for directory in set(job.output_dir for job in sweep_jobs) | {output_dir}:
+        if not isdir(directory):
+            makedirs(directory)
+    with open(join(output_dir, "sweep.json"), "w") as index_file:
+        index_file.write(dumps(
+            dict((name or ".", values) for name, values in configs),
+            indent=2, sort_keys=True))
+
+    # Skip the scenes found in the cache
+    pending = []
+    keys = {}
+    images = 0
+    for job in sweep_jobs:
+        if cache is None:
+            pending.append(job)
+            continue
+        key = cache.key(job.json_data, job.plan, job.seed)
+        path = output_path(job.json_data, job.output_dir, job.plan.name)
+        if cache.fetch(key, path):
+            images += 1
+            continue
+        keys[id(job)] = key
+        pending.append(job)
+
+    failures = {}
+    measure = metrics is not None
+
+    def done(job, result):
+        key = keys.get(id(job))
+        path = output_path(job.json_data, job.output_dir, job.plan.name)
+        if key is not None:
+            cache.store(key, path)
+        if measure:
+            metrics.add(
+                result, path, format=job.json_data["format"],
+                **dict(metrics.labels, config=job.config or "."))
+
+    def failed(job, error):
+        log.error("Scene {} of configuration {} failed: {!r}".format(
+            job.plan.name, job.config or ".", error))
+        failures.setdefault(job.config or ".", repr(error))
+
+    budget = None
+    if max_memory is not None:
+        from .planner import MemoryBudget, canvas_memory
+
+        budget = MemoryBudget(max_memory)
+        memories = {}
+        admitted = []
+        for job in pending:
+            memory = memories[id(job)] = canvas_memory(job.json_data)
+            try:
+                budget.check(job.config or ".", memory)
+            except ValueError as error:
+                failed(job, error)
+                continue
+            admitted.append(job)
+        pending = admitted
+
+    if jobs <= 1:
+        for job in pending:
+            try:
+                result = render_scene(
+                    job.json_data, job.plan, job.seed, job.output_dir,
+                    measure=measure)
+            except Exception as error:
+                failed(job, error)
+                continue
+            done(job, result)
+            images += 1
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            # Submitted in cost order, idle workers take the next job
+            futures = {}
+            for job in pending:
+                call = (
+                    render_scene, job.json_data, job.plan, job.seed,
+                    job.output_dir)
+                if budget is None:
+                    future = executor.submit(*call, measure=measure)
+                else:
+                    future = budget.submit(
+                        executor, memories[id(job)], *call, measure=measure)
+                futures[future] = job
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failed(job, error)
+                    continue
+                done(job, result)
+                images += 1
+        finally:
+            executor.shutdown()
+
+    return BatchSummary(
+        len(configs), images, sorted(failures.items()), time() - start)
+
+
+def micros_imcr_sweep(args):
+    """
+    Sweep call of the IMCR package. Every list of args.path_to_json is an
+    axis of the sweep
+    :return:              Exit code, 1 when any configuration failed
+    """
+    with open(args.path_to_json) as json_file:
+        json_data = loads(json_file.read())
+
+    cache = open_cache(args)
+    metrics = open_metrics(args)
+    if metrics is not None:
+        metrics.labels["sweep"] = basename(args.path_to_json)
+    summary = run_sweep(
+        json_data,
+        output_dir=getattr(args, "output_dir", "."),
+        jobs=getattr(args, "jobs", 1) or 1,
+        scene_files=getattr(args, "scene_files", None),
+        overrides=get_overrides(args),
+        cache=cache,
+        metrics=metrics,
+        max_memory=get_max_memory(args))
+
+    print(format_summary(summary))
+    if cache is not None:
+        from .cache import format_stats
+
+        cache.save_stats()
+        print(format_stats(cache.stats()))
+    if metrics is not None:
+        metrics.write(args.metrics)
+    return 1 if summary.failures else 0
+
+
+__all__ = [
+    'sweep_axes', 'expand_sweep', 'plan_sweep', 'run_sweep',
+    'micros_imcr_sweep']
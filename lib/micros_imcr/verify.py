@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Golden image verification.
+
+A manifest stores, for every image of a fixture directory, the digest of
+its file and the digest of its decoded pixels::
+
+    micros_imcr_verify record fixtures/ -o fixtures/pixels.json
+    micros_imcr_verify check fixtures/pixels.json new_renders/
+    micros_imcr_verify check fixtures/pixels.json data.json
+
+Files equal to the fixture byte by byte are accepted without decoding.
+Otherwise the pixels are decoded and hashed, so a different encoder
+setting giving the same pixels still passes. When the pixels differ and
+the fixture image is available, a per-pixel diff reports how many pixels
+changed and their bounding box.
+
+The framebuffer formats can not be decoded, their file digest is used as
+the pixel digest.
+"""
+
+from collections import namedtuple
+from hashlib import sha256
+from io import BytesIO
+from json import dumps, loads
+from logging import getLogger
+from os import sep, walk
+from os.path import dirname, isdir, isfile, join, relpath, splitext
+from time import time
+
+log = getLogger(__name__)
+
+
+MANIFEST_NAME = "pixels.json"
+MANIFEST_VERSION = 1
+
+# Extensions of the files written by the package
+IMAGE_EXTENSIONS = (
+    "png", "jpg", "jpeg", "bmp", "gif", "tif", "tiff", "webp", "ppm",
+    "bin", "h")
+
+# Hex digits kept of every sha256 digest
+DIGEST_LENGTH = 32
+
+PixelDigest = namedtuple("PixelDigest", ["file", "pixels", "size"])
+
+# reason is "missing", "unexpected", "size" or "pixels". pixels and bbox
+# are the count and the (left, upper, right, lower) box of the changed
+# pixels, None when the fixture image is not available
+Mismatch = namedtuple("Mismatch", ["name", "reason", "pixels", "bbox"])
+
+VerifySummary = namedtuple(
+    "VerifySummary", ["checked", "mismatches", "elapsed"])
+
+
+def _decode(data):
+    """
+    Decoded RGB or RGBA image of an encoded file, None for the formats
+    Pillow can not read
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except OSError:
+        return None
+    if image.mode not in ("RGB", "RGBA"):
+        # Indexed and RGB files of the same drawing give the same digest
+        image = image.convert("RGB")
+    return image
+
+
+def pixel_digest(data, known_file=None):
+    """
+    Digests of an encoded image
+    :param data:          Bytes of the encoded file
+    :param known_file:    File digest of the manifest. When data matches
+                          it, the pixels are not decoded
+    :return:              PixelDigest, pixels and size are None when data
+                          matches known_file
+    """
+    file_digest = sha256(data).hexdigest()[:DIGEST_LENGTH]
+    if file_digest == known_file:
+        return PixelDigest(file_digest, None, None)
+
+    image = _decode(data)
+    if image is None:
+        return PixelDigest(file_digest, file_digest, None)
+
+    digest = sha256("{} {}x{}\n".format(
+        image.mode, image.size[0], image.size[1]).encode("ascii"))
+    digest.update(image.tobytes())
+    return PixelDigest(
+        file_digest, digest.hexdigest()[:DIGEST_LENGTH], list(image.size))
+
+
+def pixel_diff(expected, actual):
+    """
+    Per-pixel comparison of two images of the same size
+    :param expected:      PIL image of the fixture
+    :param actual:        PIL image of the new render
+    :return:              (count, bbox) of the pixels with any band
+                          changed, bbox is None when they are equal
+    """
+    from PIL import ImageChops
+
+    if expected.size != actual.size:
+        raise ValueError("Can not diff a {}x{} image with a {}x{} one".format(
+            expected.size[0], expected.size[1],
+            actual.size[0], actual.size[1]))
+    if actual.mode != expected.mode:
+        actual = actual.convert(expected.mode)
+
+    # The largest band difference of every pixel
+    bands = ImageChops.difference(expected, actual).split()
+    changed = bands[0]
+    for band in bands[1:]:
+        changed = ImageChops.lighter(changed, band)
+
+    count = expected.size[0] * expected.size[1] - changed.histogram()[0]
+    return count, changed.getbbox()
+
+
+def find_images(directory):
+    """
+    Relative names, with "/" separators, of the images under a directory
+    :return:              Sorted list of names
+    """
+    names = []
+    for root, _, files in walk(directory):
+        for file_name in files:
+            extension = splitext(file_name)[1][1:].lower()
+            if extension in IMAGE_EXTENSIONS:
+                names.append(
+                    relpath(join(root, file_name), directory).replace(
+                        sep, "/"))
+    return sorted(names)
+
+
+def _digest_file(path, known_file=None):
+    with open(path, "rb") as image_file:
+        return pixel_digest(image_file.read(), known_file)
+
+
+def _map(function, tasks, jobs):
+    """
+    Results of function over the argument tuples of tasks, in task order
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return [function(*task) for task in tasks]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(
+            function, *zip(*tasks),
+            chunksize=max(1, len(tasks) // (4 * jobs))))
+
+
+def record_manifest(directory, manifest_path=None, jobs=1):
+    """
+    Writes the digests of every image of a fixture directory
+    :param directory:     Directory with the golden images
+    :param manifest_path: Output file, MANIFEST_NAME inside directory by
+                          default
+    :param jobs:          Number of worker processes hashing the images
+    :return:              The manifest in dictionary format
+    """
+    if not isdir(directory):
+        raise ValueError("Fixture directory {!r} not found".format(directory))
+    if manifest_path is None:
+        manifest_path = join(directory, MANIFEST_NAME)
+
+    names = find_images(directory)
+    digests = _map(
+        _digest_file, [(join(directory, name),) for name in names], jobs)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "images": dict(
+            (name, digest._asdict()) for name, digest in zip(names, digests)),
+    }
+    with open(manifest_path, "w") as manifest_file:
+        manifest_file.write(dumps(manifest, indent=1, sort_keys=True))
+    log.info("Recorded {} images in {}".format(len(names), manifest_path))
+    return manifest
+
+
+def load_manifest(manifest_path):
+    """
+    Reads a manifest written by record_manifest
+    :return:              Dictionary of image name to its digests
+    """
+    with open(manifest_path) as manifest_file:
+        manifest = loads(manifest_file.read())
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version {!r} in {}".format(
+            manifest.get("version"), manifest_path))
+    return manifest["images"]
+
+
+def _compare(entries, digests, load_actual, reference_dir):
+    """
+    Mismatches of the new digests against the manifest entries
+    :param digests:       Dictionary of image name to its PixelDigest
+    :param load_actual:   Function returning the encoded bytes of a new
+                          image, used to diff mismatching pixels
+    :param reference_dir: Optional directory with the fixture images
+    """
+    mismatches = [
+        Mismatch(name, "missing", None, None)
+        for name in sorted(set(entries) - set(digests))]
+    mismatches.extend(
+        Mismatch(name, "unexpected", None, None)
+        for name in sorted(set(digests) - set(entries)))
+
+    for name in sorted(set(entries) & set(digests)):
+        entry, digest = entries[name], digests[name]
+        if digest.pixels is None or digest.pixels == entry["pixels"]:
+            continue
+        if digest.size != entry["size"]:
+            mismatches.append(Mismatch(name, "size", None, None))
+            continue
+
+        fixture = None if reference_dir is None else join(
+            reference_dir, *name.split("/"))
+        if fixture is None or not isfile(fixture) or digest.size is None:
+            mismatches.append(Mismatch(name, "pixels", None, None))
+            continue
+        with open(fixture, "rb") as fixture_file:
+            expected = _decode(fixture_file.read())
+        count, bbox = pixel_diff(expected, _decode(load_actual(name)))
+        mismatches.append(Mismatch(name, "pixels", count, bbox))
+
+    return sorted(mismatches)
+
+
+def verify_directory(manifest_path, directory, reference_dir=None, jobs=1):
+    """
+    Checks the images of a directory against a manifest
+    :param manifest_path: Manifest written by record_manifest
+    :param directory:     Directory with the new renders
+    :param reference_dir: Directory with the fixture images used to diff
+                          mismatching pixels, the directory of the
+                          manifest by default
+    :param jobs:          Number of worker processes hashing the images
+    :return:              VerifySummary
+    """
+    start = time()
+    entries = load_manifest(manifest_path)
+    if reference_dir is None:
+        reference_dir = dirname(manifest_path) or "."
+
+    names = find_images(directory)
+    digests = _map(_digest_file, [
+        (join(directory, name), entries.get(name, {}).get("file"))
+        for name in names], jobs)
+
+    def load_actual(name):
+        with open(join(directory, name), "rb") as image_file:
+            return image_file.read()
+
+    mismatches = _compare(
+        entries, dict(zip(names, digests)), load_actual, reference_dir)
+    return VerifySummary(len(names), mismatches, time() - start)
+
+
+def verify_config(manifest_path, config, reference_dir=None, jobs=1,
+                  scene_files=None, **overrides):
+    """
+    Renders a configuration in memory and checks it against a manifest
+    :param manifest_path: Manifest written by record_manifest
+    :param config:        JSON data in dictionary format or path to a JSON
+                          file
+    :param reference_dir: Directory with the fixture images used to diff
+                          mismatching pixels, the directory of the
+                          manifest by default
+    :param jobs:          Number of worker processes rendering the images
+    :param scene_files:   List of JSON files with additional scene
+                          definitions
+    :param overrides:     JSON keys replacing the ones of the configuration
+    :return:              VerifySummary
+    """
+    from .imcr_tool import micros_imcr_images
+
+    start = time()
+    entries = load_manifest(manifest_path)
+    if reference_dir is None:
+        reference_dir = dirname(manifest_path) or "."
+    if not isinstance(config, dict):
+        with open(config) as json_file:
+            config = loads(json_file.read())
+    extension = overrides.get("format", config["format"])
+
+    images, digests = {}, {}
+    for scene, data in micros_imcr_images(
+            config, "bytes", jobs, scene_files, **overrides):
+        name = "{}.{}".format(scene, extension)
+        images[name] = data
+        digests[name] = pixel_digest(
+            data, entries.get(name, {}).get("file"))
+
+    mismatches = _compare(entries, digests, images.get, reference_dir)
+    return VerifySummary(len(digests), mismatches, time() - start)
+
+
+def format_mismatch(mismatch):
+    """
+    Human readable line of a Mismatch
+    """
+    if mismatch.pixels is None:
+        return "{}: {}".format(mismatch.name, mismatch.reason)
+    return "{}: {} pixels differ in {}".format(
+        mismatch.name, mismatch.pixels, mismatch.bbox)
+
+
+def parse_args(argv=None):
+    """
+    Argument parsing of the verification script
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='micros_imcr golden image checks')
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count',
+        default=0,
+        help='Increase verbosity level',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes. Defaults to 1',
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    record = commands.add_parser(
+        'record', help='Write the digests of a fixture directory')
+    record.add_argument('directory', help='Directory with the golden images')
+    record.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Manifest file. Defaults to {} inside the directory'.format(
+            MANIFEST_NAME),
+    )
+
+    check = commands.add_parser(
+        'check', help='Check new renders against a manifest')
+    check.add_argument('manifest', help='Manifest file')
+    check.add_argument(
+        'target',
+        help='Directory with the new renders, or JSON file rendered in '
+             'memory',
+    )
+    check.add_argument(
+        '--reference',
+        default=None,
+        help='Directory with the golden images used to diff mismatches. '
+             'Defaults to the directory of the manifest',
+    )
+    check.add_argument(
+        '-s', '--scene-files',
+        nargs='+',
+        default=[],
+        help='JSON files with additional scenes of a JSON target',
+    )
+
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error(
+            'Wrong jobs parameter: It must be a positive integer')
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point of the verification script
+    :return:              Exit code, 1 when an image does not match
+    """
+    import logging
+    from .args import FORMAT, V_LEVELS
+
+    args = parse_args(argv)
+    logging.basicConfig(
+        format=FORMAT, level=V_LEVELS.get(args.verbose, logging.DEBUG))
+
+    if args.command == 'record':
+        manifest = record_manifest(args.directory, args.output, args.jobs)
+        print("Recorded {} images".format(len(manifest["images"])))
+        return 0
+
+    if isdir(args.target):
+        summary = verify_directory(
+            args.manifest, args.target, args.reference, args.jobs)
+    else:
+        summary = verify_config(
+            args.manifest, args.target, args.reference, args.jobs,
+            args.scene_files)
+
+    for mismatch in summary.mismatches:
+        print(format_mismatch(mismatch))
+    print("Checked {} images, {} mismatches, {:.2f} s".format(
+        summary.checked, len(summary.mismatches), summary.elapsed))
+    return 1 if summary.mismatches else 0
+
+
+__all__ = [
+    'PixelDigest', 'Mismatch', 'VerifySummary', 'pixel_digest',
+    'pixel_diff', 'find_images', 'record_manifest', 'load_manifest',
+    'verify_directory', 'verify_config', 'main']
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Watch mode: incremental re-rendering of the scenes affected by an edit.
+
+The configuration and the scene files are polled for changes. The
+dependencies of a scene are read from its compiled plan: the color keys of
+the color indexes it draws with, once its random slots are resolved, and
+the "seed" key when it has random slots. An edit touching only those keys
+re-renders the scenes depending on them. Any other key (size, background,
+format, encoder settings...) changes every image, and an edited scene
+definition re-renders that scene.
+
+Without a "seed" key one is drawn when watching starts, so the random
+colors of a scene stay the same between re-renders.
+"""
+
+import random
+from collections import OrderedDict
+from json import loads
+from logging import getLogger
+from os.path import getmtime
+from time import sleep
+
+from .main import (
+    get_overrides, get_seeds, get_sizes, open_cache, render_config)
+from .scenes import compile_scene, get_scenes, resolve_colors
+
+log = getLogger(__name__)
+
+
+COLOR_KEYS = ("color1", "color2", "color3", "color4")
+
+# Keys a scene only depends on through its plan
+SCENE_KEYS = frozenset(COLOR_KEYS + ("seed",))
+
+POLL_INTERVAL = 0.5
+
+
+def scene_dependencies(plan, seed):
+    """
+    Color and seed keys the image of a plan depends on
+    :param plan:          DrawPlan of the scene
+    :param seed:          Seed of the scene's random colors
+    :return:              Set of JSON keys
+    """
+    indexes = resolve_colors(plan, random.Random(seed), len(COLOR_KEYS))
+    dependencies = set(COLOR_KEYS[index] for index in indexes)
+    if plan.slots:
+        dependencies.add("seed")
+    return dependencies
+
+
+def changed_keys(old, new):
+    """
+    Keys whose value differs between two configurations
+    """
+    return set(
+        key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def affected_scenes(old_data, new_data, old_scenes, new_scenes):
+    """
+    Names of the scenes whose image changes with an edit
+    :param old_data:      Previous JSON data
+    :param new_data:      Edited JSON data
+    :param old_scenes:    Previous dictionary of scenes by name
+    :param new_scenes:    Edited dictionary of scenes by name
+    :return:              List of names in render order
+    """
+    changed = changed_keys(old_data, new_data)
+    if changed - SCENE_KEYS:
+        return list(new_scenes)
+
+    # Every size of a scene has the same dependencies
+    names = []
+    sizex, sizey = get_sizes(old_data)[0]
+    plans = [
+        compile_scene(scene, sizex, sizey) for scene in new_scenes.values()]
+    for plan, seed in zip(plans, get_seeds(old_data, plans)):
+        if old_scenes.get(plan.name) != new_scenes[plan.name]:
+            names.append(plan.name)
+        elif changed & scene_dependencies(plan, seed):
+            names.append(plan.name)
+    return names
+
+
+class ConfigWatcher:
+    """
+    Polls a configuration and its scene files for changes
+
+    :path:         JSON configuration file
+    :scene_files:  JSON scene files
+    :overrides:    JSON keys replacing the ones of the file
+    :json_data:    Current configuration
+    :scenes:       Current dictionary of scenes by name
+    """
+    def __init__(self, path, scene_files=None, overrides=None):
+        self.path = path
+        self.scene_files = list(scene_files or [])
+        self.overrides = dict(overrides or {})
+        self.__seed = random.getrandbits(64)
+        self.__mtimes = self.__read_mtimes()
+        self.json_data, self.scenes = self.load()
+
+    def load(self):
+        """
+        Reads the configuration and the scenes
+        :return:              (json data, dictionary of scenes by name)
+        """
+        with open(self.path) as json_file:
+            json_data = loads(json_file.read())
+        json_data.update(self.overrides)
+        if json_data.get("seed") is None:
+            json_data["seed"] = self.__seed
+
+        scenes = OrderedDict(
+            (scene.name, scene) for scene in get_scenes(self.scene_files))
+        return json_data, scenes
+
+    def poll(self):
+        """
+        Reloads the files when one of them changed
+        :return:              Names of the scenes to render again, None
+                              when nothing changed
+        """
+        mtimes = self.__read_mtimes()
+        if mtimes == self.__mtimes:
+            return None
+        self.__mtimes = mtimes
+
+        try:
+            json_data, scenes = self.load()
+        except (OSError, ValueError) as error:
+            # An editor may save the file in several steps
+            log.error("Could not reload the configuration: {!r}".format(
+                error))
+            return None
+
+        names = affected_scenes(
+            self.json_data, json_data, self.scenes, scenes)
+        self.json_data, self.scenes = json_data, scenes
+        return names
+
+    def __read_mtimes(self):
+        mtimes = []
+        for path in [self.path] + self.scene_files:
+            try:
+                mtimes.append(getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+
+def micros_imcr_watch(args, interval=POLL_INTERVAL):
+    """
+    Watch call of the IMCR package. Renders every scene, then renders
+    again the scenes affected by each edit of the configuration or of the
+    scene files until interrupted
+    :return:              Exit code
+    """
+    watcher = ConfigWatcher(
+        args.path_to_json, getattr(args, "scene_files", None),
+        get_overrides(args))
+    cache = open_cache(args)
+
+    def render(names):
+        return render_config(
+            watcher.json_data,
+            output_dir=getattr(args, "output_dir", "."),
+            jobs=getattr(args, "jobs", 1) or 1,
+            scene_files=watcher.scene_files,
+            cache=cache,
+            save_threads=getattr(args, "save_threads", 0) or 0,
+            scene_names=names)
+
+    count = render(None)
+    print("Rendered {} images, watching {}".format(count, args.path_to_json))
+
+    try:
+        while True:
+            sleep(interval)
+            names = watcher.poll()
+            if names is None:
+                continue
+            if not names:
+                print("No scene affected")
+                continue
+            try:
+                render(names)
+            except Exception as error:
+                log.error("Rendering failed: {!r}".format(error))
+                continue
+            print("Rendered again: {}".format(", ".join(names)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+__all__ = [
+    'scene_dependencies', 'affected_scenes', 'ConfigWatcher',
+    'micros_imcr_watch']
@@ -57,10 +57,15 @@ setuptools.setup(
     packages=setuptools.find_packages('lib'),
 
     # Scripts are located under the bin directory
-    scripts=['bin/micros_imcr'],
+    scripts=[
+        'bin/micros_imcr', 'bin/micros_imcr_bench', 'bin/micros_imcr_daemon',
+        'bin/micros_imcr_verify'],
 
     # Dependencies
     install_requires=find_requirements('requirements.txt'),
+    extras_require={
+        'numpy': ['numpy'],
+    },
 
     # Metadata
     author="Rodolfo Piedra Camacho",
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Rodolfo José Piedra Camacho
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Every backend must draw the pixels of the pillow backend, on the built-in
+scenes and on random batches running off the canvas.
+"""
+
+import random
+
+import pytest
+
+from micros_imcr.backends import get_backend
+from micros_imcr.canvas import CanvasPool
+from micros_imcr.encoders import EncoderSettings
+from micros_imcr.main import ImcrPrinter
+from micros_imcr.scenes import DrawOp, compile_scene, get_scenes
+
+np = pytest.importorskip("numpy")
+
+BACKENDS = ("numpy", "sparse", "mmap")
+
+SIZES = [(160, 120), (97, 211)]
+
+PALETTE = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+
+JSON_DATA = {
+    "color1": [255, 0, 0],
+    "color2": [0, 255, 0],
+    "color3": [0, 0, 255],
+    "color4": [255, 255, 255],
+    "background": "black",
+    # The mmap backend needs an uncompressed layout
+    "format": "ppm",
+}
+
+
+def scene_pixels(backend, scene, size, seed):
+    """
+    Pixels of a built-in scene drawn by a backend
+    """
+    json_data = dict(JSON_DATA, sizex=size[0], sizey=size[1], backend=backend)
+    printer = ImcrPrinter(json_data, pool=CanvasPool())
+    printer.restart_image()
+    printer.reseed(seed)
+    printer.draw_plan(compile_scene(scene, *size))
+    return np.asarray(printer.current_image.convert("RGB"))
+
+
+def random_ops(rng, size, count):
+    """
+    Lines and arcs with boxes around and beyond the canvas. A few arc
+    shapes come back often, so the batched paths are taken as well
+    """
+    width, height = size
+    shapes = [
+        (rng.randint(0, 30), rng.randint(0, 30), rng.choice([0, 45, 90]),
+         rng.choice([180, 270, 360, 400])) for _ in range(8)]
+    ops = []
+    while len(ops) < count:
+        # Runs of a single kind, the numpy backend batches the long ones
+        kind = rng.random()
+        for _ in range(rng.randint(1, 40)):
+            x = rng.randint(-width // 2, width + width // 2)
+            y = rng.randint(-height // 2, height + height // 2)
+            if kind < 0.4:
+                xy = (x, y, x + rng.randint(-20, 20), y + rng.randint(-20, 20))
+                ops.append(DrawOp("line", xy, 0, None, None))
+            elif kind < 0.5:
+                xy = (x, y, rng.randint(-width, 2 * width),
+                      rng.randint(-height, 2 * height))
+                ops.append(DrawOp("line", xy, 0, None, None))
+            elif kind < 0.9:
+                box_width, box_height, start, end = rng.choice(shapes)
+                xy = (x, y, x + box_width, y + box_height)
+                ops.append(DrawOp("arc", xy, 0, start, end))
+            else:
+                xy = (x, y, x + rng.randint(0, 2 * width),
+                      y + rng.randint(0, 2 * height))
+                ops.append(DrawOp(
+                    "arc", xy, 0, rng.randint(0, 360), rng.randint(0, 720)))
+    return ops
+
+
+def batch_pixels(backend, size, ops, colors):
+    """
+    Pixels of a batch drawn twice on a backend canvas, the second time
+    on a reset canvas
+    """
+    canvas = get_backend(backend)("RGB", size, "black", CanvasPool())
+    if hasattr(canvas, "set_format"):
+        canvas.set_format(EncoderSettings("ppm"))
+    canvas.draw(ops, colors, PALETTE)
+    first = np.asarray(canvas.image.convert("RGB"))
+    canvas.reset()
+    canvas.draw(ops, colors, PALETTE)
+    second = np.asarray(canvas.image.convert("RGB"))
+    assert (first == second).all()
+    return second
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize(
+    "scene", get_scenes(), ids=lambda scene: scene.name)
+def test_scene_matches_pillow(backend, size, scene):
+    expected = scene_pixels("pillow", scene, size, 7)
+    assert (scene_pixels(backend, scene, size, 7) == expected).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("seed", range(3))
+def test_random_batch_matches_pillow(backend, size, seed):
+    rng = random.Random(seed)
+    ops = random_ops(rng, size, 600)
+    colors = [rng.randrange(len(PALETTE)) for _ in ops]
+    expected = batch_pixels("pillow", size, ops, colors)
+    assert (batch_pixels(backend, size, ops, colors) == expected).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_inverted_arc_box_raises(backend):
+    ops = [DrawOp("arc", (10, 10, 5, 20), 0, 0, 90)]
+    with pytest.raises(ValueError):
+        batch_pixels("pillow", (32, 32), ops, [0])
+    with pytest.raises(ValueError):
+        batch_pixels(backend, (32, 32), ops, [0])